@@ -0,0 +1,800 @@
+"""Archive backends for stored repositories
+tar archives must be read from the beginning to index them. parallel_bz2
+decompresses the bz2 blocks of tar.bz2 archives in parallel and keeps the
+block offsets, so reads after indexing only decompress the blocks of the
+member. zip archives keep a central directory and compress members
+independently, so members are found and read without decompressing the
+rest of the archive.
+Both backends expose the same interface: members, exists, read and scan.
+
+Compression backends (BACKENDS) write the archives: external programs
+for tar streams, python-zstd (tarfile and the optional zstandard module),
+zip and blobs (manifests of files in blob_store). Repository.compression
+records the backend of each archive.
+"""
+import argparse
+import bz2
+import os
+import posixpath
+import random
+import shlex
+import shutil
+import stat
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import blob_store
+import config
+from parallel_bz2 import open_reader
+from utils import vprint, pattern_matcher, ignore_surrogates, replace_surrogates
+
+
+FORMATS = ["zip", "tar.bz2", "tar.zst", "tar.xz", "blobs"]
+FILE, DIR, LINK = "file", "dir", "link"
+
+Member = namedtuple("Member", ["name", "kind", "size", "linkname"])
+Backend = namedtuple("Backend", ["name", "suffix", "compressor", "decompressor", "level"])
+
+ZSTD_DECOMPRESSOR = ["zstd", "-q", "-dc", "--long=31"]
+BACKENDS = OrderedDict((backend.name, backend) for backend in [
+    Backend("lbzip2", "tar.bz2", ["lbzip2"], ["lbzip2", "-dc"], None),
+    Backend("bzip2", "tar.bz2", ["bzip2"], ["bzip2", "-dc"], None),
+    Backend("zstd-3", "tar.zst", ["zstd", "-q", "-T0", "-3"], ZSTD_DECOMPRESSOR, None),
+    Backend("zstd-19", "tar.zst", ["zstd", "-q", "-T0", "-19"], ZSTD_DECOMPRESSOR, None),
+    Backend(
+        "zstd-19-long", "tar.zst", ["zstd", "-q", "-T0", "-19", "--long=27"],
+        ZSTD_DECOMPRESSOR, None
+    ),
+    Backend("xz", "tar.xz", ["xz", "-q", "-T0", "-6"], ["xz", "-q", "-T0", "-dc"], None),
+    Backend("python-zstd", "tar.zst", None, None, 10),
+    Backend("zip", "zip", None, None, None),
+    Backend("blobs", "blobs", None, None, None),
+])
+
+THREAD_OPTIONS = {"lbzip2": "-n{}", "zstd": "-T{}", "xz": "-T{}"}
+
+# Decompression programs in order of preference. None decompresses in-process
+DECODERS = {
+    "tar": [None],
+    "tar.bz2": [["lbzip2", "-dc"], None],
+    "tar.zst": [ZSTD_DECOMPRESSOR, None],
+    "tar.xz": [["xz", "-q", "-T0", "-dc"], None],
+}
+
+
+def get_backend(name=None):
+    """Return compression backend. Defaults to config.COMPRESSION
+    Unknown names are compression programs for tar.bz2 archives"""
+    if isinstance(name, Backend):
+        return name
+    name = name or config.COMPRESSION
+    if name in BACKENDS:
+        return BACKENDS[name]
+    program = shlex.split(name)
+    return Backend(name, "tar.bz2", program, program + ["-dc"], None)
+
+
+def with_threads(backend, threads):
+    """Return backend with its compressor limited to threads"""
+    if not backend.compressor:
+        return backend
+    option = THREAD_OPTIONS.get(os.path.basename(backend.compressor[0]))
+    if option is None:
+        return backend
+    compressor = [arg for arg in backend.compressor if not arg.startswith(option[:2])]
+    return backend._replace(compressor=compressor + [option.format(threads)])
+
+
+def backend_for(path):
+    """Return the backend that writes an archive path
+    config.COMPRESSION takes precedence over other backends of the format"""
+    suffix = archive_format(path)
+    default = get_backend()
+    if default.suffix == suffix:
+        return default
+    return next(backend for backend in BACKENDS.values() if backend.suffix == suffix)
+
+
+def tar_backend():
+    """Return config.COMPRESSION if it compresses tar streams, or lbzip2"""
+    backend = get_backend()
+    return BACKENDS["lbzip2"] if backend.suffix in ("zip", "blobs") else backend
+
+
+def archive_path(path, archive_format=None):
+    """Return the archive of a repository path
+    Existing archives take precedence over the config.COMPRESSION format"""
+    if archive_format is None:
+        for suffix in FORMATS:
+            candidate = config.Path("{}.{}".format(path, suffix))
+            if candidate.exists():
+                return candidate
+        archive_format = get_backend().suffix
+    return config.Path("{}.{}".format(path, archive_format))
+
+
+def archive_format(path):
+    """Return the format of an archive path"""
+    path = str(path)
+    for suffix in FORMATS:
+        if path.endswith("." + suffix):
+            return suffix
+    return "tar" if path.endswith(".tar") else "tar.bz2"
+
+
+def installed(program):
+    """Check if the program of a command is installed"""
+    return bool(program) and shutil.which(program[0]) is not None
+
+
+def command(action, *args):
+    """Return command that runs an action of this module"""
+    return [sys.executable, os.path.abspath(__file__), action] + list(map(str, args))
+
+
+def resolve_link(name, linkname):
+    """Return the archive name that a symbolic link points to"""
+    return posixpath.normpath(posixpath.join(posixpath.dirname(name), linkname))
+
+
+def open_decompressed(path):
+    """Open the uncompressed tar stream of an archive in-process"""
+    suffix = archive_format(path)
+    if suffix == "tar":
+        return open(str(path), "rb")
+    if suffix == "tar.bz2":
+        return open_reader(path) or bz2.BZ2File(str(path))
+    if suffix == "tar.xz":
+        import lzma
+        return lzma.open(str(path))
+    if suffix == "tar.zst" and zstandard is not None:
+        return zstandard.ZstdDecompressor(max_window_size=2 ** 31).stream_reader(
+            open(str(path), "rb"), read_across_frames=True
+        )
+    raise IOError("No decompressor available for {}".format(path))
+
+
+@contextmanager
+def decompressed_stream(path, programs=None):
+    """Yield the uncompressed tar stream of an archive
+    Decompression runs in the first installed program and in-process when
+    programs has None before it. programs defaults to the DECODERS of the
+    format, after the decompressor of config.COMPRESSION"""
+    if programs is None:
+        programs = list(DECODERS[archive_format(path)])
+        default = get_backend()
+        if default.suffix == archive_format(path) and default.decompressor:
+            programs.insert(0, default.decompressor)
+    for program in programs:
+        if program is None:
+            stream = open_decompressed(path)
+            try:
+                yield stream
+            finally:
+                stream.close()
+            return
+        if installed(program):
+            break
+    else:
+        raise IOError("No decompressor installed for {}".format(path))
+    process = subprocess.Popen(
+        program + [str(path)],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    try:
+        yield process.stdout
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+
+
+@contextmanager
+def compressed_writer(fileobj, backend):
+    """Yield a stream that compresses what is written to it into fileobj"""
+    if backend.compressor:
+        process = subprocess.Popen(backend.compressor, stdin=subprocess.PIPE, stdout=fileobj)
+        try:
+            yield process.stdin
+        finally:
+            process.stdin.close()
+            if process.wait() != 0:
+                raise EnvironmentError("Compression failed with {}".format(backend.name))
+    elif backend.name == "python-zstd":
+        if zstandard is None:
+            raise EnvironmentError("python-zstd requires the zstandard module")
+        compressor = zstandard.ZstdCompressor(level=backend.level, threads=-1)
+        with compressor.stream_writer(fileobj, closefd=False) as stream:
+            yield stream
+    else:
+        raise ValueError("{} does not compress tar streams".format(backend.name))
+
+
+def open_tar(path):
+    """Open compressed tar archive for random access
+    Returns the tarfile and the file object to close after it. bz2 blocks
+    are indexed by parallel_bz2. Other formats are decompressed into a
+    temporary file"""
+    if archive_format(path) == "tar.bz2":
+        reader = open_reader(path)
+        if reader is None:
+            return tarfile.open(str(path)), None
+        return tarfile.open(fileobj=reader), reader
+    spool = tempfile.TemporaryFile()
+    with decompressed_stream(path) as stream:
+        shutil.copyfileobj(stream, spool, 2 ** 20)
+    spool.seek(0)
+    return tarfile.open(fileobj=spool), spool
+
+
+@contextmanager
+def open_tar_stream(path):
+    """Open compressed tar archive for a single sequential pass"""
+    with decompressed_stream(path) as stream:
+        with tarfile.open(fileobj=stream, mode="r|") as tarzip:
+            yield tarzip
+
+
+class TarArchive(object):
+    """Sequential compressed tar archive
+    The member index requires a full decompression"""
+    seekable = False
+
+    def __init__(self, path):
+        self.path = config.Path(str(path))
+        self.tarzip = None
+        self.reader = None
+        self.index = None
+
+    def load(self):
+        """Open archive for random access and index its members
+        Indexed bz2 blocks let reads decompress only the blocks of a member"""
+        if self.index is None:
+            self.tarzip, self.reader = open_tar(self.path)
+            self.index = {
+                info.name.rstrip("/"): info for info in self.tarzip.getmembers()
+            }
+        return self.index
+
+    @staticmethod
+    def member(info):
+        """Convert TarInfo to Member"""
+        if info.isdir():
+            return Member(info.name.rstrip("/"), DIR, 0, None)
+        if info.issym():
+            return Member(info.name, LINK, 0, resolve_link(info.name, info.linkname))
+        if info.islnk():
+            return Member(info.name, LINK, 0, info.linkname)
+        return Member(info.name, FILE, info.size, None)
+
+    def members(self):
+        """Return members"""
+        return [self.member(info) for info in self.load().values()]
+
+    def exists(self, name):
+        """Check if member exists"""
+        return name.rstrip("/") in self.load()
+
+    def read(self, name):
+        """Read member content. Raises KeyError if it does not exist"""
+        info = self.load()[name.rstrip("/")]
+        fileobj = self.tarzip.extractfile(info)
+        if fileobj is None:
+            raise KeyError("{} is not a file".format(name))
+        return fileobj.read()
+
+    def scan(self):
+        """Yield (member, read) in archive order with a single decompression
+        read() returns the content of file members while the member is current"""
+        with open_tar_stream(self.path) as tarzip:
+            for info in tarzip:
+                yield self.member(info), lambda info=info: tarzip.extractfile(info).read()
+
+    def close(self):
+        """Close archive"""
+        if self.tarzip is not None:
+            self.tarzip.close()
+        if self.reader is not None:
+            self.reader.close()
+        self.tarzip = self.reader = self.index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ZipArchive(TarArchive):
+    """Seekable zip archive
+    Symbolic links are stored as in Info-ZIP: unix mode in the external
+    attributes and the link target as content"""
+    seekable = True
+
+    def load(self):
+        """Open archive and index its central directory"""
+        if self.index is None:
+            self.tarzip = zipfile.ZipFile(str(self.path))
+            self.index = {
+                info.filename.rstrip("/"): info for info in self.tarzip.infolist()
+            }
+        return self.index
+
+    def member(self, info):
+        """Convert ZipInfo to Member"""
+        name = info.filename.rstrip("/")
+        mode = info.external_attr >> 16
+        if info.filename.endswith("/"):
+            return Member(name, DIR, 0, None)
+        if stat.S_ISLNK(mode):
+            linkname = self.tarzip.read(info).decode("utf-8", "surrogateescape")
+            return Member(name, LINK, 0, resolve_link(name, linkname))
+        return Member(name, FILE, info.file_size, None)
+
+    def read(self, name):
+        """Read member content following symbolic links
+        Raises KeyError if it does not exist"""
+        for _ in range(40):
+            member = self.member(self.load()[name.rstrip("/")])
+            if member.kind == FILE:
+                return self.tarzip.read(self.index[member.name])
+            if member.kind == DIR:
+                raise KeyError("{} is not a file".format(name))
+            name = member.linkname
+        raise KeyError("Too many levels of symbolic links: {}".format(name))
+
+    def scan(self):
+        """Yield (member, read) in archive order
+        Only members that are read get decompressed"""
+        for info in list(self.load().values()):
+            yield self.member(info), lambda info=info: self.tarzip.read(info)
+
+
+class BlobArchive(TarArchive):
+    """Manifest of files in the blob store
+    Members are read from their blobs without decompression"""
+    seekable = True
+
+    def load(self):
+        """Read manifest"""
+        if self.index is None:
+            self.index = {
+                entry["name"]: entry for entry in blob_store.read_manifest(self.path)
+            }
+        return self.index
+
+    @staticmethod
+    def member(entry):
+        """Convert manifest entry to Member"""
+        if "link" in entry:
+            return Member(entry["name"], LINK, 0, resolve_link(entry["name"], entry["link"]))
+        if "blob" in entry:
+            return Member(entry["name"], FILE, entry["size"], None)
+        return Member(entry["name"], DIR, 0, None)
+
+    def read(self, name):
+        """Read member content following symbolic links
+        Raises KeyError if it does not exist"""
+        for _ in range(40):
+            entry = self.load()[name.rstrip("/")]
+            member = self.member(entry)
+            if member.kind == FILE:
+                with open(str(blob_store.entry_blob(entry)), "rb") as fil:
+                    return fil.read()
+            if member.kind == DIR:
+                raise KeyError("{} is not a file".format(name))
+            name = member.linkname
+        raise KeyError("Too many levels of symbolic links: {}".format(name))
+
+    def scan(self):
+        """Yield (member, read) in manifest order"""
+        for entry in list(self.load().values()):
+            member = self.member(entry)
+            yield member, lambda name=member.name: self.read(name)
+
+
+ARCHIVES = {"zip": ZipArchive, "blobs": BlobArchive}
+
+
+def open_archive(path):
+    """Open archive backend for path"""
+    return ARCHIVES.get(archive_format(path), TarArchive)(path)
+
+
+def read_members(path, root, names):
+    """Read files of an archived repository in memory
+    Returns a dict of name -> bytes for the names found in the archive.
+    Seekable archives read only the requested members. Sequential archives
+    make a pass that follows symbolic links and stops once all names are
+    found. Links to members earlier in the stream take another pass"""
+    result = {}
+    with open_archive(path) as archive:
+        if archive.seekable:
+            for name in names:
+                try:
+                    result[name] = archive.read(posixpath.join(root, name))
+                except KeyError:
+                    pass
+            return result
+        wanted = {}
+        seen = {}
+        for name in names:
+            wanted.setdefault(posixpath.join(root, name), []).append(name)
+        for _ in range(40):
+            followed = False
+            for member, read in archive.scan():
+                if member.name not in wanted:
+                    continue
+                found = wanted.pop(member.name)
+                if member.kind == LINK and member.linkname in seen:
+                    for name in found:
+                        result[name] = seen[member.linkname]
+                elif member.kind == LINK:
+                    wanted.setdefault(member.linkname, []).extend(found)
+                    followed = True
+                    continue
+                elif member.kind == FILE:
+                    data = seen[member.name] = read()
+                    for name in found:
+                        result[name] = data
+                if not wanted:
+                    break
+            if not wanted or not followed:
+                break
+    return result
+
+
+def scan_members(path, root, patterns, skip=(".git",)):
+    """Find and read files matching each pattern in a single pass
+    Patterns are matched as in utils.scan_files. Symbolic links are followed
+    when their target is a matched file or comes later in the stream.
+    Returns the relative paths for each pattern and a dict of
+    relative path -> bytes for the matched files that could be read"""
+    found = [[] for _ in patterns]
+    contents = {}
+    links = {}
+    match = pattern_matcher(patterns)
+    prefix = root + "/"
+    with open_archive(path) as archive:
+        for member, read in archive.scan():
+            if member.name in links and member.kind == FILE:
+                data = read()
+                for relative in links.pop(member.name):
+                    contents[relative] = data
+            if not member.name.startswith(prefix) or member.kind == DIR:
+                continue
+            relative = member.name[len(prefix):]
+            parts = relative.split("/")
+            if any(part in skip for part in parts[:-1]):
+                continue
+            indexes = match(parts[-1])
+            if not indexes:
+                continue
+            for index in indexes:
+                found[index].append(config.Path(relative))
+            if member.kind == FILE:
+                if relative not in contents:
+                    contents[relative] = read()
+            elif member.linkname.startswith(prefix) and member.linkname[len(prefix):] in contents:
+                contents[relative] = contents[member.linkname[len(prefix):]]
+            else:
+                links.setdefault(member.linkname, []).append(relative)
+    return found, contents
+
+
+def zip_info(name, mode, mtime):
+    """Create ZipInfo for a unix entry
+    zip names are UTF-8, so surrogates are replaced"""
+    info = zipfile.ZipInfo(
+        replace_surrogates(name), time.localtime(max(mtime, 315532800))[:6]
+    )
+    info.external_attr = (mode & 0xFFFF) << 16
+    info.create_system = 3
+    info.compress_type = zipfile.ZIP_DEFLATED
+    return info
+
+
+def manifest_entries(members, root):
+    """Return (path, size, had_surrogates) RepositoryFile entries of members
+    Paths are relative to root. Raises ValueError for members outside root"""
+    entries = []
+    for member in members:
+        if not member.name.startswith(root):
+            raise ValueError("Invalid file in archive: {}".format(member.name))
+        name, had_surrogates = ignore_surrogates(member.name)
+        entries.append((name[len(root) + 1:], member.size, had_surrogates))
+    return entries
+
+
+def compress_zip(source, target, members=None):
+    """Write directory into a zip archive with the directory name as root
+    Appends the Member of each entry to members. zip names are UTF-8, so
+    surrogates in names and link targets are replaced"""
+    members = [] if members is None else members
+    source = str(source)
+    root = os.path.basename(source.rstrip("/"))
+    partial = "{}.partial".format(target)
+    with zipfile.ZipFile(partial, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as out:
+        for directory, dirnames, filenames in os.walk(source):
+            relative = posixpath.join(root, os.path.relpath(directory, source))
+            relative = replace_surrogates(posixpath.normpath(relative))
+            out.writestr(zip_info(relative + "/", os.lstat(directory).st_mode, 0), b"")
+            members.append(Member(relative, DIR, 0, None))
+            for name in dirnames + filenames:
+                full = os.path.join(directory, name)
+                status = os.lstat(full)
+                arcname = posixpath.join(relative, replace_surrogates(name))
+                if stat.S_ISLNK(status.st_mode):
+                    linkname = replace_surrogates(os.readlink(full))
+                    out.writestr(
+                        zip_info(arcname, status.st_mode, status.st_mtime),
+                        linkname.encode("utf-8")
+                    )
+                    members.append(Member(arcname, LINK, 0, resolve_link(arcname, linkname)))
+                elif stat.S_ISREG(status.st_mode):
+                    members.append(Member(arcname, FILE, status.st_size, None))
+                    info = zip_info(arcname, status.st_mode, status.st_mtime)
+                    info.file_size = status.st_size
+                    large = status.st_size > zipfile.ZIP64_LIMIT
+                    with open(full, "rb") as src, out.open(info, "w", force_zip64=large) as dst:
+                        shutil.copyfileobj(src, dst, 2 ** 20)
+    os.rename(partial, str(target))
+    return True
+
+
+def write_blobs(entries, target, members=None):
+    """Write blob manifest and append the Member of each entry to members"""
+    if members is not None:
+        members.extend(BlobArchive.member(entry) for entry in entries)
+    blob_store.write_manifest(target, entries)
+    return True
+
+
+def compress_tar(source, target, backend, members=None):
+    """Write directory into a compressed tar archive with the directory name as root
+    Appends the Member of each entry to members"""
+    members = [] if members is None else members
+    source = str(source)
+    partial = "{}.partial".format(target)
+
+    def record(info):
+        members.append(TarArchive.member(info))
+        return info
+
+    try:
+        with open(partial, "wb") as fil, compressed_writer(fil, backend) as stream:
+            with tarfile.open(fileobj=stream, mode="w|") as out:
+                out.add(source, arcname=os.path.basename(source.rstrip("/")), filter=record)
+        os.rename(partial, str(target))
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return True
+
+
+def compress(source, target, backend=None, members=None):
+    """Compress directory. backend defaults to the backend of the target
+    Appends the Member of each archive entry to members"""
+    backend = backend or backend_for(target)
+    if backend.suffix == "zip":
+        return compress_zip(source, target, members)
+    if backend.suffix == "blobs":
+        return write_blobs(blob_store.store_directory(source), target, members)
+    return compress_tar(source, target, backend, members)
+
+
+def convert(source, target):
+    """Convert tar archive into zip with a single decompression pass
+    Hard links become symbolic links to their target"""
+    partial = "{}.partial".format(target)
+    with zipfile.ZipFile(partial, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as out:
+        with open_tar_stream(source) as tarzip:
+            for info in tarzip:
+                name = info.name.rstrip("/")
+                if info.isdir():
+                    out.writestr(zip_info(name + "/", stat.S_IFDIR | info.mode, info.mtime), b"")
+                elif info.issym() or info.islnk():
+                    linkname = info.linkname
+                    if info.islnk():
+                        linkname = posixpath.relpath(linkname, posixpath.dirname(name))
+                    out.writestr(
+                        zip_info(name, stat.S_IFLNK | 0o777, info.mtime),
+                        replace_surrogates(linkname).encode("utf-8")
+                    )
+                elif info.isfile():
+                    zinfo = zip_info(name, stat.S_IFREG | info.mode, info.mtime)
+                    zinfo.file_size = info.size
+                    large = info.size > zipfile.ZIP64_LIMIT
+                    with out.open(zinfo, "w", force_zip64=large) as dst:
+                        shutil.copyfileobj(tarzip.extractfile(info), dst, 2 ** 20)
+    os.rename(partial, str(target))
+    return True
+
+
+def recompress(source, target, backend=None):
+    """Convert archive into the format of a backend with a single decompression pass
+    Between tar formats, the uncompressed stream is copied without parsing it"""
+    backend = backend or backend_for(target)
+    if archive_format(source) in ("zip", "blobs"):
+        raise ValueError("Cannot convert {} archive {}".format(archive_format(source), source))
+    if backend.suffix == "zip":
+        return convert(source, target)
+    if backend.suffix == "blobs":
+        with open_tar_stream(source) as tarzip:
+            return write_blobs(blob_store.store_tar(tarzip), target)
+    partial = "{}.partial".format(target)
+    try:
+        with decompressed_stream(source) as src, open(partial, "wb") as fil:
+            with compressed_writer(fil, backend) as dst:
+                shutil.copyfileobj(src, dst, 2 ** 20)
+        os.rename(partial, str(target))
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return True
+
+
+def unpack(source, target, backend=None):
+    """Decompress archive into target with the decompressor of a backend
+    Writes the uncompressed tar stream, or the file contents of zip and
+    blobs archives. Without backend, it uses the decompressors of
+    decompressed_stream"""
+    programs = [backend.decompressor] if backend else None
+    with open(str(target), "wb") as out:
+        if archive_format(source) in ARCHIVES:
+            with open_archive(source) as archive:
+                for member, read in archive.scan():
+                    if member.kind == FILE:
+                        out.write(read())
+            return True
+        with decompressed_stream(source, programs) as stream:
+            shutil.copyfileobj(stream, out, 2 ** 20)
+    return True
+
+
+def converted_path(path, backend):
+    """Return the path of an archive converted to the format of a backend"""
+    path = str(path)
+    return "{}.{}".format(path[:-len(archive_format(path)) - 1], backend.suffix)
+
+
+def extract_tar(source, target):
+    """Extract tar archive in a single pass"""
+    options = {"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}
+    with open_tar_stream(source) as tarzip:
+        tarzip.extractall(str(target), **options)
+    return True
+
+
+def extract_zip(source, target):
+    """Extract zip archive restoring symbolic links and modes
+    Members may not leave target, neither by name nor through the symbolic
+    links of previous members"""
+    target = os.path.abspath(str(target))
+    real_target = os.path.realpath(target)
+    with zipfile.ZipFile(str(source)) as archive:
+        for info in archive.infolist():
+            full = os.path.abspath(os.path.join(target, info.filename))
+            if not full.startswith(target + os.sep) or not blob_store.inside(
+                    os.path.realpath(os.path.dirname(full)), real_target):
+                raise ValueError("Invalid member: {}".format(info.filename))
+            mode = info.external_attr >> 16
+            if info.filename.endswith("/"):
+                if not os.path.isdir(full):
+                    os.makedirs(full)
+                continue
+            parent = os.path.dirname(full)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            if os.path.islink(full):
+                os.remove(full)
+            if stat.S_ISLNK(mode):
+                os.symlink(archive.read(info).decode("utf-8", "surrogateescape"), full)
+                continue
+            with archive.open(info) as src, open(full, "wb") as dst:
+                shutil.copyfileobj(src, dst, 2 ** 20)
+            if mode:
+                os.chmod(full, stat.S_IMODE(mode))
+    return True
+
+
+def extract(source, target, copy=False):
+    """Extract archive into target
+    Blob manifests are materialized with hard links unless copy is set"""
+    archive = archive_format(source)
+    if archive == "zip":
+        return extract_zip(source, target)
+    if archive == "blobs":
+        blob_store.materialize(blob_store.read_manifest(source), target, copy)
+        return True
+    return extract_tar(source, target)
+
+
+def benchmark(paths, reads):
+    """Compare member read latency and full read time of archive formats"""
+    for path in paths:
+        tar_path = archive_path(path, "tar.bz2")
+        zip_path = archive_path(path, "zip")
+        if not tar_path.exists():
+            vprint(0, "{}: tar.bz2 not found".format(path))
+            continue
+        if not zip_path.exists():
+            convert(tar_path, zip_path)
+        vprint(0, "{}: tar.bz2 {:.1f} MB, zip {:.1f} MB".format(
+            path, tar_path.stat().st_size / 2 ** 20, zip_path.stat().st_size / 2 ** 20
+        ))
+        for archive in (TarArchive(tar_path), ZipArchive(zip_path)):
+            with archive:
+                start = time.perf_counter()
+                files = [member.name for member in archive.members() if member.kind == FILE]
+                indexed = time.perf_counter() - start
+                sample = random.Random(0).sample(files, min(reads, len(files)))
+                start = time.perf_counter()
+                for name in sample:
+                    archive.read(name)
+                latency = (time.perf_counter() - start) / max(len(sample), 1)
+            start = time.perf_counter()
+            for member, read in open_archive(archive.path).scan():
+                if member.kind == FILE:
+                    read()
+            full = time.perf_counter() - start
+            vprint(0, "- {}: index {:.3f}s, read {:.2f} ms/member, all members {:.3f}s".format(
+                archive_format(archive.path), indexed, latency * 1000, full
+            ))
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(
+        description="Convert, compress, extract and benchmark repository archives")
+    parser.add_argument("-v", "--verbose", type=int, default=config.VERBOSE,
+                        help="increase output verbosity")
+    parser.add_argument("action", choices=[
+        "compress", "extract", "convert", "unpack", "benchmark"
+    ], help="compress SOURCE TARGET, extract ARCHIVE TARGET, convert ARCHIVES, "
+             "unpack ARCHIVE TARGET or benchmark REPOSITORY_PATHS")
+    parser.add_argument("paths", nargs="+",
+                        help="paths")
+    parser.add_argument("-b", "--backend", type=str, choices=list(BACKENDS),
+                        help="compression backend. convert defaults to zip and "
+                        "the other actions to the backend of the archive")
+    parser.add_argument("-r", "--remove", action="store_true",
+                        help="remove original archives after conversion")
+    parser.add_argument("-n", "--reads", type=int, default=20,
+                        help="members read by the benchmark")
+    parser.add_argument("--copy", action="store_true",
+                        help="extract blobs archives as copies instead of hard links")
+    args = parser.parse_args()
+    config.VERBOSE = args.verbose
+    backend = BACKENDS[args.backend] if args.backend else None
+    if args.action == "compress":
+        compress(args.paths[0], args.paths[1], backend)
+    elif args.action == "extract":
+        extract(args.paths[0], args.paths[1], args.copy)
+    elif args.action == "unpack":
+        unpack(args.paths[0], args.paths[1], backend)
+    elif args.action == "benchmark":
+        benchmark(args.paths, args.reads)
+    else:
+        backend = backend or BACKENDS["zip"]
+        for path in args.paths:
+            target = converted_path(path, backend)
+            vprint(0, "Converting {} into {}".format(path, target))
+            recompress(path, target, backend)
+            if args.remove and target != str(path):
+                os.remove(str(path))
+
+if __name__ == "__main__":
+    main()
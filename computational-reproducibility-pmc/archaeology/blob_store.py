@@ -0,0 +1,302 @@
+"""Content-addressed blob store for repository contents
+Files are stored once by sha256 in config.BLOB_STORE. Each repository keeps
+a manifest (<hash_dir2>.blobs) with one JSON entry per line: the archive
+name and mode of every file, directory and symbolic link, and the blob of
+each file. Working trees are materialized with hard links to the blobs, so
+forks, vendored datasets and copied folders take the space of one copy.
+Blobs are read-only and shared by every tree that links them. Trees that
+may be modified, such as execution directories, must be copies.
+"""
+import argparse
+import errno
+import glob
+import hashlib
+import json
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+import time
+
+import config
+from utils import vprint
+
+
+def objects_dir():
+    """Return the directory of the blobs"""
+    return config.BLOB_STORE / "objects"
+
+
+def blob_path(digest, executable=False):
+    """Return the path of a blob
+    Hard links share modes, so executable files have their own blobs"""
+    name = digest + (".x" if executable else "")
+    return objects_dir() / digest[:2] / name
+
+
+def makedirs(path):
+    """Create directory and its parents if they do not exist"""
+    try:
+        os.makedirs(str(path))
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+
+def file_digest(path):
+    """Return sha256 of a file"""
+    digest = hashlib.sha256()
+    with open(str(path), "rb") as fil:
+        for chunk in iter(lambda: fil.read(2 ** 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def put(fileobj, executable=False):
+    """Store the content of a file object. Returns (digest, size)"""
+    temp_dir = config.BLOB_STORE / "tmp"
+    makedirs(temp_dir)
+    digest = hashlib.sha256()
+    size = 0
+    handle, temp = tempfile.mkstemp(dir=str(temp_dir))
+    try:
+        with os.fdopen(handle, "wb") as out:
+            for chunk in iter(lambda: fileobj.read(2 ** 20), b""):
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        path = blob_path(digest.hexdigest(), executable)
+        if not path.exists():
+            os.chmod(temp, 0o555 if executable else 0o444)
+            makedirs(path.parent)
+            os.rename(temp, str(path))
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+    return digest.hexdigest(), size
+
+
+def put_file(path, executable=False):
+    """Store a file. Files that are already stored are only read once"""
+    digest = file_digest(path)
+    if blob_path(digest, executable).exists():
+        return digest, os.path.getsize(str(path))
+    with open(str(path), "rb") as fil:
+        return put(fil, executable)
+
+
+def file_entry(name, mode, fileobj=None, path=None):
+    """Store a regular file and return its manifest entry"""
+    executable = bool(mode & 0o111)
+    if path is not None:
+        digest, size = put_file(path, executable)
+    else:
+        digest, size = put(fileobj, executable)
+    return {"name": name, "mode": stat.S_IMODE(mode), "size": size, "blob": digest}
+
+
+def store_directory(source):
+    """Store the files of a directory
+    Returns manifest entries with the directory name as root"""
+    source = str(source).rstrip("/")
+    root = os.path.basename(source)
+    entries = []
+    for directory, dirnames, filenames in os.walk(source):
+        relative = os.path.normpath(os.path.join(root, os.path.relpath(directory, source)))
+        entries.append({"name": relative, "mode": stat.S_IMODE(os.lstat(directory).st_mode)})
+        for name in sorted(dirnames + filenames):
+            full = os.path.join(directory, name)
+            status = os.lstat(full)
+            arcname = relative + "/" + name
+            if stat.S_ISLNK(status.st_mode):
+                entries.append({
+                    "name": arcname, "mode": 0o777, "link": os.readlink(full)
+                })
+            elif stat.S_ISREG(status.st_mode):
+                entries.append(file_entry(arcname, status.st_mode, path=full))
+    return entries
+
+
+def store_tar(tarzip):
+    """Store the files of a tar stream
+    Hard links become symbolic links to their target"""
+    entries = []
+    for info in tarzip:
+        name = info.name.rstrip("/")
+        if info.isdir():
+            entries.append({"name": name, "mode": info.mode})
+        elif info.issym() or info.islnk():
+            linkname = info.linkname
+            if info.islnk():
+                linkname = os.path.relpath(linkname, os.path.dirname(name) or ".")
+            entries.append({"name": name, "mode": 0o777, "link": linkname})
+        elif info.isfile():
+            entries.append(file_entry(name, info.mode, tarzip.extractfile(info)))
+    return entries
+
+
+def write_manifest(path, entries):
+    """Write manifest atomically"""
+    partial = "{}.partial".format(path)
+    with open(partial, "w") as out:
+        for entry in entries:
+            out.write(json.dumps(entry, sort_keys=True) + "\n")
+    os.rename(partial, str(path))
+
+
+def read_manifest(path):
+    """Read manifest entries"""
+    with open(str(path), "r") as fil:
+        return [json.loads(line) for line in fil if line.strip()]
+
+
+def entry_blob(entry):
+    """Return the blob path of a file entry"""
+    return blob_path(entry["blob"], entry["mode"] & 0o111)
+
+
+def inside(path, directory):
+    """Check if path is directory or is below it"""
+    return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
+
+
+def materialize(entries, target, copy=False):
+    """Create the working tree of manifest entries in target
+    Files are hard links to the blobs unless copy is set or the store is in
+    another filesystem. Returns True if it used hard links.
+    Entries may not leave target, neither by name nor through the symbolic
+    links of previous entries"""
+    target = os.path.abspath(str(target))
+    real_target = os.path.realpath(target)
+    link = not copy
+    for entry in entries:
+        full = os.path.abspath(os.path.join(target, entry["name"]))
+        if not inside(full, target) or not inside(
+                os.path.realpath(os.path.dirname(full)), real_target):
+            raise ValueError("Invalid entry: {}".format(entry["name"]))
+        if "blob" not in entry and "link" not in entry:
+            makedirs(full)
+            continue
+        makedirs(os.path.dirname(full))
+        if os.path.lexists(full):
+            os.remove(full)
+        if "link" in entry:
+            os.symlink(entry["link"], full)
+            continue
+        source = str(entry_blob(entry))
+        if link:
+            try:
+                os.link(source, full)
+                continue
+            except OSError as err:
+                if err.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+                    raise
+                vprint(2, "Hard links unavailable ({}). Copying".format(err))
+                link = False
+        shutil.copyfile(source, full)
+        os.chmod(full, entry["mode"])
+    return link
+
+
+def manifests(paths=None):
+    """Return manifest paths. Defaults to the manifests in BASE_DIR/content"""
+    if paths:
+        return [str(path) for path in paths]
+    return sorted(glob.glob(str(config.BASE_DIR / "content" / "*" / "*.blobs")))
+
+
+def report(paths=None):
+    """Print how much space the blob store saves"""
+    blobs = {}
+    files = logical = 0
+    found = manifests(paths)
+    for path in found:
+        for entry in read_manifest(path):
+            if "blob" in entry:
+                files += 1
+                logical += entry["size"]
+                blobs[(entry["blob"], bool(entry["mode"] & 0o111))] = entry["size"]
+    stored = sum(blobs.values())
+    vprint(0, "Manifests: {}. Files: {}. Blobs: {}".format(len(found), files, len(blobs)))
+    vprint(0, "Logical: {:.1f} MB. Stored: {:.1f} MB. Dedup ratio: {:.2f}".format(
+        logical / 2 ** 20, stored / 2 ** 20, logical / stored if stored else 1.0
+    ))
+
+
+def benchmark(paths=None, count=10):
+    """Compare materialization with hard links, copies and tar extraction
+    Trees are created next to the blob store, in the same filesystem"""
+    selected = manifests(paths)[:count]
+    totals = {"link": 0.0, "copy": 0.0, "tar": 0.0}
+    tar_count = 0
+    makedirs(config.BLOB_STORE)
+    directory = tempfile.mkdtemp(dir=str(config.BLOB_STORE))
+    try:
+        for path in selected:
+            entries = read_manifest(path)
+            size = sum(entry.get("size", 0) for entry in entries)
+            times = {}
+            for mode in ("link", "copy"):
+                target = os.path.join(directory, mode)
+                start = time.time()
+                materialize(entries, target, copy=mode == "copy")
+                times[mode] = time.time() - start
+                shutil.rmtree(target)
+            archive = next((
+                candidate for candidate in glob.glob(path[:-len(".blobs")] + ".tar*")
+                if not candidate.endswith(".partial")
+            ), None)
+            if archive:
+                target = os.path.join(directory, "tar")
+                os.mkdir(target)
+                start = time.time()
+                subprocess.check_call(["tar", "-xf", archive, "-C", target])
+                times["tar"] = time.time() - start
+                shutil.rmtree(target)
+                tar_count += 1
+            for mode, elapsed in times.items():
+                totals[mode] += elapsed
+            vprint(1, "{}: {} entries, {:.1f} MB. {}".format(
+                path, len(entries), size / 2 ** 20, ", ".join(
+                    "{} {:.3f}s".format(mode, elapsed) for mode, elapsed in sorted(times.items())
+                )
+            ))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    vprint(0, "Repositories: {}. Hard links: {:.3f}s. Copies: {:.3f}s".format(
+        len(selected), totals["link"], totals["copy"]
+    ))
+    if tar_count:
+        vprint(0, "tar -xf of the {} repositories with tar archives: {:.3f}s".format(
+            tar_count, totals["tar"]
+        ))
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(
+        description="Report and benchmark the blob store")
+    parser.add_argument("-v", "--verbose", type=int, default=config.VERBOSE,
+                        help="increase output verbosity")
+    parser.add_argument("command", choices=["report", "benchmark", "materialize"],
+                        help="report deduplication, benchmark materialization "
+                        "or materialize MANIFEST TARGET")
+    parser.add_argument("paths", nargs="*",
+                        help="manifests. Defaults to the manifests in BASE_DIR/content")
+    parser.add_argument("-n", "--count", type=int, default=10,
+                        help="repositories of the benchmark")
+    parser.add_argument("--copy", action="store_true",
+                        help="materialize copies instead of hard links")
+    args = parser.parse_args()
+    config.VERBOSE = args.verbose
+    if args.command == "report":
+        report(args.paths)
+    elif args.command == "benchmark":
+        benchmark(args.paths, args.count)
+    else:
+        materialize(read_manifest(args.paths[0]), args.paths[1], args.copy)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""Cached IPython input transformation
+Cells without IPython syntax skip the transformation. The other results
+are stored in a sqlite_cache keyed by the hash of the source and the
+IPython version, so they are reused across runs and by every stage.
+"""
+import argparse
+import hashlib
+import re
+import tempfile
+import time
+
+import IPython
+from IPython.core.interactiveshell import InteractiveShell
+
+import config
+from notebook_loader import load_text
+from sqlite_cache import SqliteCache, process_cache
+from utils import vprint
+
+
+# Escapes, magics, shell commands, help and prompts that IPython rewrites
+IPYTHON_SYNTAX = re.compile(r"[%!?]|^[ \t]*[,;/]|^(?:>>>|\.\.\.|In \[)", re.M)
+ERRORS = {
+    "IndentationError": IndentationError,
+    "SyntaxError": SyntaxError,
+}
+
+
+def is_plain(source):
+    """Check if IPython leaves the source unchanged, except for the final newline"""
+    return bool(source) and not source[0].isspace() and not IPYTHON_SYNTAX.search(source)
+
+
+class CellTransformer(SqliteCache):
+    """IPython input transformation with a persistent cache"""
+    table = "transforms"
+    columns = ("error", "result")
+    label = "Transform cache"
+
+    def __init__(self, path=None):
+        if path is None and config.CACHE_DIR:
+            path = config.CACHE_DIR / "transform.sqlite"
+        super(CellTransformer, self).__init__(path)
+        self.version = IPython.__version__
+        self.plain = 0
+
+    def key(self, source):
+        """Return cache key of source"""
+        return "{}:{}".format(
+            self.version,
+            hashlib.sha1(source.encode("utf-8", "surrogatepass")).hexdigest()
+        )
+
+    def transform(self, source):
+        """Transform cell source as IPython does
+        Raises the IndentationError or SyntaxError of the transformation"""
+        if is_plain(source):
+            self.plain += 1
+            return source if source.endswith("\n") else source + "\n"
+        key = self.key(source)
+        row = self.lookup(key)
+        if row is not None:
+            error, result = row
+        else:
+            error = None
+            shell = InteractiveShell.instance()
+            try:
+                result = shell.input_transformer_manager.transform_cell(source)
+            except (IndentationError, SyntaxError) as err:
+                error, result = type(err).__name__, str(err)
+            self.store(key, error, result)
+        if error:
+            raise ERRORS[error](result)
+        return result
+
+    def report(self):
+        """Return cache statistics"""
+        total = self.plain + self.hits + self.misses
+        return "Cells: {}. Plain: {}. Cache hits: {}. Misses: {}".format(
+            total, self.plain, self.hits, self.misses
+        )
+
+
+def get_transformer():
+    """Return the transformer of the current process"""
+    return process_cache("transform", CellTransformer)
+
+
+def load_sources(paths):
+    """Load code cell sources of python notebooks in paths"""
+    sources = []
+    for path in paths:
+        path = config.Path(path)
+        files = path.rglob("*.ipynb") if path.is_dir() else [path]
+        for name in files:
+            try:
+                with open(str(name), "rb") as fil:
+                    notebook, _ = load_text(fil.read().decode("utf-8"))
+            except Exception as err:  # pylint: disable=broad-except
+                vprint(2, "Failed to load {}: {}".format(name, err))
+                continue
+            for cell in notebook.get("cells", []):
+                if cell.get("cell_type") == "code":
+                    source = cell.get("source") or ""
+                    sources.append(
+                        "".join(source) if isinstance(source, list) else source
+                    )
+    return sources
+
+
+def benchmark(sources, repeat):
+    """Compare IPython transformation with cached transformation"""
+    shell = InteractiveShell.instance()
+
+    def measure(function):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for source in sources:
+                try:
+                    function(source)
+                except (IndentationError, SyntaxError):
+                    pass
+        elapsed = (time.perf_counter() - start) / repeat
+        return len(sources) / elapsed if elapsed else float("inf")
+
+    mismatch = 0
+    for source in sources:
+        if is_plain(source):
+            expected = shell.input_transformer_manager.transform_cell(source)
+            if expected != (source if source.endswith("\n") else source + "\n"):
+                mismatch += 1
+                vprint(1, "Plain path mismatch: {!r}".format(source[:80]))
+    vprint(0, "Cells: {}. Plain path mismatches: {}".format(len(sources), mismatch))
+    vprint(0, "IPython: {:.0f} cells/s".format(
+        measure(shell.input_transformer_manager.transform_cell)
+    ))
+    with tempfile.TemporaryDirectory() as directory:
+        transformer = CellTransformer(config.Path(directory) / "transform.sqlite")
+        cold = measure(lambda source: transformer.transform(source))
+        transformer.flush()
+        vprint(0, "Cold cache: {:.0f} cells/s".format(cold))
+        warm = measure(lambda source: transformer.transform(source))
+        vprint(0, "Warm cache: {:.0f} cells/s".format(warm))
+        vprint(0, transformer.report())
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(
+        description="Benchmark the cached IPython input transformation")
+    parser.add_argument("-v", "--verbose", type=int, default=config.VERBOSE,
+                        help="increase output verbosity")
+    parser.add_argument("paths", nargs="+",
+                        help="notebook files or directories")
+    parser.add_argument("-n", "--repeat", type=int, default=1,
+                        help="number of repetitions")
+    args = parser.parse_args()
+    config.VERBOSE = args.verbose
+    benchmark(load_sources(args.paths), args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 #!/usr/bin/env upython
 import argparse
+import multiprocessing
 import subprocess
 import sys
 import os
@@ -19,13 +20,17 @@ def read_interval(var, default=None):
 MACHINE = os.environ.get("JUP_MACHINE", "default")
 BASE_DIR = Path(os.environ.get("JUP_BASE_DIR", "./")).expanduser()
 LOGS_DIR = Path(os.environ.get("JUP_LOGS_DIR", str(BASE_DIR / "logs"))).expanduser()
-COMPRESSION = os.environ.get("JUP_COMPRESSION", "lbzip2")
+COMPRESSION = os.environ.get("JUP_COMPRESSION", "lbzip2")  # see archives.BACKENDS
+ARCHIVE_CACHE = int(os.environ.get("JUP_ARCHIVE_CACHE", 8))
 VERBOSE = int(os.environ.get("JUP_VERBOSE", 5))
 DB_CONNECTION = os.environ.get("JUP_DB_CONNECTION", "sqlite:///db.sqlite")
 GITHUB_USERNAME = os.environ.get("JUP_GITHUB_USERNAME", "")
 GITHUB_PASSWORD = os.environ.get("JUP_GITHUB_PASSWORD", "")
 GITHUB_TOKEN = os.environ.get("JUP_GITHUB_PASSWORD", "")
+GITHUB_GRAPHQL_URL = os.environ.get("JUP_GITHUB_GRAPHQL_URL", "https://api.github.com/graphql")
+GITHUB_TIMEOUT = float(os.environ.get("JUP_GITHUB_TIMEOUT", 60))
 MAX_SIZE = float(os.environ.get("JUP_MAX_SIZE", 10.0))
+SCREEN_POLICY = os.environ.get("JUP_SCREEN_POLICY", "")  # skip, defer, sparse
 FIRST_DATE = dateutil.parser.parse(os.environ.get("JUP_FIRST_DATE", "2020-01-25"))
 EMAIL_LOGIN = os.environ.get("JUP_EMAIL_LOGIN", "")
 EMAIL_TO = os.environ.get("JUP_EMAIL_TO", "")
@@ -34,12 +39,20 @@ REPOSITORY_INTERVAL = read_interval("JUP_REPOSITORY_INTERVAL")
 NOTEBOOK_INTERVAL = read_interval("JUP_NOTEBOOK_INTERVAL")
 WITH_EXECUTION = int(os.environ.get("JUP_WITH_EXECUTION", 1))
 WITH_DEPENDENCY = int(os.environ.get("JUP_WITH_DEPENDENCY", 0))
+WITH_MANIFEST = int(os.environ.get("JUP_WITH_MANIFEST", 0))
+INGEST_ARCHIVE = int(os.environ.get("JUP_INGEST_ARCHIVE", 0))
+OBJECT_STORE = os.environ.get("JUP_OBJECT_STORE", "")
+OBJECT_STORE = Path(OBJECT_STORE).expanduser() if OBJECT_STORE else None
 EXECUTION_MODE = int(os.environ.get("JUP_EXECUTION_MODE", -1))
 EXECUTION_DIR = Path(os.environ.get("JUP_EXECUTION_DIR", str(BASE_DIR / "execution"))).expanduser()
 ANACONDA_PATH = Path(os.environ.get("JUP_ANACONDA_PATH", "~/anaconda3/")).expanduser()
 MOUNT_BASE = os.environ.get("JUP_MOUNT_BASE", "")
 UMOUNT_BASE = os.environ.get("JUP_UMOUNT_BASE", "")
 NOTEBOOK_TIMEOUT = int(os.environ.get("JUP_NOTEBOOK_TIMEOUT", 300))
+PROCESSES = int(os.environ.get("JUP_PROCESSES", multiprocessing.cpu_count()))
+CACHE_DIR = os.environ.get("JUP_CACHE_DIR", "~/.cache/archaeology")  # local disk, not BASE_DIR
+CACHE_DIR = Path(CACHE_DIR).expanduser() if CACHE_DIR else None
+BLOB_STORE = Path(os.environ.get("JUP_BLOB_STORE", str(BASE_DIR / "blobs"))).expanduser()
 
 IS_SQLITE = DB_CONNECTION.startswith("sqlite")
 
@@ -125,11 +138,15 @@ def show_config():
     print("BASE_DIR:", BASE_DIR)
     print("LOGS_DIR:", LOGS_DIR)
     print("COMPRESSION:", COMPRESSION)
+    print("ARCHIVE_CACHE:", ARCHIVE_CACHE)
     print("VERBOSE:", VERBOSE)
     print("DB_CONNECTION:", DB_CONNECTION)
     print("GITHUB_USERNAME:", GITHUB_USERNAME)
     print("GITHUB_PASSWORD:", GITHUB_PASSWORD)
+    print("GITHUB_GRAPHQL_URL:", GITHUB_GRAPHQL_URL)
+    print("GITHUB_TIMEOUT:", GITHUB_TIMEOUT)
     print("MAX_SIZE:", MAX_SIZE)
+    print("SCREEN_POLICY:", SCREEN_POLICY)
     print("FIRST_DATE:", FIRST_DATE)
     print("EMAIL_LOGIN:", EMAIL_LOGIN)
     print("EMAIL_TO:", EMAIL_TO)
@@ -138,12 +155,18 @@ def show_config():
     print("NOTEBOOK_INTERVAL", NOTEBOOK_INTERVAL)
     print("WITH_EXECUTION", WITH_EXECUTION)
     print("WITH_DEPENDENCY", WITH_DEPENDENCY)
+    print("WITH_MANIFEST", WITH_MANIFEST)
+    print("INGEST_ARCHIVE", INGEST_ARCHIVE)
+    print("OBJECT_STORE", OBJECT_STORE)
     print("EXECUTION_MODE", EXECUTION_MODE)
     print("EXECUTION_DIR", EXECUTION_DIR)
     print("ANACONDA_PATH", ANACONDA_PATH)
     print("MOUNT_BASE", MOUNT_BASE)
     print("UMOUNT_BASE", UMOUNT_BASE)
     print("NOTEBOOK_TIMEOUT", NOTEBOOK_TIMEOUT)
+    print("PROCESSES", PROCESSES)
+    print("CACHE_DIR", CACHE_DIR)
+    print("BLOB_STORE", BLOB_STORE)
     print("\nVERSIONS:")
     for major, minors in VERSIONS.items():
         for minor, patches in minors.items():
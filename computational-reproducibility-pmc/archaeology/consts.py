@@ -14,6 +14,9 @@ R_FAILED_TO_CLONE = 1024             # 2 ** 10
 
 R_TROUBLESOME = 4096                 # 2 ** 12
 R_EXTRACTED_FILES = 8192             # 2 ** 13
+R_SCREEN_SKIPPED = 16384             # 2 ** 14
+R_SCREEN_DEFERRED = 32768            # 2 ** 15
+R_SPARSE_CLONE = 65536               # 2 ** 16
 
 R_STATUSES = {
     R_OK: "load - ok",
@@ -28,6 +31,9 @@ R_STATUSES = {
     R_FAILED_TO_CLONE: "clone - fail",
     R_TROUBLESOME: "troublesome",
     R_EXTRACTED_FILES: "extracted files",
+    R_SCREEN_SKIPPED: "screen - skipped",
+    R_SCREEN_DEFERRED: "screen - deferred",
+    R_SPARSE_CLONE: "sparse clone",
 }
 
 
@@ -1,9 +1,11 @@
 """Handles database model and connection"""
 import sys
 import subprocess
+import tarfile
 from contextlib import contextmanager
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, Integer, String, Boolean, DateTime, Interval
 from sqlalchemy import Float
@@ -11,7 +13,8 @@ from sqlalchemy.orm import sessionmaker, scoped_session, relationship
 from sqlalchemy import ForeignKeyConstraint
 
 import config
-from utils import version_string_to_list, ext_split
+from utils import version_string_to_list, ext_split, git_head
+import archives
 
 if not config.IS_SQLITE:
     from sqlalchemy.dialects.postgresql import BIGINT as BigInt
@@ -90,6 +93,7 @@ class Repository(Base):
     pipfile_locks_count = Column(Integer)
     pipfiles = Column(String)
     pipfile_locks = Column(String)
+    compression = Column(String)
 
 
     article_obj = many_to_one("Article", "repository_objs")
@@ -119,46 +123,88 @@ class Repository(Base):
 
     @property
     def zip_path(self):
-        """Return notebook path"""
-        return config.Path(str(self.path) + ".tar.bz2")
-
-    def compress(self, target=None, return_cmd=False):
-        """Compress repository"""
+        """Return archive path
+        The backend in compression selects the format. Otherwise, existing
+        archives take precedence over config.COMPRESSION. The archive found
+        by probing is kept on the instance"""
+        path = self.path
+        if self.compression:
+            suffix = archives.get_backend(self.compression).suffix
+            return archives.archive_path(path, suffix)
+        found = getattr(self, "_found_archive", None)
+        if found is not None and found[0] == str(path):
+            return found[1]
+        result = archives.archive_path(path)
+        if result.exists():
+            self._found_archive = (str(path), result)
+        return result
+
+    def open_archive(self):
+        """Open archive backend"""
+        return archives.open_archive(self.zip_path)
+
+    def compress(self, target=None, return_cmd=False, backend=None, manifest=None):
+        """Compress repository and record the backend in compression
+        backend defaults to config.COMPRESSION or to the backend of the target.
+        If manifest is a list, the archive is written in-process and its
+        RepositoryFile entries (see archives.manifest_entries) are appended"""
         if not self.path.exists():
             return False
+        backend = archives.get_backend(backend)
         if target is None:
-            target = self.zip_path
-        elif isinstance(target, str):
-            target = config.Path(target)
-        cmd = [
-            "tar", "-cf", str(target),
-            "--use-compress-program={}".format(config.COMPRESSION),
-            "-C", str(target.parent), str(self.hash_dir2)
-        ]
+            target = archives.archive_path(self.path, backend.suffix)
+        else:
+            target = config.Path(str(target))
+            if backend.suffix != archives.archive_format(target):
+                backend = archives.backend_for(target)
+        if backend.compressor:
+            cmd = [
+                "tar", "-cf", str(target),
+                "--use-compress-program={}".format(" ".join(backend.compressor)),
+                "-C", str(target.parent), str(self.hash_dir2)
+            ]
+        else:
+            cmd = archives.command("compress", self.path, target, "-b", backend.name)
         if return_cmd:
             return cmd
-        return subprocess.call(cmd) == 0
+        if manifest is not None:
+            members = []
+            try:
+                archives.compress(self.path, target, backend, members)
+            except (EnvironmentError, tarfile.TarError, ValueError):
+                return False
+            manifest.extend(archives.manifest_entries(members, self.hash_dir2))
+        elif subprocess.call(cmd) != 0:
+            return False
+        self.compression = backend.name
+        return True
 
-    def uncompress(self, target=None, return_cmd=False):
-        """Uncompress repository"""
-        if not self.zip_path.exists():
+    def uncompress(self, target=None, return_cmd=False, copy=False):
+        """Uncompress repository
+        Extraction runs in archives, which decompresses bz2 blocks in parallel.
+        Blob manifests become hard links to the blob store unless copy is set"""
+        zip_path = self.zip_path
+        if not zip_path.exists():
             return False
-        target = target or self.zip_path.parent
-        cmd = [
-            "tar", "-xjf", str(self.zip_path),
-            "-C", str(target)
-        ]
+        target = target or zip_path.parent
+        cmd = archives.command("extract", zip_path, target)
+        if copy:
+            cmd.append("--copy")
         if return_cmd:
             return cmd
         return subprocess.call(cmd) == 0
 
     def get_commit(self, cwd=None):
-        """Get commit from uncompressed repository"""
+        """Get commit from uncompressed repository
+        Reads .git files and only runs git when they do not resolve HEAD"""
         cwd = cwd or self.path
         if isinstance(cwd, str):
             cwd = config.Path(cwd)
         if not cwd.exists():
             return None
+        commit = git_head(cwd)
+        if commit is not None:
+            return commit
         try:
             return subprocess.check_output([
                 "git", "rev-parse", "HEAD"
@@ -1003,6 +1049,20 @@ class RepositoryFile(Base):
         ).format(self)
 
 
+def save_manifest(session, repository, manifest):
+    """Bulk insert (path, size, had_surrogates) entries as RepositoryFile rows
+    Entries come from archives.manifest_entries or utils.scan_files"""
+    session.bulk_insert_mappings(RepositoryFile, [
+        {
+            "repository_id": repository.id,
+            "path": path,
+            "size": size,
+            "had_surrogates": had_surrogates,
+        }
+        for path, size, had_surrogates in manifest
+    ])
+
+
 class NotebookMarkdown(Base):
     """Notebook Markdown Features Table"""
     # pylint: disable=too-few-public-methods, invalid-name
@@ -1911,14 +1971,40 @@ class ArticleMesh(Base):
 
 
 
+# Columns added to existing tables: create_all only creates missing tables
+ADDED_COLUMNS = [
+    ("repositories", "compression", "VARCHAR"),
+]
+
+
+def add_columns(engine):
+    """Add the ADDED_COLUMNS that existing tables lack"""
+    for table, column, sqltype in ADDED_COLUMNS:
+        names = [col["name"] for col in inspect(engine).get_columns(table)]
+        if column in names:
+            continue
+        try:
+            with engine.begin() as connection:
+                connection.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(
+                    table, column, sqltype
+                )))
+        except SQLAlchemyError:
+            # Another stage may have added it concurrently
+            names = [col["name"] for col in inspect(engine).get_columns(table)]
+            if column not in names:
+                raise
+
+
 @contextmanager
 def connect(echo=False, config=config):
-    """Creates a context with an open SQLAlchemy session."""
+    """Creates a context with an open SQLAlchemy session.
+    Creates missing tables and adds the ADDED_COLUMNS of existing ones"""
     engine = create_engine(
         config.DB_CONNECTION,
         echo=echo
     )
     Base.metadata.create_all(engine)
+    add_columns(engine)
     connection = engine.connect()
     db_session = scoped_session(
         sessionmaker(autocommit=False, autoflush=True, bind=engine)
@@ -21,9 +21,13 @@ def clone_repository(session, repository, skip_if_error=consts.R_FAILED_TO_CLONE
         if not repository.path.exists() and not repository.zip_path.exists() and not dry_run:
             load_repository(
                 session, repository.domain, repository.repository,
-                commit=repository.commit, clone_existing=True
+                repository.article_id,
+                commit=repository.commit, clone_existing=True, screen=""
             )
 
+        if repository.processed & consts.R_SCREEN_DEFERRED and repository.path.exists():
+            repository.processed -= consts.R_SCREEN_DEFERRED
+
         if repository.path.exists() or repository.zip_path.exists():
             if repository.processed & consts.R_UNAVAILABLE_FILES:
                 repository.processed -= consts.R_UNAVAILABLE_FILES
@@ -40,13 +44,15 @@ def clone_repository(session, repository, skip_if_error=consts.R_FAILED_TO_CLONE
 
 
 def apply(
-    session, status, skip_if_error, dry_run, list_repo,
+    session, status, skip_if_error, dry_run, list_repo, deferred,
     count, interval, reverse, check
 ):
     """Clone removed files"""
     filters = [
         Repository.processed.op("&")(consts.R_UNAVAILABLE_FILES) != 0, # files unavailable
         Repository.processed.op("&")(skip_if_error) == 0,
+        Repository.processed.op("&")(consts.R_SCREEN_SKIPPED) == 0,
+        Repository.processed.op("&")(consts.R_SCREEN_DEFERRED) == deferred,
     ]
     if interval:
         filters += [
@@ -105,6 +111,8 @@ def main():
                         help="discover repositories but do not clone")
     parser.add_argument("-l", "--list", action='store_true',
                         help="list repositories but do not clone nor discover")
+    parser.add_argument("-q", "--deferred", action='store_true',
+                        help="clone the low-priority queue of deferred repositories")
     parser.add_argument('-r', '--reverse', action='store_true',
                         help='iterate in reverse order')
     parser.add_argument('--check', type=str, nargs='*',
@@ -124,6 +132,7 @@ def main():
             0 if args.retry_errors else consts.R_FAILED_TO_CLONE,
             args.dry_run,
             args.list,
+            consts.R_SCREEN_DEFERRED if args.deferred else 0,
             args.count,
             args.interval,
             args.reverse,
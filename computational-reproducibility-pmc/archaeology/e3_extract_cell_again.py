@@ -2,14 +2,12 @@
 import argparse
 import os
 import sys
-import tarfile
 
 
 import config
 import consts
 
 import nbformat as nbf
-from IPython.core.interactiveshell import InteractiveShell
 
 from itertools import groupby
 
@@ -17,23 +15,20 @@ from itertools import groupby
 from db import Cell, Notebook, Repository, Execution, connect
 from utils import vprint, StatusLogger
 from utils import mount_basedir, check_exit, savepid
-from config import Path
+from cell_transform import get_transformer
+from repository_content import repository_content
 
 
 def process_repository(session, status, repository, query_iter):
     query_iter = list(query_iter)
-    zip_path = None
-    tarzip = None
-    if not repository.path.exists():
-        if not repository.zip_path.exists():
-            repository.processed |= consts.R_UNAVAILABLE_FILES
-            session.add(repository)
-            status.count += len(query_iter)
-            return "Failed. Repository not found: {}".format(repository)
-        tarzip =  tarfile.open(str(repository.zip_path))
-        zip_path = Path(repository.hash_dir2)
-
-    shell = InteractiveShell.instance()
+    content = repository_content(session, repository, ("directory", "archive"))
+    if content is None:
+        repository.processed |= consts.R_UNAVAILABLE_FILES
+        session.add(repository)
+        status.count += len(query_iter)
+        return "Failed. Repository not found: {}".format(repository)
+
+    transformer = get_transformer()
     group = groupby(
         query_iter,
         lambda x: (x[1])
@@ -43,14 +38,7 @@ def process_repository(session, status, repository, query_iter):
         vprint(1, "Processing notebook: {}. Found {} cells".format(notebook, len(cells)))
         name = notebook.name
         vprint(2, "Loading notebook file")
-        if tarzip:
-            notebook = nbf.read(
-                tarzip.extractfile(tarzip.getmember(str(zip_path / name))),
-                nbf.NO_CONVERT
-            )
-        else:
-            with open(str(repository.path / name)) as ofile:
-                notebook = nbf.read(ofile, nbf.NO_CONVERT)
+        notebook = nbf.reads(content.read(name).decode("utf-8"), nbf.NO_CONVERT)
         notebook = nbf.convert(notebook, 4)
         metadata = notebook["metadata"]
         language_info = metadata.get("language_info", {})
@@ -64,13 +52,14 @@ def process_repository(session, status, repository, query_iter):
             source = notebook_cell.get("source", "")
             if language_name == "python" and notebook_cell.get("cell_type") == "code":
                 try:
-                    source = shell.input_transformer_manager.transform_cell(source)
+                    source = transformer.transform(source)
                 except (IndentationError, SyntaxError):
                     pass
             cell.source = source
             if cell.processed & consts.C_MARKED_FOR_EXTRACTION:
                 cell.processed -= consts.C_MARKED_FOR_EXTRACTION
             session.add(cell)
+        transformer.flush()
         session.commit()
     return "ok"
 
@@ -22,10 +22,8 @@ def unzip_repository(session, repository):
             repository.processed |= consts.R_UNAVAILABLE_FILES
             session.add(repository)
             return "Failed to load notebooks due <repository not found>"
-        uncompressed = subprocess.call([
-            "tar", "-xjf", str(repository.zip_path),
-            "-C", str(repository.zip_path.parent)
-        ])
+        # Copies: trees in content are modified, blobs are shared
+        uncompressed = subprocess.call(repository.uncompress(return_cmd=True, copy=True))
         if uncompressed != 0:
             return "Extraction failed with code {}".format(uncompressed)
     if repository.processed & consts.R_COMPRESS_OK:
@@ -0,0 +1,61 @@
+"""Persistent cache of repository-independent cell features
+Results are stored as JSON in a sqlite_cache keyed by the extractor, its
+version, the Python version and the hash of the source. Forks and copied
+notebooks repeat cells, so their features are extracted only once.
+"""
+import hashlib
+import json
+import sys
+
+import config
+from sqlite_cache import SqliteCache, process_cache
+
+
+class FeatureCache(SqliteCache):
+    """Feature cache of an extractor version"""
+    table = "features"
+    columns = ("result",)
+    label = "Feature cache"
+
+    def __init__(self, extractor, version, path=None, flush_size=500):
+        if path is None and config.CACHE_DIR:
+            path = config.CACHE_DIR / "features.sqlite"
+        super(FeatureCache, self).__init__(path, flush_size)
+        self.prefix = "{}:{}:py{}.{}".format(extractor, version, *sys.version_info[:2])
+
+    def key(self, source, qualifier=""):
+        """Return cache key of source
+        The qualifier holds other inputs of the extractor"""
+        if not isinstance(source, bytes):
+            source = source.encode("utf-8", "surrogatepass")
+        return "{}:{}:{}".format(
+            self.prefix, qualifier, hashlib.sha1(source).hexdigest()
+        )
+
+    def get(self, source, qualifier=""):
+        """Return the cached result of source or None"""
+        row = self.lookup(self.key(source, qualifier))
+        return None if row is None else json.loads(row[0])
+
+    def put(self, source, result, qualifier=""):
+        """Add result of source"""
+        self.store(self.key(source, qualifier), json.dumps(result))
+
+    def report(self):
+        """Return cache statistics"""
+        return hit_rate(self.hits, self.misses)
+
+
+def hit_rate(hits, misses):
+    """Return hit rate message"""
+    total = hits + misses
+    return "Feature cache hits: {} of {} ({:.1f}%)".format(
+        hits, total, 100.0 * hits / total if total else 0.0
+    )
+
+
+def get_cache(extractor, version):
+    """Return the feature cache of the current process"""
+    return process_cache(
+        ("features", extractor, version), lambda: FeatureCache(extractor, version)
+    )
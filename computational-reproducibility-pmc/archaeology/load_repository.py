@@ -4,6 +4,9 @@ import hashlib
 import subprocess
 import shutil
 import os
+import tarfile
+import tempfile
+from contextlib import contextmanager
 from github import Github, GithubException
 
 import requests
@@ -11,11 +14,25 @@ import requests
 from future.moves.urllib.parse import urlparse
 
 
+import archives
 import consts
 import config
-from db import Repository, connect
-from utils import find_files, vprint, join_paths, find_files_in_path
+from db import Repository, connect, save_manifest
+from utils import vprint, join_paths, scan_files, pattern_matcher
+from utils import ignore_surrogates, replace_surrogates
 from utils import mount_basedir, savepid
+import object_store
+
+
+PATTERNS = [
+    "*.ipynb", "setup.py", "requirements.txt", "Pipfile", "Pipfile.lock"
+]
+
+SCREEN_POLICIES = {
+    "skip": consts.R_SCREEN_SKIPPED,
+    "defer": consts.R_SCREEN_DEFERRED | consts.R_UNAVAILABLE_FILES,
+    "sparse": consts.R_SPARSE_CLONE,
+}
 
 
 def extract_domain_repository(url):
@@ -84,8 +101,14 @@ def git_output(*args, cwd=None):
     return subprocess.check_output(["git"] + list(args), cwd=cwd)
 
 
-def clone(part, end, repo, remote, branch=None, commit=None):
-    """Clone git repository into a proper directory"""
+def clone(part, end, repo, remote, branch=None, commit=None, domain="github.com",
+          sparse=False):
+    """Clone git repository into a proper directory
+    With a shared object store, the clone borrows objects from the store
+    of its fork network and moves its remaining objects into it.
+    Other clones of commit-less repositories are shallow unless they are forks.
+    A sparse clone only checks out notebooks and dependency files
+    """
     part_dir = config.BASE_DIR / "content" / part
     part_dir.mkdir(parents=True, exist_ok=True)
     full_dir = part_dir / end
@@ -95,8 +118,13 @@ def clone(part, end, repo, remote, branch=None, commit=None):
         shutil.rmtree(str(full_dir), ignore_errors=True)
     if not full_dir.exists():
         args = ["clone"]
-        if commit is None:
+        reference = object_store.find_reference(domain, repo)
+        if reference is not None:
+            args += ["--reference-if-able", str(reference)]
+        elif commit is None and not object_store.full_history(domain, repo):
             args += ["--depth", "1"]
+        if sparse:
+            args += ["--filter=blob:none", "--sparse"]
         args += [remote, str(full_dir)]
         if branch is not None:
             args.append("-b")
@@ -113,11 +141,189 @@ def clone(part, end, repo, remote, branch=None, commit=None):
                 raise EnvironmentError("Checkout failed for {}/{}".format(
                     repo, commit
                 ))
+        if sparse:
+            git("-C", str(full_dir), "sparse-checkout", "set", "--no-cone", *PATTERNS)
+        object_store.attach(full_dir, domain, repo)
     return full_dir
 
 
+def resolve_commit(remote, branch=None):
+    """Resolve the commit of a remote branch (or HEAD) without cloning"""
+    ref = "refs/heads/{}".format(branch) if branch else "HEAD"
+    output = git_output("ls-remote", remote, ref).decode("utf-8").split()
+    if not output:
+        raise EnvironmentError("Failed to resolve {} of {}".format(ref, remote))
+    return output[0]
+
+
+@contextmanager
+def archive_source(domain, repo, remote, commit):
+    """Yield a streaming tarfile of the repository at commit
+    Github repositories are streamed from codeload. Other remotes are
+    archived from a temporary blobless bare clone.
+    Every member is under a single top-level directory.
+    """
+    if domain == "github.com":
+        url = "https://codeload.github.com/{}/tar.gz/{}".format(repo, commit)
+        response = requests.get(url, stream=True)
+        if response.status_code != 200:
+            raise EnvironmentError("Download failed for {} ({})".format(
+                url, response.status_code
+            ))
+        try:
+            with tarfile.open(fileobj=response.raw, mode="r|gz") as source:
+                yield source
+        finally:
+            response.close()
+        return
+    temp_dir = tempfile.mkdtemp(prefix="blobless-")
+    try:
+        git("clone", "--quiet", "--bare", "--filter=blob:none", remote, temp_dir)
+        process = subprocess.Popen(
+            ["git", "archive", "--format=tar", "--prefix=archive/", commit],
+            cwd=temp_dir, stdout=subprocess.PIPE
+        )
+        try:
+            with tarfile.open(fileobj=process.stdout, mode="r|") as source:
+                yield source
+        finally:
+            process.stdout.close()
+            if process.wait() != 0:
+                raise EnvironmentError("Archive failed for {}/{}".format(
+                    repo, commit
+                ))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def ingest_archive(part, end, domain, repo, remote, commit, patterns=PATTERNS, backend=None):
+    """Stream repository at commit into its compressed archive
+    Nothing is written uncompressed to disk. Files are classified by
+    patterns and the manifest is built while the archive is written.
+    Surrogates are replaced in every name and link target, so the paths
+    found, the manifest and the archive agree.
+    backend must compress tar streams. It defaults to archives.tar_backend().
+    Returns the relative paths for each pattern and the manifest
+    """
+    backend = backend or archives.tar_backend()
+    part_dir = config.BASE_DIR / "content" / part
+    part_dir.mkdir(parents=True, exist_ok=True)
+    target = archives.archive_path(part_dir / end, backend.suffix)
+    partial = config.Path(str(target) + ".partial")
+    match = pattern_matcher(patterns)
+    found = [[] for _ in patterns]
+    manifest = [("", 0, False)]
+    try:
+        with open(str(partial), "wb") as zfile, \
+                archives.compressed_writer(zfile, backend) as stream:
+            with archive_source(domain, repo, remote, commit) as source, \
+                    tarfile.open(fileobj=stream, mode="w|") as out:
+                root = tarfile.TarInfo(end)
+                root.type = tarfile.DIRTYPE
+                root.mode = 0o755
+                out.addfile(root)
+                for member in source:
+                    _, _, name = member.name.partition("/")
+                    if not name:
+                        continue
+                    name = replace_surrogates(name)
+                    indexes = []
+                    if member.isfile():
+                        indexes = match(name.rsplit("/", 1)[-1])
+                    for index in indexes:
+                        found[index].append(config.Path(name))
+                    clean_name, had_surrogates = ignore_surrogates(name)
+                    manifest.append((clean_name, member.size, had_surrogates))
+                    fileobj = source.extractfile(member) if member.isfile() else None
+                    member.name = "{}/{}".format(end, name)
+                    if member.issym():
+                        member.linkname = replace_surrogates(member.linkname)
+                    out.addfile(member, fileobj)
+        partial.rename(target)
+    finally:
+        if partial.exists():
+            partial.unlink()
+    return found, manifest
+
+
+def restore_archive(session, repository, remote):
+    """Ingest the missing archive of a registered repository at its commit"""
+    vprint(1, "Restoring archive of commit {}".format(repository.commit))
+    backend = archives.tar_backend()
+    _, manifest = ingest_archive(
+        repository.hash_dir1, repository.hash_dir2, repository.domain,
+        repository.repository, remote, repository.commit, backend=backend
+    )
+    repository.compression = backend.name
+    repository.processed |= consts.R_COMPRESS_OK
+    if repository.processed & consts.R_COMPRESS_ERROR:
+        repository.processed -= consts.R_COMPRESS_ERROR
+    if not repository.processed & consts.R_EXTRACTED_FILES:
+        save_manifest(session, repository, manifest)
+        repository.processed |= consts.R_EXTRACTED_FILES
+    session.add(repository)
+    session.commit()
+
+
+def list_remote_tree(domain, repo, remote, branch=None):
+    """List file paths of the default commit without cloning
+    Returns the paths and the repository size in GB (None if unknown)
+    """
+    size = None
+    if domain == "github.com":
+        try:
+            repository = Github(config.GITHUB_TOKEN).get_repo(repo)
+            size = repository.size / 1024 / 1024
+            tree = repository.get_git_tree(
+                branch or repository.default_branch, recursive=True
+            )
+            if not tree.raw_data.get("truncated"):
+                return [entry.path for entry in tree.tree if entry.type == "blob"], size
+            vprint(2, "Truncated tree listing. Using blobless fetch")
+        except GithubException as err:
+            vprint(2, "Failed to list tree of {}: {}".format(repo, err))
+    temp_dir = tempfile.mkdtemp(prefix="screen-")
+    try:
+        args = ["clone", "--quiet", "--bare", "--depth", "1", "--filter=blob:none"]
+        if branch is not None:
+            args += ["-b", branch]
+        git(*(args + [remote, temp_dir]))
+        paths = git_output(
+            "ls-tree", "-r", "-z", "--name-only", "HEAD", cwd=temp_dir
+        ).decode("utf-8", "surrogateescape").split("\0")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return [path for path in paths if path], size
+
+
+def skip_checkpoints(notebooks):
+    """Remove notebooks in .ipynb_checkpoints
+    Requirement files in checkpoints are kept"""
+    return [name for name in notebooks if ".ipynb_checkpoints" not in str(name)]
+
+
+def screen_repository(domain, repo, remote, branch=None):
+    """Check notebooks and size of a repository before cloning
+    Returns the failure reason (None if it passes) and the paths found for
+    each pattern
+    """
+    paths, size = list_remote_tree(domain, repo, remote, branch)
+    match = pattern_matcher(PATTERNS)
+    found = [[] for _ in PATTERNS]
+    for path in paths:
+        for index in match(path.rsplit("/", 1)[-1]):
+            found[index].append(config.Path(replace_surrogates(path)))
+    found[0] = skip_checkpoints(found[0])
+    if not found[0]:
+        return "no notebooks", found
+    if size is not None and size > config.MAX_SIZE:
+        return "size {:.2f} GB > {} GB".format(size, config.MAX_SIZE), found
+    return None, found
+
+
 def load_repository_from_url(session, url, article_id, branch=None,
-                             commit=None, clone_existing=False):
+                             commit=None, clone_existing=False,
+                             with_manifest=None, archive=None, screen=None):
     """Clone repository and extract its information from URL"""
     domain, repo = extract_domain_repository(url)
     remote = get_remote(domain, repo)
@@ -126,7 +332,8 @@ def load_repository_from_url(session, url, article_id, branch=None,
             vprint(0, "url: {}, branch: {}, commit:{}, clone_existing: {}".format(url, branch, commit, clone_existing))
             return load_repository(
                 session, domain, repo, article_id,
-                branch=branch, commit=commit, clone_existing=clone_existing)
+                branch=branch, commit=commit, clone_existing=clone_existing,
+                with_manifest=with_manifest, archive=archive, screen=screen)
         else:
             vprint(0, "Repository is empty: {}".format(url))
     else:
@@ -134,8 +341,19 @@ def load_repository_from_url(session, url, article_id, branch=None,
 
 
 def load_repository(session, domain, repo, article_id, check_repo_only=True, branch=None,
-                    commit=None, clone_existing=False):
-    """Clone repository and extract its information"""
+                    commit=None, clone_existing=False, with_manifest=None,
+                    archive=None, screen=None):
+    """Clone repository and extract its information
+    With archive, stream the repository into its compressed archive instead.
+    With a screen policy, repositories without notebooks or larger than
+    MAX_SIZE are skipped, deferred, or sparsely cloned
+    """
+    if with_manifest is None:
+        with_manifest = config.WITH_MANIFEST
+    if archive is None:
+        archive = config.INGEST_ARCHIVE
+    if screen is None:
+        screen = config.SCREEN_POLICY
     vprint(0, "Processing repository: {}".format(repo))
     if check_repo_only:
         repository = session.query(Repository).filter(
@@ -149,11 +367,27 @@ def load_repository(session, domain, repo, article_id, check_repo_only=True, bra
     part, end = extract_hash_parts(repo)
     remote = get_remote(domain, repo)
     vprint(1, "Remote: {}".format(remote))
-    full_dir = clone(part, end, repo, remote, branch, commit)
+    processed = consts.R_OK
+    found = None
+    if screen and commit is None:
+        reason, screened = screen_repository(domain, repo, remote, branch)
+        if reason is not None:
+            vprint(1, "Screening failed ({}). Policy: {}".format(reason, screen))
+            processed |= SCREEN_POLICIES[screen]
+            if screen != "sparse":
+                found = screened
+                commit = resolve_commit(remote, branch)
+    if found is None and archive:
+        commit = commit or resolve_commit(remote, branch)
+    elif found is None:
+        full_dir = clone(
+            part, end, repo, remote, branch, commit, domain,
+            sparse=bool(processed & consts.R_SPARSE_CLONE)
+        )
 
-    commit = git_output(
-        "rev-parse", "HEAD", cwd=str(full_dir)
-    ).decode("utf-8").strip()
+        commit = git_output(
+            "rev-parse", "HEAD", cwd=str(full_dir)
+        ).decode("utf-8").strip()
 
     repository = session.query(Repository).filter(
         Repository.domain == domain,
@@ -163,22 +397,32 @@ def load_repository(session, domain, repo, article_id, check_repo_only=True, bra
     if repository is not None:
         if not check_repo_only:
             vprint(1, "Repository exists: ID={}".format(repository.id))
+        if (archive and found is None and not repository.path.exists()
+                and not repository.zip_path.exists()):
+            restore_archive(session, repository, remote)
         # vprint(1, "> Removing .git directory")
         # shutil.rmtree(str(repository.path / ".git"), ignore_errors=True)
         return repository
 
-    vprint(1, "Finding files")
-    notebooks = [
-        file.relative_to(full_dir)
-        for file in find_files(full_dir, "*.ipynb")
-        if ".ipynb_checkpoints" not in str(file)
-    ]
-
-    setups, requirements, pipfiles, pipfile_locks = find_files_in_path(
-        full_dir, [
-            "setup.py", "requirements.txt", "Pipfile", "Pipfile.lock"
-        ]
-    )
+    manifest = None
+    compression = None
+    if found is not None:
+        vprint(1, "Registering without cloning")
+    elif archive:
+        vprint(1, "Archiving commit {}".format(commit))
+        backend = archives.tar_backend()
+        found, manifest = ingest_archive(
+            part, end, domain, repo, remote, commit, backend=backend
+        )
+        compression = backend.name
+        processed |= consts.R_COMPRESS_OK
+    else:
+        vprint(1, "Finding files")
+        found, manifest = scan_files(full_dir, PATTERNS, manifest=with_manifest)
+    notebooks, setups, requirements, pipfiles, pipfile_locks = found
+    notebooks = skip_checkpoints(notebooks)
+    if manifest is not None:
+        processed |= consts.R_EXTRACTED_FILES
 
     repository = Repository(
         domain=domain, repository=repo,
@@ -197,11 +441,16 @@ def load_repository(session, domain, repo, article_id, check_repo_only=True, bra
         pipfiles=join_paths(pipfiles),
         pipfile_locks=join_paths(pipfile_locks),
 
-        processed=consts.R_OK,
+        processed=processed,
+        compression=compression,
         article_id=article_id,
     )
     session.add(repository)
     session.commit()
+    if manifest is not None:
+        vprint(1, "Saving {} files".format(len(manifest)))
+        save_manifest(session, repository, manifest)
+        session.commit()
     # vprint("Removing .git directory")
     # shutil.rmtree(str(repository.path / ".git"), ignore_errors=True)
     vprint(1, "Done. ID={}".format(repository.id))
@@ -222,12 +471,23 @@ def main():
                         help="specific commit")
     parser.add_argument("-e", "--clone-existing", action='store_true',
                         help="clone even if repository exists")
+    parser.add_argument("-m", "--manifest", action='store_true',
+                        default=bool(config.WITH_MANIFEST),
+                        help="store the repository file manifest")
+    parser.add_argument("-a", "--archive", action='store_true',
+                        default=bool(config.INGEST_ARCHIVE),
+                        help="stream repository into its archive instead of cloning")
+    parser.add_argument("-s", "--screen", type=str, default=config.SCREEN_POLICY,
+                        choices=["", "skip", "defer", "sparse"],
+                        help="policy for repositories without notebooks or too large")
 
     args = parser.parse_args()
     config.VERBOSE = args.verbose
     with connect() as session, mount_basedir(), savepid():
         load_repository_from_url(
-            session, args.url, args.branch, args.commit, args.clone_existing
+            session, args.url, None, args.branch, args.commit,
+            args.clone_existing, with_manifest=args.manifest,
+            archive=args.archive, screen=args.screen
         )
 
 
@@ -0,0 +1,262 @@
+"""Fast notebook loader
+Scans the notebook JSON and keeps only the fields that s1 uses: format
+version, metadata, cell types, sources, execution counts and the names of
+output mime types. Output payloads (images, html, text streams) are
+skipped without being decoded. Notebooks older than v4 or that the scanner
+cannot read return None, so callers can fall back to nbformat.
+"""
+import argparse
+import base64
+import json
+import os
+import re
+import time
+
+import nbformat as nbf
+
+import config
+from utils import vprint
+
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+STRUCTURE = re.compile(r'["\[\]{}]')
+SCALAR = re.compile(r"[^,\]}\s]*")
+DECODER = json.JSONDecoder()
+scanstring = json.decoder.scanstring  # pylint: disable=invalid-name
+
+
+def skip_string(text, pos):
+    """Return the position after the string that starts at pos"""
+    end = pos + 1
+    while True:
+        end = text.find('"', end)
+        if end == -1:
+            raise ValueError("Unterminated string at {}".format(pos))
+        backslash = end - 1
+        while text[backslash] == "\\":
+            backslash -= 1
+        if (end - 1 - backslash) % 2 == 0:
+            return end + 1
+        end += 1
+
+
+def skip_value(text, pos):
+    """Return the position after the value that starts at pos"""
+    char = text[pos]
+    if char == '"':
+        return skip_string(text, pos)
+    if char not in "[{":
+        return SCALAR.match(text, pos).end()
+    depth = 0
+    while True:
+        match = STRUCTURE.search(text, pos)
+        if match is None:
+            raise ValueError("Unterminated value")
+        pos = match.start()
+        char = text[pos]
+        if char == '"':
+            pos = skip_string(text, pos)
+            continue
+        depth += 1 if char in "[{" else -1
+        pos += 1
+        if depth == 0:
+            return pos
+
+
+def parse_value(text, pos):
+    """Decode the value that starts at pos"""
+    try:
+        return DECODER.scan_once(text, pos)
+    except StopIteration:
+        raise ValueError("Invalid value at {}".format(pos))
+
+
+def parse_keys(text, pos):
+    """Return the keys of the object at pos mapped to None"""
+    return parse_object(text, pos, None)
+
+
+def parse_object(text, pos, fields):
+    """Decode the object at pos, keeping only keys in fields
+    fields maps keys to parsers. When fields is None, keep every key
+    with a None value"""
+    if text[pos] != "{":
+        raise ValueError("Expected object at {}".format(pos))
+    result = {}
+    pos = WHITESPACE.match(text, pos + 1).end()
+    if text[pos] == "}":
+        return result, pos + 1
+    while True:
+        if text[pos] != '"':
+            raise ValueError("Expected key at {}".format(pos))
+        key, pos = scanstring(text, pos + 1)
+        pos = WHITESPACE.match(text, pos).end()
+        if text[pos] != ":":
+            raise ValueError("Expected ':' at {}".format(pos))
+        pos = WHITESPACE.match(text, pos + 1).end()
+        parser = fields.get(key) if fields is not None else None
+        if parser is not None:
+            result[key], pos = parser(text, pos)
+        else:
+            if fields is None:
+                result[key] = None
+            pos = skip_value(text, pos)
+        pos = WHITESPACE.match(text, pos).end()
+        if text[pos] == ",":
+            pos = WHITESPACE.match(text, pos + 1).end()
+        elif text[pos] == "}":
+            return result, pos + 1
+        else:
+            raise ValueError("Expected ',' or '}}' at {}".format(pos))
+
+
+def array_of(parser):
+    """Return a parser for arrays of items"""
+    def parse_array(text, pos):
+        if text[pos] != "[":
+            raise ValueError("Expected array at {}".format(pos))
+        result = []
+        pos = WHITESPACE.match(text, pos + 1).end()
+        if text[pos] == "]":
+            return result, pos + 1
+        while True:
+            item, pos = parser(text, pos)
+            result.append(item)
+            pos = WHITESPACE.match(text, pos).end()
+            if text[pos] == ",":
+                pos = WHITESPACE.match(text, pos + 1).end()
+            elif text[pos] == "]":
+                return result, pos + 1
+            else:
+                raise ValueError("Expected ',' or ']' at {}".format(pos))
+    return parse_array
+
+
+def object_of(fields):
+    """Return a parser for objects with fields"""
+    return lambda text, pos: parse_object(text, pos, fields)
+
+
+def parse_source(text, pos):
+    """Decode multiline string as nbformat does"""
+    value, pos = parse_value(text, pos)
+    if isinstance(value, list):
+        value = "".join(value)
+    return value, pos
+
+
+OUTPUT_FIELDS = {
+    "output_type": parse_value,
+    "data": parse_keys,
+}
+
+CELL_FIELDS = {
+    "cell_type": parse_value,
+    "execution_count": parse_value,
+    "source": parse_source,
+    "outputs": array_of(object_of(OUTPUT_FIELDS)),
+}
+
+NOTEBOOK_FIELDS = {
+    "nbformat": parse_value,
+    "nbformat_minor": parse_value,
+    "metadata": parse_value,
+    "cells": array_of(object_of(CELL_FIELDS)),
+}
+
+
+def read_notebook(text):
+    """Return a light v4 notebook dict or None if the scanner cannot read it
+    Outputs only keep output_type and the mime type names of data"""
+    try:
+        pos = WHITESPACE.match(text).end()
+        notebook, pos = parse_object(text, pos, NOTEBOOK_FIELDS)
+        if WHITESPACE.match(text, pos).end() != len(text):
+            return None
+    except (ValueError, IndexError):
+        return None
+    if not isinstance(notebook.get("nbformat"), int) or notebook["nbformat"] < 4:
+        return None
+    return notebook
+
+
+def load_text(text):
+    """Load notebook text, falling back to nbformat
+    Returns the notebook and whether the fast loader read it"""
+    notebook = read_notebook(text)
+    if notebook is not None:
+        return notebook, True
+    return nbf.reads(text, nbf.NO_CONVERT), False
+
+
+def synthetic_notebook(megabytes, cells=50):
+    """Return notebook text with large embedded outputs"""
+    image = base64.b64encode(os.urandom(int(megabytes * 2 ** 20 / cells * 3 / 4)))
+    notebook = nbf.v4.new_notebook()
+    for index in range(cells):
+        notebook.cells.append(nbf.v4.new_markdown_cell("## Step {}".format(index)))
+        notebook.cells.append(nbf.v4.new_code_cell(
+            "plot(data[{}])".format(index),
+            execution_count=index + 1,
+            outputs=[
+                nbf.v4.new_output("stream", text="line\n" * 200),
+                nbf.v4.new_output("display_data", data={
+                    "image/png": image.decode("ascii"),
+                    "text/plain": ["<Figure>"],
+                }),
+            ],
+        ))
+    return nbf.writes(notebook)
+
+
+def benchmark(texts, repeat):
+    """Compare fast loader with nbformat"""
+    def measure(function):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for text in texts:
+                function(text)
+        return (time.perf_counter() - start) / repeat
+
+    def with_nbformat(text):
+        nbf.convert(nbf.reads(text, nbf.NO_CONVERT), 4)
+
+    size = sum(len(text) for text in texts) / 2 ** 20
+    fast = sum(1 for text in texts if read_notebook(text) is not None)
+    vprint(0, "Notebooks: {} ({:.1f} MB). Fast loader: {}. Fallback: {}".format(
+        len(texts), size, fast, len(texts) - fast
+    ))
+    for name, function in (
+        ("nbformat", with_nbformat),
+        ("json", json.loads),
+        ("fast", load_text),
+    ):
+        elapsed = measure(function)
+        vprint(0, "{}: {:.3f}s ({:.1f} MB/s)".format(name, elapsed, size / elapsed))
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(
+        description="Benchmark the fast notebook loader")
+    parser.add_argument("-v", "--verbose", type=int, default=config.VERBOSE,
+                        help="increase output verbosity")
+    parser.add_argument("notebooks", nargs="*",
+                        help="notebook files")
+    parser.add_argument("-s", "--synthetic", type=float, default=0,
+                        help="add a notebook with this many MB of outputs")
+    parser.add_argument("-n", "--repeat", type=int, default=3,
+                        help="number of repetitions")
+    args = parser.parse_args()
+    config.VERBOSE = args.verbose
+    texts = []
+    for path in args.notebooks:
+        with open(path, "rb") as fil:
+            texts.append(fil.read().decode("utf-8"))
+    if args.synthetic:
+        texts.append(synthetic_notebook(args.synthetic))
+    benchmark(texts, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""Shared git object store for cloned repositories
+Each store is a bare repository keyed by the root commit of the cloned
+history. Clones borrow objects from it through git alternates, so forks
+and near-copies only download and keep the objects the store lacks.
+Only forks and clones that borrow from a store are cloned with their full
+history; other clones stay shallow and are not attached.
+Repositories must be detached before they are archived.
+"""
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+from contextlib import contextmanager
+from functools import lru_cache
+
+from github import Github, GithubException
+
+import config
+from utils import vprint
+
+
+def git_dir(path):
+    """Return the .git directory of a repository path"""
+    return config.Path(str(path)) / ".git"
+
+
+def alternates_file(path):
+    """Return the alternates file of a repository path"""
+    return git_dir(path) / "objects" / "info" / "alternates"
+
+
+def store_path(root):
+    """Return the store of a root commit"""
+    return config.OBJECT_STORE / "{}.git".format(root)
+
+
+def clone_ref(repo):
+    """Return the ref component of a clone in its store
+    Repository names of other domains are URLs, which are not valid in refs.
+    The sha1 is the one of the content directory (hash_dir1 + hash_dir2)"""
+    return hashlib.sha1(repo.encode("utf-8")).hexdigest()
+
+
+def read_index():
+    """Read the name -> root commit index"""
+    index = config.OBJECT_STORE / "index.json"
+    if not index.exists():
+        return {}
+    with open(str(index), "r") as fil:
+        return json.load(fil)
+
+
+def write_index(data):
+    """Write the name -> root commit index atomically"""
+    index = config.OBJECT_STORE / "index.json"
+    handle, temp = tempfile.mkstemp(
+        dir=str(config.OBJECT_STORE), prefix="index.", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(handle, "w") as fil:
+            json.dump(data, fil, indent=1, sort_keys=True)
+        os.replace(temp, str(index))
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+
+@contextmanager
+def locked(name):
+    """Hold an exclusive lock on a file of the object store
+    Workers that attach clones at the same time take turns on the index
+    and on each store"""
+    with open(str(config.OBJECT_STORE / "{}.lock".format(name)), "w") as fil:
+        fcntl.flock(fil, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fil, fcntl.LOCK_UN)
+
+
+@lru_cache(maxsize=128)
+def network_names(domain, repo):
+    """Return the names that identify the fork network of a repository"""
+    names = [repo]
+    if domain != "github.com":
+        return tuple(names)
+    try:
+        repository = Github(config.GITHUB_TOKEN).get_repo(repo)
+        for other in (repository.parent, repository.source):
+            if other is not None and other.full_name not in names:
+                names.append(other.full_name)
+    except GithubException as err:
+        vprint(2, "Failed to load fork network of {}: {}".format(repo, err))
+    return tuple(names)
+
+
+def find_reference(domain, repo):
+    """Return the store that the clone of a repository should borrow from"""
+    if not config.OBJECT_STORE:
+        return None
+    index = read_index()
+    for name in network_names(domain, repo):
+        root = index.get(name)
+        if root and store_path(root).exists():
+            vprint(2, "Borrowing objects from {} ({})".format(root, name))
+            return store_path(root)
+    return None
+
+
+def full_history(domain, repo):
+    """Check if a clone without reference should fetch its full history
+    Forks seed the store of their network; other clones stay shallow"""
+    return bool(config.OBJECT_STORE) and len(network_names(domain, repo)) > 1
+
+
+def root_commit(path):
+    """Return the first root commit of HEAD"""
+    roots = subprocess.check_output(
+        ["git", "rev-list", "--max-parents=0", "HEAD"], cwd=str(path)
+    ).decode("utf-8").split()
+    return sorted(roots)[0]
+
+
+def attach(path, domain, repo):
+    """Move the objects of a clone into the store of its root commit
+    The clone keeps only the objects that the store does not have.
+    Shallow clones are not attached: their root is not the real root
+    """
+    if not config.OBJECT_STORE or (git_dir(path) / "shallow").exists():
+        return None
+    config.OBJECT_STORE.mkdir(parents=True, exist_ok=True)
+    root = root_commit(path)
+    store = store_path(root)
+    ref_name = clone_ref(repo)
+    with locked(root):
+        if not store.exists():
+            subprocess.check_call(["git", "init", "--quiet", "--bare", str(store)])
+        subprocess.check_call([
+            "git", "--git-dir", str(store), "fetch", "--quiet", "--no-tags",
+            str(path), "+HEAD:refs/clones/{}/tip".format(ref_name),
+            "+refs/*:refs/clones/{}/refs/*".format(ref_name)
+        ])
+        subprocess.check_call(["git", "--git-dir", str(store), "gc", "--auto", "--quiet"])
+    alternates = alternates_file(path)
+    existing = alternates.read_text().split() if alternates.exists() else []
+    objects = str(store.resolve() / "objects")
+    if objects not in existing:
+        with open(str(alternates), "a") as fil:
+            fil.write(objects + "\n")
+    # Pack loose objects first: repack -l only drops borrowed objects from packs
+    subprocess.check_call(["git", "repack", "-a", "-d", "-q"], cwd=str(path))
+    subprocess.check_call(["git", "repack", "-a", "-d", "-l", "-q"], cwd=str(path))
+    with locked("index"):
+        index = read_index()
+        for name in network_names(domain, repo):
+            index.setdefault(name, root)
+        index[repo] = root
+        write_index(index)
+    return root
+
+
+def detach(path):
+    """Copy borrowed objects into the clone and drop its alternates
+    This must run before the repository is archived or moved
+    """
+    alternates = alternates_file(path)
+    if not alternates.exists():
+        return False
+    subprocess.check_call(["git", "repack", "-a", "-d", "-q"], cwd=str(path))
+    alternates.unlink()
+    return True
+
+
+def disk_usage(store, *refs):
+    """Return the bytes of the objects reachable from store refs"""
+    return int(subprocess.check_output([
+        "git", "--git-dir", str(store), "rev-list", "--objects",
+        "--disk-usage"
+    ] + list(refs)).decode("utf-8").strip() or 0)
+
+
+def report():
+    """Print how many bytes the stores save"""
+    index = read_index()
+    clones = {}
+    for name, root in index.items():
+        clones.setdefault(root, set()).add(name)
+    total_store = total_clones = 0
+    for root, names in sorted(clones.items()):
+        store = store_path(root)
+        if not store.exists():
+            continue
+        refs = subprocess.check_output([
+            "git", "--git-dir", str(store), "for-each-ref",
+            "--format=%(refname)", "refs/clones/"
+        ]).decode("utf-8").split()
+        heads = [ref for ref in refs if ref.count("/") == 3 and ref.endswith("/tip")]
+        size = disk_usage(store, "--all")
+        standalone = sum(disk_usage(store, ref) for ref in heads)
+        total_store += size
+        total_clones += standalone
+        vprint(1, "{}: {} clones, {} names, {:.1f} MB stored, {:.1f} MB standalone".format(
+            root, len(heads), len(names), size / 2 ** 20, standalone / 2 ** 20
+        ))
+    ratio = total_clones / total_store if total_store else 1.0
+    vprint(0, "Stores: {}. Stored: {:.1f} MB. Standalone: {:.1f} MB. Dedup ratio: {:.2f}".format(
+        len(clones), total_store / 2 ** 20, total_clones / 2 ** 20, ratio
+    ))
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(
+        description="Manage the shared git object store")
+    parser.add_argument("-v", "--verbose", type=int, default=config.VERBOSE,
+                        help="increase output verbosity")
+    parser.add_argument("command", choices=["report", "detach"],
+                        help="report deduplication or detach repositories")
+    parser.add_argument("paths", nargs="*",
+                        help="repository paths to detach")
+    args = parser.parse_args()
+    config.VERBOSE = args.verbose
+    if args.command == "report":
+        report()
+    else:
+        for path in args.paths:
+            vprint(0, "{}: {}".format(path, "detached" if detach(path) else "not attached"))
+
+
+if __name__ == "__main__":
+    main()
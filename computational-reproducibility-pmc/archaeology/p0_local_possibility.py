@@ -6,10 +6,11 @@ import sys
 import config
 import consts
 
-from db import CellModule, RepositoryFile, connect
+from db import CellModule, connect
 from utils import vprint, StatusLogger, check_exit, savepid
+from repository_content import repository_content
 
-def process_cell_module(session, cell_module, archive):
+def process_cell_module(session, cell_module, index):
     if cell_module.local_possibility is not None:
         return "already processed"
     session.add(cell_module)
@@ -22,30 +23,8 @@ def process_cell_module(session, cell_module, archive):
         cell_module.local_possibility = 0
         return "empty 0"
 
-    modes = [
-        [module_name, 3, "full match 3"],
-    ]
-    split = module_name.split('/', 1)
-    if len(split) > 1:
-        modes.append([split[-1], 2, "all but first 2"])
-
-    split = module_name.split('/')
-    if len(split) > 2:
-        modes.append([split[-1], 1, "module name 1"])
-
-
-    for name in archive:
-        for modname, value, result in modes:
-            if name.endswith(modname):
-                if len(name) <= len(modname):
-                    cell_module.local_possibility = value
-                    return result
-                elif name[-len(modname) - 1] == '/':
-                    cell_module.local_possibility = value
-                    return result + " (py)"
-
-    cell_module.local_possibility = 0
-    return "non-local"
+    cell_module.local_possibility, result = index.local_possibility(module_name)
+    return result
 
 
 def load_repository(session, cell_module, skip_repo, repository_id, archives):
@@ -63,12 +42,8 @@ def load_repository(session, cell_module, skip_repo, repository_id, archives):
             vprint(1, 'Skipping. Files not extracted from repository')
             return True, cell_module.repository_id, None
 
-        archives = {
-            fil.path for fil in session.query(RepositoryFile).filter(
-                RepositoryFile.repository_id == repository.id
-            )
-        }
-        return False, cell_module.repository_id, archives
+        index = repository_content(session, repository, ("manifest",)).path_index()
+        return False, cell_module.repository_id, index
 
     return skip_repo, repository_id, archives
 
@@ -0,0 +1,100 @@
+"""Path index of the files of a repository
+A trie of path components answers existence checks and local module
+resolution. A trie of reversed components answers which names end with a
+path. Both walk one node per component of the query.
+"""
+END = None
+
+
+def components(path):
+    """Split relative path into its components"""
+    return [part for part in path.split("/") if part and part != "."]
+
+
+class PathIndex(object):
+    """Index of the relative names of a repository
+    Directories of the names exist even without their own entries"""
+
+    def __init__(self, names=()):
+        self.tree = {}
+        self.suffixes = {}
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        """Add relative name"""
+        parts = components(name)
+        node = self.tree
+        for part in parts:
+            node = node.setdefault(part, {})
+        node = self.suffixes
+        for part in reversed(parts):
+            node = node.setdefault(part, {})
+        node[END] = True
+
+    def node(self, path, node=None):
+        """Return the tree node of path or None"""
+        node = self.tree if node is None else node
+        for part in components(path):
+            node = node.get(part)
+            if node is None:
+                return None
+        return node
+
+    def exists(self, path):
+        """Check if file or directory exists"""
+        return self.node(path) is not None
+
+    def is_local(self, module, base=""):
+        """Check if module is local to the directory base
+        Each package of the module must exist as a directory or .py file"""
+        if module.startswith("."):
+            return True
+        node = self.node(base)
+        for part in module.split("."):
+            if node is None:
+                return False
+            if not part:
+                continue
+            child = node.get(part)
+            if child is None and part + ".py" not in node:
+                return False
+            node = child
+        return True
+
+    def ending(self, path):
+        """Return which names end with path at a component boundary
+        Returns None if none does, "exact" if a name is path and "suffix"
+        otherwise"""
+        parts = path.split("/")
+        node = self.suffixes
+        for part in reversed(parts):
+            node = node.get(part)
+            if node is None:
+                return None
+        return "exact" if END in node else "suffix"
+
+    def local_possibility(self, module_name):
+        """Return (local_possibility, description) of a module path
+        3: a name ends with the module path
+        2: a name ends with the module path without its first package
+        1: a name ends with the last part of a path with at least 3 parts
+        0: no name matches"""
+        modes = [
+            [module_name, 3, "full match 3"],
+        ]
+        split = module_name.split("/", 1)
+        if len(split) > 1:
+            modes.append([split[-1], 2, "all but first 2"])
+
+        split = module_name.split("/")
+        if len(split) > 2:
+            modes.append([split[-1], 1, "module name 1"])
+
+        for modname, value, result in modes:
+            ending = self.ending(modname)
+            if ending == "exact":
+                return value, result
+            if ending == "suffix":
+                return value, result + " (py)"
+        return 0, "non-local"
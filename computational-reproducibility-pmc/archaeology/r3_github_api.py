@@ -1,11 +1,64 @@
+import argparse
+import json
 from github import Github, GithubException
+import dateutil.parser
+import requests
 import config
 from db import Repository, Article, RepositoryData, RepositoryRelease, connect
 from utils import mount_basedir, savepid, vprint
-from datetime import datetime
+from datetime import datetime, timezone
 import time
 
 
+GRAPHQL_REPOSITORY = """
+    {alias}: repository(owner: {owner}, name: {name}) {{
+        url
+        description
+        createdAt
+        updatedAt
+        pushedAt
+        diskUsage
+        homepageUrl
+        languages(first: 100, orderBy: {{field: SIZE, direction: DESC}}) {{ edges {{ size node {{ name }} }} }}
+        stargazerCount
+        watchers {{ totalCount }}
+        forkCount
+        issues(states: OPEN) {{ totalCount }}
+        pullRequests(states: OPEN) {{ totalCount }}
+        isArchived
+        hasIssuesEnabled
+        hasProjectsEnabled
+        hasWikiEnabled
+        isPrivate
+        licenseInfo {{ name key }}
+        defaultBranchRef {{
+            target {{
+                ... on Commit {{
+                    {history}
+                }}
+            }}
+        }}
+        releases(first: 100{after}) {{
+            totalCount
+            pageInfo {{ hasNextPage endCursor }}
+            nodes {{ name tagName createdAt publishedAt isPrerelease }}
+        }}
+    }}
+"""
+
+GRAPHQL_RELEASES = """
+    {alias}: repository(owner: {owner}, name: {name}) {{
+        releases(first: 100{after}) {{
+            totalCount
+            pageInfo {{ hasNextPage endCursor }}
+            nodes {{ name tagName createdAt publishedAt isPrerelease }}
+        }}
+    }}
+"""
+
+COMMIT_DATES = ["published", "received", "accepted"]
+
+
 def get_repo_info_github_api(session):
     count = 0
     query = session.query(Repository)
@@ -116,11 +169,252 @@ def get_repo_info_github_api(session):
 
     vprint(0, "Finished loading repository data and release")
 
+def graphql_date(value):
+    """Convert GraphQL ISO date into the naive UTC datetime PyGithub returns"""
+    if not value:
+        return None
+    date = dateutil.parser.parse(value)
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def retry_delay(response, attempt):
+    """Return seconds to wait before retrying a response or None
+    Gateway errors back off exponentially. Rate and abuse limits wait for
+    Retry-After or for the rate limit reset"""
+    if response.status_code in (502, 503, 504):
+        return 2 ** attempt
+    if response.status_code not in (403, 429):
+        return None
+    headers = response.headers
+    if "Retry-After" in headers:
+        return float(headers["Retry-After"])
+    if headers.get("X-RateLimit-Remaining") == "0" and "X-RateLimit-Reset" in headers:
+        return max(float(headers["X-RateLimit-Reset"]) - time.time(), 0) + 1
+    if "rate limit" in response.text or "abuse" in response.text:
+        return 60 * 2 ** attempt
+    return None
+
+
+def graphql_query(query, endpoint=None, retries=5, timeout=None):
+    """Run GraphQL query and return its data and errors"""
+    endpoint = endpoint or config.GITHUB_GRAPHQL_URL
+    timeout = timeout or config.GITHUB_TIMEOUT
+    headers = {}
+    if config.GITHUB_TOKEN:
+        headers["Authorization"] = "bearer {}".format(config.GITHUB_TOKEN)
+    for attempt in range(retries):
+        last = attempt == retries - 1
+        try:
+            response = requests.post(
+                endpoint, data=json.dumps({"query": query}), headers=headers,
+                timeout=timeout
+            )
+        except (requests.ConnectionError, requests.Timeout) as err:
+            if last:
+                raise
+            vprint(1, "GraphQL request failed due {!r}. Retrying".format(err))
+            time.sleep(2 ** attempt)
+            continue
+        delay = retry_delay(response, attempt)
+        if delay is not None and not last:
+            vprint(1, "GraphQL status {}. Retrying in {:.0f}s".format(
+                response.status_code, delay
+            ))
+            time.sleep(delay)
+            continue
+        response.raise_for_status()
+        result = response.json()
+        return result.get("data") or {}, result.get("errors") or []
+
+
+def repository_alias_query(alias, repository, article, after=None):
+    """Build aliased GraphQL fragment for a repository"""
+    owner, _, name = repository.repository.partition("/")
+    history = []
+    for date_name in COMMIT_DATES:
+        date = getattr(article, date_name + "_date", None) if article else None
+        if date:
+            since = datetime.strptime(date, '%Y-%m-%d').strftime("%Y-%m-%dT%H:%M:%SZ")
+            history.append("{}: history(since: {}) {{ totalCount }}".format(
+                date_name, json.dumps(since)
+            ))
+    return GRAPHQL_REPOSITORY.format(
+        alias=alias,
+        owner=json.dumps(owner),
+        name=json.dumps(name),
+        history="\n".join(history) or "oid",
+        after=", after: {}".format(json.dumps(after)) if after else "",
+    )
+
+
+def release_rows(repository, nodes):
+    """Convert GraphQL release nodes into RepositoryRelease rows"""
+    return [
+        {
+            "name": node["name"],
+            "tag_name": node["tagName"],
+            "created_at": graphql_date(node["createdAt"]),
+            "published_at": graphql_date(node["publishedAt"]),
+            "tarball_url": "https://api.github.com/repos/{}/tarball/{}".format(
+                repository.repository, node["tagName"]
+            ),
+            "prerelease": node["isPrerelease"],
+            "repository_id": repository.id,
+            "article_id": repository.article_id,
+        }
+        for node in nodes
+    ]
+
+
+def repository_data_row(repository, repo):
+    """Convert GraphQL repository into a RepositoryData row"""
+    target = (repo.get("defaultBranchRef") or {}).get("target") or {}
+    license_info = repo.get("licenseInfo") or {}
+    commits = {
+        date_name: target[date_name]["totalCount"] if date_name in target else None
+        for date_name in COMMIT_DATES
+    }
+    languages = {
+        edge["node"]["name"]: edge["size"]
+        for edge in repo["languages"]["edges"]
+    }
+    return {
+        "url": repo["url"],
+        "description": repo["description"],
+        "created_at": graphql_date(repo["createdAt"]),
+        "updated_at": graphql_date(repo["updatedAt"]),
+        "pushed_at": graphql_date(repo["pushedAt"]),
+        "size": repo["diskUsage"],
+        "homepage": repo["homepageUrl"],
+        "language": str(languages),
+        # REST watchers is an alias of stargazers
+        "watchers": repo["stargazerCount"],
+        "subscribers_count": repo["watchers"]["totalCount"],
+        "stargazers_count": repo["stargazerCount"],
+        "forks_count": repo["forkCount"],
+        # GraphQL does not expose network_count, has_downloads, has_pages.
+        # The REST mode (--batch 0) stores them
+        "network_count": None,
+        "open_issues_count": (
+            repo["issues"]["totalCount"] + repo["pullRequests"]["totalCount"]
+        ),
+        "archived": repo["isArchived"],
+        "has_issues": repo["hasIssuesEnabled"],
+        "has_downloads": None,
+        "has_projects": repo["hasProjectsEnabled"],
+        "has_pages": None,
+        "has_wiki": repo["hasWikiEnabled"],
+        "private": repo["isPrivate"],
+        "license_name": license_info.get("name"),
+        "license_key": license_info.get("key"),
+        "total_commits_after_published_date": commits["published"],
+        "total_commits_after_received_date": commits["received"],
+        "total_commits_after_accepted_date": commits["accepted"],
+        "total_releases": repo["releases"]["totalCount"],
+        "repository_id": repository.id,
+        "article_id": repository.article_id,
+    }
+
+
+def remaining_releases(repository, releases, endpoint=None):
+    """Fetch release pages beyond the first one"""
+    nodes = []
+    while releases["pageInfo"]["hasNextPage"]:
+        owner, _, name = repository.repository.partition("/")
+        data, errors = graphql_query("query {{ {} }}".format(GRAPHQL_RELEASES.format(
+            alias="r0", owner=json.dumps(owner), name=json.dumps(name),
+            after=", after: {}".format(json.dumps(releases["pageInfo"]["endCursor"]))
+        )), endpoint)
+        if not data.get("r0"):
+            vprint(1, "Failed to load releases of {}: {}".format(repository, errors))
+            break
+        releases = data["r0"]["releases"]
+        nodes += releases["nodes"]
+    return nodes
+
+
+def fetch_batch(repositories, endpoint=None):
+    """Fetch RepositoryData and RepositoryRelease rows for a batch of (repository, article)"""
+    query = "query {{ {} }}".format("".join(
+        repository_alias_query("r{}".format(index), repository, article)
+        for index, (repository, article) in enumerate(repositories)
+    ))
+    data, errors = graphql_query(query, endpoint)
+    for error in errors:
+        vprint(2, "GraphQL error: {}".format(error.get("message")))
+    data_rows, release_rows_ = [], []
+    for index, (repository, _) in enumerate(repositories):
+        repo = data.get("r{}".format(index))
+        if repo is None:
+            vprint(1, "Repository not found={}".format(repository.repository))
+            continue
+        data_rows.append(repository_data_row(repository, repo))
+        nodes = repo["releases"]["nodes"]
+        nodes += remaining_releases(repository, repo["releases"], endpoint)
+        release_rows_ += release_rows(repository, nodes)
+    return data_rows, release_rows_
+
+
+def get_repo_info_github_graphql(session, batch_size=50, endpoint=None, delay=0):
+    """Load repository data and releases in batches of GraphQL queries"""
+    query = (
+        session.query(Repository, Article)
+        .outerjoin(Article, Article.id == Repository.article_id)
+        .outerjoin(RepositoryData, (
+            (RepositoryData.repository_id == Repository.id)
+            & (RepositoryData.article_id == Repository.article_id)
+        ))
+        .filter(
+            RepositoryData.id.is_(None),
+            Repository.repository != 'features/actions',
+        )
+        .order_by(Repository.id.asc())
+    )
+    pending = query.all()
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        vprint(0, "Fetching repositories {} to {} of {}".format(
+            start + 1, start + len(batch), len(pending)
+        ))
+        data_rows, release_rows_ = fetch_batch(batch, endpoint)
+        session.bulk_insert_mappings(RepositoryData, data_rows)
+        session.bulk_insert_mappings(RepositoryRelease, release_rows_)
+        session.commit()
+        vprint(1, "Done. {} RepositoryData, {} RepositoryRelease".format(
+            len(data_rows), len(release_rows_)
+        ))
+        if delay:
+            time.sleep(delay)
+
+    vprint(0, "Finished loading repository data and release")
+
+
 def main():
     """Main function"""
+    parser = argparse.ArgumentParser(
+        description="Load repository metadata from the GitHub API")
+    parser.add_argument("-v", "--verbose", type=int, default=config.VERBOSE,
+                        help="increase output verbosity")
+    parser.add_argument("-b", "--batch", type=int, default=0,
+                        help="repositories per GraphQL query (0 uses REST, which "
+                             "also stores network_count, has_downloads, has_pages)")
+    parser.add_argument("--endpoint", type=str,
+                        default=config.GITHUB_GRAPHQL_URL,
+                        help="GraphQL endpoint")
+    parser.add_argument("-d", "--delay", type=float, default=0,
+                        help="seconds to wait between GraphQL batches")
+    args = parser.parse_args()
+    config.VERBOSE = args.verbose
 
     with connect() as session, mount_basedir(), savepid():
-        get_repo_info_github_api(session)
+        if args.batch:
+            get_repo_info_github_graphql(
+                session, args.batch, args.endpoint, args.delay
+            )
+        else:
+            get_repo_info_github_api(session)
 
 if __name__ == "__main__":
     main()
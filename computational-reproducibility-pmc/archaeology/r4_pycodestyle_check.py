@@ -10,6 +10,7 @@ import re
 import config
 from db import Repository, Notebook, NotebookCodeStyle, connect
 from utils import mount_basedir, savepid, vprint
+from repository_content import repository_content
 
 
 # notebook = ''
@@ -36,12 +37,17 @@ from utils import mount_basedir, savepid, vprint
         #if re.match(r"(.*)#In[\d[0-9\w+]]:(\d[0-9\w+):(\d[0-9\w+): (.*)", err):
 
 def call_codestyle_check(session, repository, notebook):
-    if repository.path.exists():
-        notebook_path = str(repository.path / notebook.name)
-        print(notebook_path)
+    content = repository_content(session, repository, ("directory", "archive"))
+    if content is not None:
+        try:
+            with content.local_path(notebook.name) as notebook_path:
+                print(notebook_path)
 
-        process = subprocess.Popen(['flake8-nb'] + [notebook_path], stdout=APIPE, stderr=APIPE)
-        out, err = process.communicate()
+                process = subprocess.Popen(['flake8-nb'] + [notebook_path], stdout=APIPE, stderr=APIPE)
+                out, err = process.communicate()
+        except (IOError, OSError) as err:
+            vprint(1, "Failed to read notebook {} due {!r}".format(notebook.name, err))
+            return
         rc = process.returncode
         if rc and out:
             code_style_err = out.decode('UTF-8').rstrip().split('\n')
@@ -0,0 +1,244 @@
+"""Unified access to the files of a repository
+RepositoryContent reads files from the uncompressed directory or from the
+archive, and answers existence checks from the RepositoryFile manifest.
+Module resolution uses a PathIndex of the names, built once per content.
+Open archives and their member indexes stay in an LRU cache, so looking
+up many members of the same repository opens and indexes it once.
+"""
+import errno
+import io
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import config
+import consts
+from archives import open_archive, read_members, scan_members
+from db import RepositoryFile
+from path_index import PathIndex
+from utils import scan_files, ignore_surrogates
+
+
+OPEN_ARCHIVES = OrderedDict()
+
+
+def cached_archive(path):
+    """Return open archive backend from the LRU cache"""
+    key = str(path)
+    mtime = os.stat(key).st_mtime
+    entry = OPEN_ARCHIVES.pop(key, None)
+    if entry is not None and entry[0] != mtime:
+        entry[1].close()
+        entry = None
+    if entry is None:
+        entry = (mtime, open_archive(path))
+    OPEN_ARCHIVES[key] = entry
+    while len(OPEN_ARCHIVES) > max(config.ARCHIVE_CACHE, 1):
+        _, (_, archive) = OPEN_ARCHIVES.popitem(last=False)
+        archive.close()
+    return entry[1]
+
+
+def clear_cache():
+    """Close cached archives"""
+    while OPEN_ARCHIVES:
+        _, (_, archive) = OPEN_ARCHIVES.popitem()
+        archive.close()
+
+
+def not_found(name):
+    """Return error for missing files"""
+    return IOError(errno.ENOENT, "File not found in repository", name)
+
+
+def clean(name):
+    """Normalize relative name"""
+    name, _ = ignore_surrogates(name)
+    return name.strip("/")
+
+
+class RepositoryContent(object):
+    """Files of a repository. Names are relative to the repository root"""
+    kind = None
+
+    def __init__(self, session, repository):
+        self.session = session
+        self.repository = repository
+        self.names = None
+        self.index = None
+
+    def manifest(self):
+        """Return the set of names in the RepositoryFile manifest"""
+        if self.names is None:
+            self.names = set()
+            for (path,) in self.session.query(RepositoryFile.path).filter(
+                RepositoryFile.repository_id == self.repository.id
+            ):
+                self.names.add(path.strip("/"))
+        return self.names
+
+    def exists(self, name):
+        """Check if file or directory exists"""
+        return clean(name) in self.manifest()
+
+    def list(self):
+        """Return names of files and directories"""
+        return list(self.manifest())
+
+    def path_index(self):
+        """Return the PathIndex of the names. It is built once"""
+        if self.index is None:
+            self.index = PathIndex(self.list())
+        return self.index
+
+    def read(self, name):
+        """Read file content. Raises IOError if it cannot be read"""
+        raise not_found(name)
+
+    def open(self, name):
+        """Open file for reading in binary mode"""
+        return io.BytesIO(self.read(name))
+
+    def read_many(self, names):
+        """Return dict of name -> bytes for the names that could be read"""
+        result = {}
+        for name in names:
+            try:
+                result[name] = self.read(name)
+            except (IOError, OSError):
+                pass
+        return result
+
+    def scan(self, patterns):
+        """Return relative paths of files matching each pattern"""
+        raise not_found(self.repository.path)
+
+    @contextmanager
+    def local_path(self, name):
+        """Yield a filesystem path with the content of the file"""
+        suffix = os.path.splitext(name)[1]
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "file" + suffix)
+            with open(path, "wb") as fil:
+                fil.write(self.read(name))
+            yield path
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+class ManifestContent(RepositoryContent):
+    """Existence checks only, from the RepositoryFile manifest"""
+    kind = "manifest"
+
+
+class DirectoryContent(RepositoryContent):
+    """Uncompressed repository directory"""
+    kind = "directory"
+
+    def path(self, name):
+        """Return filesystem path of name"""
+        return os.path.join(str(self.repository.path), name.lstrip("/"))
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def list(self):
+        _, manifest = scan_files(self.repository.path, [], manifest=True)
+        return [path for path, _, _ in manifest]
+
+    def read(self, name):
+        with open(self.path(name), "rb") as fil:
+            return fil.read()
+
+    def open(self, name):
+        return open(self.path(name), "rb")
+
+    def scan(self, patterns):
+        found, _ = scan_files(self.repository.path, patterns)
+        return found
+
+    @contextmanager
+    def local_path(self, name):
+        yield self.path(name)
+
+
+class ArchiveContent(RepositoryContent):
+    """Compressed repository
+    Sequential archives answer existence checks from the manifest when it
+    exists, to avoid decompressing the archive to index it"""
+    kind = "archive"
+
+    def __init__(self, session, repository):
+        super(ArchiveContent, self).__init__(session, repository)
+        self.path = repository.zip_path
+        self.root = repository.hash_dir2
+        self.archive = cached_archive(self.path)
+        self.contents = {}
+
+    def use_manifest(self):
+        """Check if the manifest should answer existence checks"""
+        return (
+            not self.archive.seekable
+            and self.repository.processed & consts.R_EXTRACTED_FILES
+        )
+
+    def member(self, name):
+        """Return archive name"""
+        return "{}/{}".format(self.root, clean(name))
+
+    def exists(self, name):
+        if self.use_manifest():
+            return super(ArchiveContent, self).exists(name)
+        return self.archive.exists(self.member(name))
+
+    def list(self):
+        if self.use_manifest():
+            return super(ArchiveContent, self).list()
+        prefix = self.root + "/"
+        return [
+            member.name[len(prefix):] for member in self.archive.members()
+            if member.name.startswith(prefix)
+        ]
+
+    def read(self, name):
+        if name in self.contents:
+            return self.contents[name]
+        try:
+            return self.archive.read(self.member(name))
+        except KeyError:
+            raise not_found(name)
+
+    def read_many(self, names):
+        if self.archive.seekable:
+            return super(ArchiveContent, self).read_many(names)
+        missing = [name for name in names if name not in self.contents]
+        if missing:
+            self.contents.update(read_members(self.path, self.root, missing))
+        return {name: self.contents[name] for name in names if name in self.contents}
+
+    def scan(self, patterns):
+        found, contents = scan_members(self.path, self.root, patterns)
+        self.contents.update(contents)
+        return found
+
+
+CONTENTS = {
+    "directory": (DirectoryContent, lambda repository: repository.path.exists()),
+    "archive": (ArchiveContent, lambda repository: repository.zip_path.exists()),
+    "manifest": (
+        ManifestContent,
+        lambda repository: repository.processed & consts.R_EXTRACTED_FILES
+    ),
+}
+
+
+def repository_content(session, repository, order=("directory", "archive", "manifest")):
+    """Return the first available content of a repository or None"""
+    for kind in order:
+        cls, available = CONTENTS[kind]
+        if available(repository):
+            return cls(session, repository)
+    return None
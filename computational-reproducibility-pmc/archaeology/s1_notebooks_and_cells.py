@@ -1,18 +1,23 @@
 """Load notebook and cells"""
 import argparse
 import os
+import tarfile
+import zipfile
+from collections import deque
 
 import nbformat as nbf
-from IPython.core.interactiveshell import InteractiveShell
 
 import config
 import consts
 import shutil
 import subprocess
 from db import Cell, Notebook, Repository, connect
-from utils import timeout, TimeoutError, vprint, StatusLogger, mount_basedir
+from utils import TimeoutError, vprint, StatusLogger, mount_basedir
 from utils import check_exit, savepid, SafeSession
-from e5_unzip_repositories import unzip_repository
+from repository_content import repository_content
+from workers import WorkerPool
+from notebook_loader import load_text
+from cell_transform import get_transformer
 
 
 def cell_output_formats(cell):
@@ -27,18 +32,21 @@ def cell_output_formats(cell):
             yield "error"
 
 
-@timeout(5 * 60, use_signals=False)
-def load_notebook(repository_id, path, notebook_file, nbrow):
-    """Extract notebook information and cells from notebook"""
+def load_notebook(repository_id, path, notebook_file, nbrow, content=None):
+    """Extract notebook information and cells from notebook
+    content holds the notebook bytes when it was read from the archive"""
     # pylint: disable=too-many-locals
     status = 0
     try:
-        with open(str(path / notebook_file)) as ofile:
-            notebook = nbf.read(ofile, nbf.NO_CONVERT)
+        if content is None:
+            with open(str(path / notebook_file), "rb") as ofile:
+                content = ofile.read()
+        notebook, fast = load_text(content.decode("utf-8"))
         nbrow["nbformat"] = "{0[nbformat]}".format(notebook)
         if "nbformat_minor" in notebook:
             nbrow["nbformat"] += ".{0[nbformat_minor]}".format(notebook)
-        notebook = nbf.convert(notebook, 4)
+        if not fast:
+            notebook = nbf.convert(notebook, 4)
         metadata = notebook["metadata"]
     except OSError as e:
         vprint(3, "Failed to open notebook {}".format(e))
@@ -84,7 +92,7 @@ def load_notebook(repository_id, path, notebook_file, nbrow):
     language_info = metadata.get("language_info", {})
     nbrow["language"] = language_info.get("name", "unknown")
     nbrow["language_version"] = language_info.get("version", "unknown")
-    shell = InteractiveShell.instance()
+    transformer = get_transformer()
     is_python = nbrow["language"] == "python"
     is_unknown_version = nbrow["language_version"] == "unknown"
 
@@ -108,7 +116,7 @@ def load_notebook(repository_id, path, notebook_file, nbrow):
             source = cell["source"] = cell["source"] or ""
             if is_python and cell.get("cell_type") == "code":
                 try:
-                    source = shell.input_transformer_manager.transform_cell(source)
+                    source = transformer.transform(source)
                 except (IndentationError, SyntaxError) as err:
                     vprint(3, "Error on cell transformation: {}".format(err))
                     source = ""
@@ -150,87 +158,128 @@ def load_notebook(repository_id, path, notebook_file, nbrow):
     if nbrow["total_cells"] == 0:
         status = consts.N_LOAD_FORMAT_ERROR
 
+    transformer.flush()
     nbrow["max_execution_count"] = exec_count
     nbrow["processed"] = status
     return nbrow, cells_info
 
 
 
-def process_repository(session, repository, skip_if_error=consts.R_N_ERROR):
-    """Process repository"""
+def new_nbrow(repository, name):
+    """Return default notebook row"""
+    return {
+        "repository_id": repository.id,
+        "name": name,
+        "nbformat": 0,
+        "kernel": "no-kernel",
+        "language": "unknown",
+        "language_version": "unknown",
+        "max_execution_count": 0,
+        "total_cells": 0,
+        "code_cells": 0,
+        "code_cells_with_output": 0,
+        "markdown_cells": 0,
+        "raw_cells": 0,
+        "unknown_cell_formats": 0,
+        "empty_cells": 0,
+        "processed": consts.N_OK,
+    }
+
+
+def prepare_repository(session, repository, skip_if_error=consts.R_N_ERROR):
+    """Return the count of known notebooks, (row, content) of notebooks to load
+    and the ids of stopped notebooks, which finish_repository deletes
+    content is None unless the notebook was read from the archive
+    Return a message instead if the repository should not be loaded
+    It does not commit: the main loop commits repositories in order"""
     if repository.processed & (consts.R_N_EXTRACTION + skip_if_error):
         return "already processed"
     if repository.processed & consts.R_N_ERROR:
         session.add(repository)
         repository.processed -= consts.R_N_ERROR
 
+    existing = {}
+    stopped = []
+    for notebook in session.query(Notebook).filter(
+        Notebook.repository_id == repository.id,
+    ):
+        if notebook.processed & consts.N_STOPPED:
+            stopped.append(notebook.id)
+        else:
+            existing.setdefault(notebook.name, notebook)
+
     count = 0
+    nbrows = []
     for name in repository.notebook_names:
         if not name:
             continue
         count += 1
-        notebook = session.query(Notebook).filter(
-            Notebook.repository_id == repository.id,
-            Notebook.name == name,
-        ).first()
+        notebook = existing.get(name)
         if notebook is not None:
-            if notebook.processed & consts.N_STOPPED:
-                session.delete(notebook)
-                session.commit()
-            else:
-                if notebook.processed & consts.N_GENERIC_LOAD_ERROR:
-                    count -= 1
-                    vprint(2, "Notebook already exists. Delete from DB: {}".format(notebook))
-                    with open(str(config.LOGS_DIR / "todo_delete"), "a") as f:
-                        f.write("{},".format(notebook.id))
+            if notebook.processed & consts.N_GENERIC_LOAD_ERROR:
+                count -= 1
+                vprint(2, "Notebook already exists. Delete from DB: {}".format(notebook))
+                with open(str(config.LOGS_DIR / "todo_delete"), "a") as f:
+                    f.write("{},".format(notebook.id))
 
-                continue  # Skip working notebook
+            continue  # Skip working notebook
 
-        if not repository.path.exists():
-            vprint(2, "Unzipping repository: {}".format(repository.zip_path))
-            msg = unzip_repository(session, repository)
-            if msg != "done":
-                vprint(2, msg)
-                return "failed"
+        nbrows.append(new_nbrow(repository, name))
 
-        try:
-            vprint(2, "Loading notebook {}".format(name))
-            nbrow = {
-                "repository_id": repository.id,
-                "name": name,
-                "nbformat": 0,
-                "kernel": "no-kernel",
-                "language": "unknown",
-                "language_version": "unknown",
-                "max_execution_count": 0,
-                "total_cells": 0,
-                "code_cells": 0,
-                "code_cells_with_output": 0,
-                "markdown_cells": 0,
-                "raw_cells": 0,
-                "unknown_cell_formats": 0,
-                "empty_cells": 0,
-                "processed": consts.N_OK,
-            }
-            try:
-                nbrow, cells = load_notebook(repository.id, repository.path, name, nbrow)
-            except TimeoutError:
-                nbrow["processed"] = consts.N_LOAD_TIMEOUT
-                cells = []
-            nbrow["processed"] |= consts.N_STOPPED
-            notebook = Notebook(**nbrow)
-            session.dependent_add(
-                notebook, [Cell(**cellrow) for cellrow in cells], "notebook_id"
-            )
-
-        except Exception as err:  # pylint: disable=broad-except
-            repository.processed |= consts.R_N_ERROR
+    contents = {}
+    if nbrows and not repository.path.exists():
+        content = repository_content(session, repository, ("archive",))
+        if content is None:
+            repository.processed |= consts.R_UNAVAILABLE_FILES
             session.add(repository)
-            vprint(1, "Failed to load notebook {} due {!r}".format(name, err))
-            if config.VERBOSE > 4:
-                import traceback
-                traceback.print_exc()
-
+            vprint(2, "Failed to load notebooks due <repository not found>")
+            return "failed"
+        vprint(2, "Reading notebooks from archive: {}".format(repository.zip_path))
+        try:
+            contents = content.read_many([nbrow["name"] for nbrow in nbrows])
+        except (OSError, tarfile.TarError, zipfile.BadZipfile) as err:
+            vprint(2, "Failed to read archive due {!r}".format(err))
+            return "failed"
+        for nbrow in nbrows:
+            if nbrow["name"] not in contents:
+                vprint(2, "Notebook not found in archive: {}".format(nbrow["name"]))
+    return count, [(nbrow, contents.get(nbrow["name"])) for nbrow in nbrows], stopped
+
+
+def save_notebook(session, repository, nbrow, success, result):
+    """Add notebook and cells loaded by a worker"""
+    if success:
+        nbrow, cells = result
+    elif isinstance(result, TimeoutError):
+        nbrow["processed"] = consts.N_LOAD_TIMEOUT
+        cells = []
+    else:
+        repository.processed |= consts.R_N_ERROR
+        session.add(repository)
+        vprint(1, "Failed to load notebook {} due {!r}".format(nbrow["name"], result))
+        return
+    try:
+        nbrow["processed"] |= consts.N_STOPPED
+        notebook = Notebook(**nbrow)
+        session.dependent_add(
+            notebook, [Cell(**cellrow) for cellrow in cells], "notebook_id"
+        )
+    except Exception as err:  # pylint: disable=broad-except
+        repository.processed |= consts.R_N_ERROR
+        session.add(repository)
+        vprint(1, "Failed to load notebook {} due {!r}".format(nbrow["name"], err))
+        if config.VERBOSE > 4:
+            import traceback
+            traceback.print_exc()
+
+
+def finish_repository(session, repository, count, stopped=()):
+    """Mark repository as extracted and commit its notebooks
+    Stopped notebooks are deleted in the same transaction"""
+    if stopped:
+        session.query(Notebook).filter(
+            Notebook.id.in_(stopped)
+        ).delete(synchronize_session=False)
     if not repository.processed & consts.R_N_ERROR and count == repository.notebooks_count:
         repository.processed |= consts.R_N_EXTRACTION
         session.add(repository)
@@ -248,10 +297,54 @@ def process_repository(session, repository, skip_if_error=consts.R_N_ERROR):
     return "done"
 
 
+def extract_repositories(session, status, repositories, skip_if_error, pool, check):
+    """Load notebooks of repositories in the worker pool
+    The main process prepares repositories ahead of the workers and writes
+    their results in order. Each queue entry is either (repository, nbrow)
+    for a notebook sent to the pool or (repository, prepared) for the end
+    of a repository
+    """
+    queue = deque()
+
+    def tasks():
+        for repository in repositories:
+            if check_exit(check):
+                vprint(0, "Found .exit file. Exiting")
+                return
+            status.report()
+            vprint(0, "Extracting notebooks/cells from {}".format(repository))
+            with mount_basedir():
+                prepared = prepare_repository(session, repository, skip_if_error)
+            if not isinstance(prepared, str):
+                for nbrow, content in prepared[1]:
+                    vprint(2, "Loading notebook {}".format(nbrow["name"]))
+                    queue.append((repository, nbrow))
+                    yield (
+                        repository.id, repository.path, nbrow["name"], nbrow, content
+                    ), {}
+            queue.append((repository, prepared))
+
+    def finish_ready():
+        while queue and not isinstance(queue[0][1], dict):
+            repository, prepared = queue.popleft()
+            if not isinstance(prepared, str):
+                prepared = finish_repository(session, repository, prepared[0], prepared[2])
+            vprint(0, prepared)
+            status.count += 1
+            session.commit()
+
+    for success, result in pool.imap(tasks()):
+        finish_ready()
+        repository, nbrow = queue.popleft()
+        save_notebook(session, repository, nbrow, success, result)
+    finish_ready()
+
+
 def apply(
     session, status, selected_repositories, skip_if_error,
-    count, interval, reverse, check
+    count, interval, reverse, check, processes=config.PROCESSES
 ):
+    pool = None
     while selected_repositories:
         filters = [
             Repository.processed.op("&")(consts.R_N_EXTRACTION) == 0, # no extraction
@@ -284,17 +377,13 @@ def apply(
                 Repository.id.asc()
             )
 
-        for repository in query:
-            if check_exit(check):
-                vprint(0, "Found .exit file. Exiting")
-                return
-            status.report()
-            vprint(0, "Extracting notebooks/cells from {}".format(repository))
-            with mount_basedir():
-                result = process_repository(session, repository, skip_if_error)
-                vprint(0, result)
-            status.count += 1
-            session.commit()
+        if pool is None:
+            pool = WorkerPool(load_notebook, 5 * 60, processes)
+        extract_repositories(session, status, query, skip_if_error, pool, check)
+        if check_exit(check):
+            break
+    if pool is not None:
+        pool.close()
 
 
 def main():
@@ -316,6 +405,8 @@ def main():
                         help="count results")
     parser.add_argument('-r', '--reverse', action='store_true',
                         help='iterate in reverse order')
+    parser.add_argument("-p", "--processes", type=int, default=config.PROCESSES,
+                        help="number of processes that load notebooks")
     parser.add_argument('--check', type=str, nargs='*',
                         default={'all', script_name, script_name + '.py'},
                         help='check name in .exit')
@@ -334,7 +425,8 @@ def main():
             args.count,
             args.interval,
             args.reverse,
-            set(args.check)
+            set(args.check),
+            args.processes
         )
 
 if __name__ == "__main__":
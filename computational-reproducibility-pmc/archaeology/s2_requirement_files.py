@@ -1,6 +1,7 @@
 """Load notebook and cells"""
 import argparse
 import tarfile
+import zipfile
 import os
 import chardet
 
@@ -9,28 +10,22 @@ import consts
 
 from db import RequirementFile, Repository, connect
 from utils import vprint, join_paths, StatusLogger, check_exit, savepid
-from utils import find_files_in_path, find_files_in_zip, mount_basedir
-from config import Path
+from utils import mount_basedir
+from repository_content import repository_content
 
 
-def process_requirement_file(session, repository, reqformat, skip_if_error=consts.R_REQUIREMENTS_ERROR):
-    """Process requirement file"""
+REQUIREMENT_FORMATS = ["setup.py", "requirements.txt", "Pipfile", "Pipfile.lock"]
+
+
+def process_requirement_file(session, repository, reqformat, skip_if_error=consts.R_REQUIREMENTS_ERROR, content=None):
+    """Process requirement file
+    content is the RepositoryContent used to read files"""
     MAP = {
         "setup.py": "setup",
         "requirements.txt": "requirement",
         "Pipfile": "pipfile",
         "Pipfile.lock": "pipfile_lock"
     }
-    zip_path = None
-    tarzip = None
-    if not repository.path.exists():
-        if not repository.zip_path.exists():
-            repository.processed |= consts.R_UNAVAILABLE_FILES
-            session.add(repository)
-            vprint(1, "Failed to load requirement {} due <repository not found>".format(reqformat))
-            return False
-        tarzip =  tarfile.open(str(repository.zip_path))
-        zip_path = Path(repository.hash_dir2)
     finished = True
     req_param = MAP[reqformat] + "_names"
     for name in getattr(repository, req_param):
@@ -38,30 +33,28 @@ def process_requirement_file(session, repository, reqformat, skip_if_error=const
             continue
         try:
             vprint(2, "Loading requirement {}".format(name))
-            if tarzip:
-                content = tarzip.extractfile(tarzip.getmember(str(zip_path / name))).read()
-            else:
-                with open(str(repository.path / name), "rb") as ofile:
-                    content = ofile.read()
+            if content is None:
+                content = repository_content(session, repository, ("directory",))
+            data = content.read(name)
 
-            coding = chardet.detect(content)
+            coding = chardet.detect(data)
             if coding["encoding"] is None:
                 vprint(3, "Codec not detected")
                 continue
             try:
-                content = content.decode(coding['encoding'])
+                data = data.decode(coding['encoding'])
             except UnicodeDecodeError:
                 vprint(3, "Invalid codec")
                 continue
 
-            if '\0' in content:
+            if '\0' in data:
                 vprint(3, "NULL byte in content")
                 continue
             requirement_file = RequirementFile(
                 repository_id=repository.id,
                 name=name,
                 reqformat=reqformat,
-                content=content,
+                content=data,
                 processed=consts.F_OK,
             )
             session.add(requirement_file)
@@ -73,47 +66,44 @@ def process_requirement_file(session, repository, reqformat, skip_if_error=const
                 import traceback
                 traceback.print_exc()
             finished = False
-    if tarzip:
-        tarzip.close()
     return finished
 
 
-def collect_requirements(session, repository):
-    if repository.path.exists():
-        vprint(2, "using path")
-        setups, requirements, pipfiles, pipfile_locks = find_files_in_path(
-            repository.path, [
-                "setup.py", "requirements.txt", "Pipfile", "Pipfile.lock"
-            ]
-        )
-        changed = True
-    elif repository.zip_path.exists():
-        vprint(2, "using zip")
-        with tarfile.open(str(repository.zip_path)) as tarzip:
-            setups, requirements, pipfiles, pipfile_locks = find_files_in_zip(
-                tarzip, Path(repository.hash_dir2), [
-                    "setup.py", "requirements.txt", "Pipfile", "Pipfile.lock"
-                ]
-            )
-        changed = True
-    else:
+def collect_requirements(session, repository, skip_if_error=consts.R_REQUIREMENTS_ERROR):
+    """Rebuild requirement file lists
+    Compressed repositories are read in a single streaming pass that also
+    keeps the contents of their requirement files. Like every scan, it
+    skips .git, which has no working tree files.
+    Returns the RepositoryContent or None if it is not available"""
+    content = repository_content(session, repository, ("directory", "archive"))
+    if content is None:
         vprint(2, "not found")
         repository.processed |= consts.R_UNAVAILABLE_FILES
-        changed = False
+        session.add(repository)
+        return None
+    vprint(2, "using {}".format(content.kind))
+    try:
+        setups, requirements, pipfiles, pipfile_locks = content.scan(
+            REQUIREMENT_FORMATS
+        )
+    except (OSError, tarfile.TarError, zipfile.BadZipfile) as err:
+        vprint(1, "Failed to read archive due {!r}".format(err))
+        repository.processed |= skip_if_error
+        session.add(repository)
+        return None
 
-    if changed:
-        repository.setups_count = len(setups)
-        repository.requirements_count=len(requirements)
-        repository.pipfiles_count = len(pipfiles)
-        repository.pipfile_locks_count = len(pipfile_locks)
+    repository.setups_count = len(setups)
+    repository.requirements_count=len(requirements)
+    repository.pipfiles_count = len(pipfiles)
+    repository.pipfile_locks_count = len(pipfile_locks)
 
-        repository.setups = join_paths(setups)
-        repository.requirements = join_paths(requirements)
-        repository.pipfiles = join_paths(pipfiles)
-        repository.pipfile_locks = join_paths(pipfile_locks)
+    repository.setups = join_paths(setups)
+    repository.requirements = join_paths(requirements)
+    repository.pipfiles = join_paths(pipfiles)
+    repository.pipfile_locks = join_paths(pipfile_locks)
 
     session.add(repository)
-    session.commit()
+    return content
 
 
 def process_repository(session, repository, skip_if_error=consts.R_REQUIREMENTS_ERROR):
@@ -124,12 +114,15 @@ def process_repository(session, repository, skip_if_error=consts.R_REQUIREMENTS_
         session.add(repository)
         repository.processed -= skip_if_error
 
-    finished = True
+    content = collect_requirements(session, repository, skip_if_error)
+    if content is None:
+        return "Failed to load requirements due <repository not found>"
 
-    finished &= process_requirement_file(session, repository, "setup.py", skip_if_error)
-    finished &= process_requirement_file(session, repository, "requirements.txt", skip_if_error)
-    finished &= process_requirement_file(session, repository, "Pipfile", skip_if_error)
-    finished &= process_requirement_file(session, repository, "Pipfile.lock", skip_if_error)
+    finished = True
+    for reqformat in REQUIREMENT_FORMATS:
+        finished &= process_requirement_file(
+            session, repository, reqformat, skip_if_error, content
+        )
 
     if finished and not repository.processed & skip_if_error:
 
@@ -1,17 +1,251 @@
 """Remove processed notebooks from disk"""
 import argparse
+import math
+import random
 import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
 import config
 import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing.pool import ThreadPool
 
+from sqlalchemy import or_
+
+import archives
 import consts
-from db import Repository, Notebook, connect
+from db import Repository, Notebook, connect, save_manifest
 from utils import vprint, StatusLogger, mount_basedir, check_exit, savepid
+from object_store import detach
+
+
+
+def task_row(repository):
+    """Return the columns that workers need to compress a repository"""
+    return {
+        "id": repository.id,
+        "domain": repository.domain,
+        "repository": repository.repository,
+        "hash_dir1": repository.hash_dir1,
+        "hash_dir2": repository.hash_dir2,
+        "commit": repository.commit,
+        "processed": repository.processed,
+        "compression": repository.compression,
+    }
+
+
+def detached(repository):
+    """Return a transient copy of repository with the task_row columns
+    Session commits do not expire it, so reading it does not query the DB"""
+    return Repository(**task_row(repository))
+
+
+def failed_results(rows):
+    """Return compress_repository results that mark rows as errors"""
+    return [
+        (row["id"], row["processed"] | consts.R_COMPRESS_ERROR, row["compression"], None)
+        for row in rows
+    ]
+
+
+def compress_repository(row, keep, backend):
+    """Compress a repository described by task_row in a worker process
+    Returns (id, processed, compression, manifest). manifest holds the
+    RepositoryFile entries of a new archive or None"""
+    repository = Repository(**row)
+    manifest = None
+    vprint(0, "Compressing {}".format(repository))
+    vprint(1, "Into {}".format(repository.zip_path))
+    try:
+        if repository.path.exists():
+            commit = repository.get_commit()
+            if commit != repository.commit:
+                repository.processed |= consts.R_COMMIT_MISMATCH
+            if detach(repository.path):
+                vprint(1, "Detached from object store")
+
+        repository.processed |= consts.R_COMPRESS_ERROR
+        exists = repository.zip_path.exists()
+        if not exists and not repository.processed & consts.R_EXTRACTED_FILES:
+            manifest = []
+        if exists or repository.compress(backend=backend, manifest=manifest):
+            if repository.processed & consts.R_COMPRESS_ERROR:
+                repository.processed -= consts.R_COMPRESS_ERROR
+            if not keep:
+                shutil.rmtree(str(repository.path), ignore_errors=True)
+        elif not repository.zip_path.exists():
+            if repository.processed & consts.R_COMPRESS_ERROR:
+                repository.processed -= consts.R_COMPRESS_ERROR
+            if not repository.path.exists():
+                repository.processed |= consts.R_UNAVAILABLE_FILES
+            vprint(1, "{} failed".format(repository))
+        if repository.zip_path.exists():
+            vprint(1, "{} ok".format(repository))
+            repository.processed |= consts.R_COMPRESS_OK
+    except Exception as err:
+        vprint(1, "{} failed: {}".format(repository, err))
+    if not repository.processed & consts.R_COMPRESS_OK:
+        manifest = None
+    return row["id"], repository.processed, repository.compression, manifest
+
+
+def compress_batch(batch, keep, backend):
+    """Compress a batch of repositories in a worker process"""
+    return [compress_repository(row, keep, backend) for row in batch]
+
 
+def repository_size(repository):
+    """Return the size in bytes of the uncompressed repository"""
+    total = 0
+    stack = [str(repository.path)]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    total += entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                pass
+    return total
+
+
+def disk_throughput(repositories, directory, limit=64 * 2 ** 20):
+    """Measure read throughput of repository files in MB/s
+    Copies the files it reads into directory as a sample for
+    compressor_throughput. Returns None if it reads less than 1 MB"""
+    read = 0
+    start = time.time()
+    for repository in repositories:
+        target = os.path.join(directory, repository.hash_dir2)
+        for root, _, files in os.walk(str(repository.path)):
+            for name in files:
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    continue
+                try:
+                    with open(path, "rb") as fil:
+                        data = fil.read(limit - read)
+                except (IOError, OSError):
+                    continue
+                read += len(data)
+                relative = os.path.relpath(path, str(repository.path))
+                os.makedirs(os.path.dirname(os.path.join(target, relative)), exist_ok=True)
+                with open(os.path.join(target, relative), "wb") as out:
+                    out.write(data)
+                if read >= limit:
+                    break
+            if read >= limit:
+                break
+        if read >= limit:
+            break
+    elapsed = time.time() - start
+    if read < 2 ** 20 or not elapsed:
+        return None
+    return read / 2 ** 20 / elapsed
+
+
+def compressor_throughput(backend, directory):
+    """Measure single-threaded compression throughput of the sample in MB/s"""
+    if not backend.compressor:
+        return None
+    raw = directory + ".tar"
+    try:
+        with tarfile.open(raw, "w") as out:
+            out.add(directory, arcname=".")
+        elapsed, _ = measure(archives.with_threads(backend, 1).compressor, raw)
+        size = os.path.getsize(raw) / 2 ** 20
+    except EnvironmentError as err:
+        vprint(1, "Compressor benchmark failed: {}".format(err))
+        return None
+    finally:
+        if os.path.exists(raw):
+            os.remove(raw)
+    if size < 1 or not elapsed:
+        return None
+    return size / elapsed
+
+
+def plan_jobs(backend, repositories):
+    """Return (jobs, threads per job) for the available cores
+    A single-threaded compressor reads at cpu MB/s, so disk / cpu jobs
+    saturate the disk. Cores left over become compressor threads"""
+    cores = config.PROCESSES
+    directory = tempfile.mkdtemp()
+    try:
+        disk = disk_throughput(repositories, os.path.join(directory, "sample"))
+        cpu = compressor_throughput(backend, os.path.join(directory, "sample")) if disk else None
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    if disk and cpu:
+        jobs = min(cores, max(1, int(math.ceil(disk / cpu))))
+        vprint(0, "Disk: {:.1f} MB/s. Compressor: {:.1f} MB/s per thread".format(disk, cpu))
+    else:
+        jobs = cores
+    return jobs, max(1, cores // jobs)
 
 
-def apply(session, status, keep, count, interval, reverse, check):
-    """Compress repositories"""
+def measure_sizes(repositories, check):
+    """Return {id: size} of repositories
+    Returns None if an .exit file appears during the pass"""
+    sizes = {}
+    pool = ThreadPool(max(config.PROCESSES, 4))
+    try:
+        results = pool.imap(repository_size, repositories, chunksize=8)
+        for index, (repository, size) in enumerate(zip(repositories, results)):
+            if index % 100 == 0 and check_exit(check):
+                vprint(0, "Found .exit file. Exiting")
+                return None
+            sizes[repository.id] = size
+    finally:
+        pool.terminate()
+    return sizes
+
+
+def load_repositories(session, ids, chunk=100):
+    """Load detached copies of repositories of ids in their order, chunk by chunk
+    Copies are made before the caller commits, which would expire the chunk"""
+    for start in range(0, len(ids), chunk):
+        part = ids[start:start + chunk]
+        loaded = {
+            repository.id: detached(repository)
+            for repository in session.query(Repository).filter(Repository.id.in_(part))
+        }
+        for id_ in part:
+            if id_ in loaded:
+                yield loaded[id_]
+
+
+def make_batches(repositories, size, batch_size):
+    """Group consecutive repositories until they reach batch_size bytes
+    size(repository) runs when the repository joins a batch"""
+    batch, total = [], 0
+    for repository in repositories:
+        batch.append(repository)
+        total += size(repository)
+        if total >= batch_size:
+            yield batch
+            batch, total = [], 0
+    if batch:
+        yield batch
+
+
+def apply(session, status, keep, count, interval, reverse, check,
+          jobs=0, order="large", batch_mb=16):
+    """Compress repositories concurrently
+    Workers compress batches of repositories. The main process is the only
+    DB writer: it bulk updates the results of each batch and bulk inserts
+    the file manifests that workers collect while writing the archives.
+    Repositories of batches that fail are marked with R_COMPRESS_ERROR.
+    Only the large and small orders measure all repositories first. The id
+    order streams repositories and measures them as they join batches"""
     filters = [
         Repository.processed.op('&')(consts.R_COMPRESS_OK) == 0,
     ]
@@ -34,35 +268,115 @@ def apply(session, status, keep, count, interval, reverse, check):
             Repository.id.asc()
         )
 
+    with mount_basedir():
+        ids = [id_ for id_, in query.with_entities(Repository.id)]
+        if order == "id":
+            repositories = load_repositories(session, ids)
+            size = repository_size
+            sample = list(load_repositories(session, ids[:100]))
+        else:
+            repositories = list(load_repositories(session, ids))
+            sizes = measure_sizes(repositories, check)
+            if sizes is None:
+                return
+            repositories.sort(
+                key=lambda repository: sizes[repository.id],
+                reverse=order == "large"
+            )
+            size = lambda repository: sizes[repository.id]
+            sample = [repository for repository in repositories if sizes[repository.id]]
+        backend = archives.get_backend()
+        if jobs:
+            threads = max(1, config.PROCESSES // jobs)
+        else:
+            jobs, threads = plan_jobs(backend, sample)
+        backend = archives.with_threads(backend, threads)
+        vprint(0, "Repositories: {}. Jobs: {}. Threads per job: {}".format(
+            len(ids), jobs, threads
+        ))
+        by_id = {}
+        batches = make_batches(repositories, size, batch_mb * 2 ** 20)
+        with ProcessPoolExecutor(jobs) as executor:
+            running = {}
+            exhausted = False
+            while True:
+                while not exhausted and len(running) < 2 * jobs:
+                    if check_exit(check):
+                        vprint(0, "Found .exit file. Exiting")
+                        exhausted = True
+                        break
+                    batch = next(batches, None)
+                    if batch is None:
+                        exhausted = True
+                        break
+                    by_id.update((repository.id, repository) for repository in batch)
+                    rows = [task_row(repository) for repository in batch]
+                    running[executor.submit(compress_batch, rows, keep, backend)] = rows
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    rows = running.pop(future)
+                    try:
+                        results = future.result()
+                    except Exception as err:
+                        vprint(0, "Batch failed: {}".format(err))
+                        results = failed_results(rows)
+                    updates = []
+                    for id_, processed, compression, manifest in results:
+                        repository = by_id.pop(id_)
+                        if manifest is not None:
+                            save_manifest(session, repository, manifest)
+                            processed |= consts.R_EXTRACTED_FILES
+                        updates.append({
+                            "id": id_, "processed": processed, "compression": compression,
+                        })
+                        status.count += 1
+                    session.bulk_update_mappings(Repository, updates)
+                    status.report()
+                    session.commit()
+
+
+def migrate(session, status, count, interval, reverse, check):
+    """Convert archives of other backends into config.COMPRESSION
+    Archives of the same format are recorded without rewriting them"""
+    backend = archives.get_backend()
+    filters = [
+        Repository.processed.op('&')(consts.R_COMPRESS_OK) != 0,
+        or_(Repository.compression.is_(None), Repository.compression != backend.name),
+    ]
+    if interval:
+        filters += [
+            Repository.id >= interval[0],
+            Repository.id <= interval[1],
+        ]
+    query = session.query(Repository).filter(*filters)
+    if count:
+        print(query.count())
+        return
+    query = query.order_by(Repository.id.desc() if reverse else Repository.id.asc())
+
     for repository in query:
         if check_exit(check):
             vprint(0, "Found .exit file. Exiting")
             return
         status.report()
-        vprint(0, "Compressing {}".format(repository))
-        vprint(1, "Into {}".format(repository.zip_path))
+        vprint(0, "Migrating {}".format(repository))
         with mount_basedir():
+            source = repository.zip_path
+            target = archives.archive_path(repository.path, backend.suffix)
             try:
-                if repository.path.exists():
-                    commit = repository.get_commit()
-                    if commit != repository.commit:
-                        repository.processed |= consts.R_COMMIT_MISMATCH
-
-                repository.processed |= consts.R_COMPRESS_ERROR
-                if repository.zip_path.exists() or repository.compress():
-                    if repository.processed & consts.R_COMPRESS_ERROR:
-                        repository.processed -= consts.R_COMPRESS_ERROR
-                    if not keep:
-                        shutil.rmtree(str(repository.path), ignore_errors=True)
-                elif not repository.zip_path.exists():
-                    if repository.processed & consts.R_COMPRESS_ERROR:
-                        repository.processed -= consts.R_COMPRESS_ERROR
-                    if not repository.path.exists():
-                        repository.processed |= consts.R_UNAVAILABLE_FILES
-                    vprint(1, "failed")
-                if repository.zip_path.exists():
-                    vprint(1, "ok")
-                    repository.processed |= consts.R_COMPRESS_OK
+                if not source.exists():
+                    vprint(1, "Archive not found")
+                elif str(source) == str(target) and repository.compression is None:
+                    vprint(1, "Same format. Recording {}".format(backend.name))
+                    repository.compression = backend.name
+                else:
+                    vprint(1, "Into {}".format(target))
+                    archives.recompress(source, target, backend)
+                    repository.compression = backend.name
+                    if str(source) != str(target):
+                        source.unlink()
             except Exception as err:
                 vprint(1, "Failed: {}".format(err))
         session.add(repository)
@@ -70,6 +384,150 @@ def apply(session, status, keep, count, interval, reverse, check):
         session.commit()
 
 
+# Runs a command and writes its status, seconds and peak RSS in KB to argv[1].
+# The kernel keeps the peak RSS of the process before exec, so commands are
+# started from this small interpreter instead of the benchmark process
+RUSAGE = """
+import os, sys, time
+start = time.time()
+pid = os.fork()
+if not pid:
+    os.execvp(sys.argv[2], sys.argv[2:])
+_, status, usage = os.wait4(pid, 0)
+with open(sys.argv[1], "w") as out:
+    out.write("{} {} {}".format(status, time.time() - start, usage.ru_maxrss))
+"""
+
+
+def measure(cmd, source=None, target=None):
+    """Run command with source as stdin and target as stdout
+    Returns the elapsed seconds and the peak resident memory in MB"""
+    with tempfile.NamedTemporaryFile("r") as result, \
+            open(source or os.devnull, "rb") as src, \
+            open(target or os.devnull, "wb") as dst:
+        subprocess.check_call(
+            [sys.executable, "-S", "-c", RUSAGE, result.name] + cmd,
+            stdin=src, stdout=dst, stderr=subprocess.DEVNULL
+        )
+        status, elapsed, rss = result.read().split()
+    if int(status) != 0:
+        raise EnvironmentError("{} failed".format(" ".join(cmd[:3])))
+    return float(elapsed), int(rss) / 1024.0
+
+
+def write_tar(repository, target):
+    """Write the uncompressed tar of a repository
+    Returns False if the repository is not available"""
+    if repository.path.exists():
+        with tarfile.open(target, "w") as out:
+            out.add(str(repository.path), arcname=repository.hash_dir2)
+    elif repository.zip_path.exists() and (
+            archives.archive_format(repository.zip_path) not in archives.ARCHIVES):
+        archives.unpack(repository.zip_path, target)
+    elif repository.zip_path.exists():
+        directory = tempfile.mkdtemp()
+        try:
+            archives.extract(repository.zip_path, directory, copy=True)
+            with tarfile.open(target, "w") as out:
+                out.add(os.path.join(directory, repository.hash_dir2), arcname=repository.hash_dir2)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    else:
+        return False
+    return True
+
+
+def benchmark_backend(backend, raw):
+    """Compress and decompress an uncompressed tar with a backend
+    Returns compressed size, compress and decompress (seconds, MB RSS)"""
+    target = archives.converted_path(raw, backend)
+    try:
+        if backend.compressor:
+            compressed = measure(backend.compressor, raw, target)
+        else:
+            compressed = measure(archives.command("convert", raw, "-b", backend.name))
+        size = os.path.getsize(target)
+        if backend.decompressor:
+            decompressed = measure(backend.decompressor + [target])
+        else:
+            decompressed = measure(archives.command(
+                "unpack", target, os.devnull, "-b", backend.name
+            ))
+    finally:
+        if os.path.exists(target):
+            os.remove(target)
+    return size, compressed, decompressed
+
+
+def benchmark(session, sample, names, interval):
+    """Compare compression backends on a sample of repositories
+    Reports compression ratio, compress and decompress throughput of the
+    uncompressed tar, and peak RSS. Python backends include the interpreter
+    and every command includes the RSS of a minimal Python process"""
+    backends = []
+    for name in names:
+        backend = archives.get_backend(name)
+        if backend.compressor and not archives.installed(backend.compressor):
+            vprint(0, "{}: {} not installed".format(name, backend.compressor[0]))
+        elif backend.name == "python-zstd" and archives.zstandard is None:
+            vprint(0, "{}: zstandard module not installed".format(name))
+        elif backend.suffix == "blobs":
+            vprint(0, "{}: deduplicates across repositories. See blob_store.py report".format(name))
+        else:
+            backends.append(backend)
+    query = session.query(Repository.id)
+    if interval:
+        query = query.filter(Repository.id >= interval[0], Repository.id <= interval[1])
+    ids = sorted(id_ for (id_,) in query)
+    random.Random(0).shuffle(ids)
+
+    totals = {backend.name: [0, 0.0, 0.0, 0.0, 0.0] for backend in backends}
+    raw_size = used = 0
+    directory = tempfile.mkdtemp()
+    try:
+        for id_ in ids:
+            if used >= sample:
+                break
+            repository = session.query(Repository).filter(Repository.id == id_).first()
+            raw = os.path.join(directory, "{}.tar".format(repository.hash_dir2))
+            with mount_basedir():
+                if not write_tar(repository, raw):
+                    continue
+            used += 1
+            raw_size += os.path.getsize(raw)
+            vprint(1, "{}: {:.1f} MB".format(repository, os.path.getsize(raw) / 2 ** 20))
+            for backend in backends:
+                try:
+                    size, compressed, decompressed = benchmark_backend(backend, raw)
+                except EnvironmentError as err:
+                    vprint(1, "{} failed: {}".format(backend.name, err))
+                    continue
+                total = totals[backend.name]
+                total[0] += size
+                total[1] += compressed[0]
+                total[2] += decompressed[0]
+                total[3] = max(total[3], compressed[1])
+                total[4] = max(total[4], decompressed[1])
+            os.remove(raw)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    megabytes = raw_size / 2 ** 20
+    vprint(0, "Repositories: {}. Uncompressed: {:.1f} MB".format(used, megabytes))
+    vprint(0, "{:<14} {:>7} {:>12} {:>12} {:>10} {:>10}".format(
+        "backend", "ratio", "comp MB/s", "decomp MB/s", "comp RSS", "decomp RSS"
+    ))
+    for backend in backends:
+        size, compress_time, decompress_time, compress_rss, decompress_rss = totals[backend.name]
+        if not size:
+            continue
+        vprint(0, "{:<14} {:>7.2f} {:>12.1f} {:>12.1f} {:>8.1f}MB {:>8.1f}MB".format(
+            backend.name, raw_size / size,
+            megabytes / compress_time, megabytes / decompress_time,
+            compress_rss, decompress_rss
+        ))
+
+
 def main():
     """Main function"""
     script_name = os.path.basename(__file__)[:-3]
@@ -79,7 +537,14 @@ def main():
                         help="increase output verbosity")
     parser.add_argument("-z", "--compression", type=str,
                         default=config.COMPRESSION,
-                        help="compression algorithm")
+                        help="compression backend: {}".format(", ".join(archives.BACKENDS)))
+    parser.add_argument("-m", "--migrate", action='store_true',
+                        help="convert archives of other backends")
+    parser.add_argument("-b", "--benchmark", type=int, default=0,
+                        help="compare backends on a sample of repositories")
+    parser.add_argument("--backends", type=str, nargs="+",
+                        default=list(archives.BACKENDS),
+                        help="backends of the benchmark")
     parser.add_argument("-e", "--retry-errors", action='store_true',
                         help="retry errors")
     parser.add_argument("-i", "--interval", type=int, nargs=2,
@@ -91,6 +556,13 @@ def main():
                         help='iterate in reverse order')
     parser.add_argument('-k', '--keep-uncompressed', action='store_true',
                         help='keep uncompressed files')
+    parser.add_argument("-j", "--jobs", type=int, default=0,
+                        help="concurrent compressions. 0 sizes them by cores and disk throughput")
+    parser.add_argument("--order", type=str, default="large",
+                        choices=["large", "small", "id"],
+                        help="compress large or small repositories first, or by id")
+    parser.add_argument("--batch-mb", type=int, default=16,
+                        help="group small repositories into batches of this size")
     parser.add_argument('--check', type=str, nargs='*',
                         default={'all', script_name, script_name + '.py'},
                         help='check name in .exit')
@@ -104,6 +576,15 @@ def main():
 
     config.COMPRESSION = args.compression
     with connect() as session, savepid():
+        if args.benchmark:
+            benchmark(session, args.benchmark, args.backends, args.interval)
+            return
+        if args.migrate:
+            migrate(
+                session, status, args.count, args.interval,
+                args.reverse, set(args.check)
+            )
+            return
         apply(
             session,
             status,
@@ -111,7 +592,10 @@ def main():
             args.count,
             args.interval,
             args.reverse,
-            set(args.check)
+            set(args.check),
+            args.jobs,
+            args.order,
+            args.batch_mb,
         )
 
 if __name__ == "__main__":
@@ -1,19 +1,28 @@
 """Load markdown features"""
 import argparse
+import json
 import os
+import random
 import sys
+import time
+from collections import deque
+from functools import lru_cache
+from itertools import groupby
 
 import mistune
 
 from nbconvert.filters.markdown_mistune import MarkdownWithMath
-from langdetect import detect
+from langdetect import detect, detect_langs, DetectorFactory
+from langdetect.lang_detect_exception import LangDetectException
 from nltk.corpus import stopwords
 
 import config
 import consts
 
 from db import Cell, Notebook, MarkdownFeature, connect
+from feature_cache import get_cache, hit_rate
 from utils import vprint, StatusLogger, check_exit, savepid
+from workers import WorkerPool
 
 
 # Map based on stopwords.fileids() and !ls $langdetect.PROFILES_DIRECTORY
@@ -41,6 +50,14 @@ LANG_MAP = {
     'tr': 'turkish',
 }
 
+# langdetect is random by default. A fixed seed makes results reproducible
+DetectorFactory.seed = 0
+
+# Notebooks whose most probable language is below this are mixed
+MIXED_THRESHOLD = 0.9
+
+UNDETECTED = ('undetected', frozenset(), False)
+
 
 class CountRenderer(mistune.Renderer):
 
@@ -331,16 +348,48 @@ class CountRenderer(mistune.Renderer):
         return text
 
 
-def extract_features(text):
-    """Extract Markdown Features from text"""
+@lru_cache(maxsize=None)
+def language_info(code):
+    """Return (language, stopwords frozenset, using_stopwords) of a langdetect code"""
     language = 'undetected'
     try:
-        language = LANG_MAP[detect(text)]
-        stopwords_set = stopwords.words(language)
-        using_stopwords = True
+        language = LANG_MAP[code]
+        return language, frozenset(stopwords.words(language)), True
     except Exception:
-        stopwords_set = set()
-        using_stopwords = False
+        return language, frozenset(), False
+
+
+def detect_language(text):
+    """Detect language of text. Returns language_info"""
+    try:
+        return language_info(detect(text))
+    except LangDetectException:
+        return UNDETECTED
+
+
+def notebook_languages(texts):
+    """Return language_info for each markdown text of a notebook
+    The language is detected once from the concatenated texts. Mixed
+    notebooks detect the language of each text. Texts without letters
+    have no language"""
+    with_letters = [any(char.isalpha() for char in text) for text in texts]
+    try:
+        best = detect_langs("\n\n".join(texts))[0]
+    except LangDetectException:
+        return [UNDETECTED] * len(texts)
+    if best.prob < MIXED_THRESHOLD:
+        return [
+            detect_language(text) if letters else UNDETECTED
+            for text, letters in zip(texts, with_letters)
+        ]
+    detected = language_info(best.lang)
+    return [detected if letters else UNDETECTED for letters in with_letters]
+
+
+def extract_features(text, language=None):
+    """Extract Markdown Features from text
+    language is a language_info. It is detected from text if it is None"""
+    language, stopwords_set, using_stopwords = language or detect_language(text)
 
     renderer = CountRenderer(language, stopwords_set, using_stopwords)
     markdown = MarkdownWithMath(renderer=renderer, escape=False)
@@ -359,45 +408,234 @@ def extract_features(text):
     return renderer.counter
 
 
-def process_markdown_cell(
-    session, repository_id, notebook_id, cell,
-    skip_if_error=consts.C_PROCESS_ERROR
-):
-    """Process Markdown Cell to collect features"""
-    if cell.processed & consts.C_PROCESS_OK:
-        return 'already processed'
-
-    if not skip_if_error and cell.processed & consts.C_PROCESS_ERROR:
-        markdown_features = session.query(MarkdownFeature).filter(
-            MarkdownFeature.cell_id == cell.id
-        ).first()
-        if markdown_features:
-            session.delete(markdown_features)
-            session.commit()
-        cell.processed -= consts.C_PROCESS_ERROR
-        session.add(cell)
+class Summary(object):
+    """Length, lines, words and stopwords of a rendered string
+    Adding summaries joins the words at their boundary as str.split() does
+    on the joined strings, so each string is split only once"""
+    __slots__ = (
+        'length', 'newlines', 'words', 'stopwords', 'head', 'tail', 'solid', 'stopset'
+    )
 
-    try:
-        data = extract_features(cell.source)
-        data['repository_id'] = repository_id
-        data['notebook_id'] = notebook_id
-        data['cell_id'] = cell.id
-        data['index'] = cell.index
-        session.add(MarkdownFeature(**data))
-        cell.processed |= consts.C_PROCESS_OK
-        return 'done'
-    except Exception as err:
-        cell.processed |= consts.C_PROCESS_ERROR
-        if config.VERBOSE > 4:
-            import traceback
-            traceback.print_exc()
-        return 'Failed to process ({})'.format(err)
-    finally:
-        session.add(cell)
-
-
-def apply(session, status, skip_if_error, count, interval, reverse, check):
-    """Extract markdown features"""
+    def __init__(self, text='', stopset=frozenset()):
+        words = text.split()
+        self.length = len(text)
+        self.newlines = text.count('\n')
+        self.words = len(words)
+        self.stopwords = sum(map(stopset.__contains__, words)) if stopset else 0
+        self.head = words[0] if words and not text[0].isspace() else None
+        self.tail = words[-1] if words and not text[-1].isspace() else None
+        self.solid = self.words == 1 and self.head is not None and self.tail is not None
+        self.stopset = stopset
+
+    def __len__(self):
+        return self.length
+
+    def __add__(self, other):
+        if not isinstance(other, Summary):
+            other = Summary(other, self.stopset)
+        if not other.length:
+            return self
+        if not self.length:
+            return other
+        result = Summary.__new__(Summary)
+        result.length = self.length + other.length
+        result.newlines = self.newlines + other.newlines
+        result.words = self.words + other.words
+        result.stopwords = self.stopwords + other.stopwords
+        result.head = self.head
+        result.tail = other.tail
+        result.solid = False
+        result.stopset = self.stopset
+        if self.tail is not None and other.head is not None:
+            joined = self.tail + other.head
+            stopset = self.stopset
+            result.words -= 1
+            result.stopwords += (
+                (joined in stopset) - (self.tail in stopset) - (other.head in stopset)
+            )
+            if self.solid:
+                result.head = joined
+            if other.solid:
+                result.tail = joined
+            result.solid = self.solid and other.solid
+        return result
+
+    def __radd__(self, other):
+        return Summary(other, self.stopset) + self
+
+
+class TokenCounter(CountRenderer):
+    """CountRenderer that produces Summary values instead of strings
+    Spans are split into words once and nested elements add the summaries
+    of their children"""
+
+    def placeholder(self):
+        return Summary('', self.stopwords)
+
+    def summary(self, value):
+        """Return Summary of a string or Summary"""
+        if isinstance(value, Summary):
+            return value
+        return Summary(value, self.stopwords)
+
+    def count_lines(self, category, value):
+        counter = self.counter
+        value = self.summary(value)
+        counter[category] += 1
+        counter['meaningful_words'] += value.words
+        counter['meaningful_stopwords'] += value.stopwords
+        counter[category + '_words'] += value.words
+        counter[category + '_stopwords'] += value.stopwords
+        counter[category + '_len'] += value.length
+        counter[category + '_lines'] += value.newlines + 1
+
+    def count_span(self, category, value):
+        counter = self.counter
+        value = self.summary(value)
+        counter[category] += 1
+        counter[category + '_words'] += value.words
+        counter[category + '_stopwords'] += value.stopwords
+        counter[category + '_len'] += value.length
+
+    def header(self, text, level, raw=None):
+        text = self.summary(text)
+        self.count_span('header', text)
+        self.count_lines('h{}'.format(level), text)
+        self.counter['header_lines'] += text.newlines + 1
+        return text
+
+    def footnote_item(self, key, text):
+        return self.placeholder()
+
+    def footnotes(self, text):
+        # mistune separates footnotes with an hrule
+        self.hrule()
+        return self.placeholder()
+
+
+COUNTER_TEMPLATE = CountRenderer('undetected', frozenset(), False).counter
+LINES_KEYS = tuple(key for key in COUNTER_TEMPLATE if key.endswith('_lines'))
+
+
+@lru_cache(maxsize=None)
+def token_parser(language):
+    """Return reusable TokenCounter and parser for a language_info"""
+    renderer = TokenCounter(*language)
+    return renderer, MarkdownWithMath(renderer=renderer, escape=False)
+
+
+def extract_token_features(text, language=None):
+    """Extract the features of extract_features in a single pass
+    TokenCounter accumulates them from the parser without building the
+    rendered text. language is detected from text if it is None"""
+    language = language or detect_language(text)
+    renderer, markdown = token_parser(language)
+    counter = renderer.counter = dict(COUNTER_TEMPLATE)
+    counter['language'] = language[0]
+    counter['using_stopwords'] = language[2]
+    markdown(text)
+    summary = Summary(text, language[1])
+    counter['len'] = summary.length
+    counter['lines'] = summary.newlines + 1
+    counter['words'] = summary.words
+    counter['stopwords'] = summary.stopwords
+    counter['meaningful_lines'] = sum(counter[key] for key in LINES_KEYS)
+    return counter
+
+
+EXTRACTORS = {
+    'render': extract_features,
+    'tokens': extract_token_features,
+}
+
+
+# Increase when the extractors change their results to invalidate cached features
+CACHE_VERSION = 1
+
+
+@lru_cache(maxsize=None)
+def named_language(name):
+    """Return language_info of a language name"""
+    code = next((code for code, language in LANG_MAP.items() if language == name), None)
+    return language_info(code)
+
+
+def cached_languages(texts):
+    """Return notebook_languages from the feature cache"""
+    cache = get_cache('markdown_languages', CACHE_VERSION)
+    source = json.dumps(texts)
+    names = cache.get(source)
+    if names is not None:
+        return [named_language(name) for name in names]
+    languages = notebook_languages(texts)
+    cache.put(source, [language[0] for language in languages])
+    return languages
+
+
+def extract_notebook(cells, extractor='tokens'):
+    """Extract features of the (cell_id, source) markdown cells of a notebook
+    Runs in workers. Features are cached by source and language.
+    Returns (cell_id, features or error message, cached) triples"""
+    extract = EXTRACTORS[extractor]
+    cache = get_cache('markdown_' + extractor, CACHE_VERSION)
+    languages = cached_languages([source for _, source in cells])
+    results = []
+    for (cell_id, source), language in zip(cells, languages):
+        features = cache.get(source, language[0])
+        if features is not None:
+            results.append((cell_id, features, True))
+            continue
+        try:
+            features = extract(source, language)
+            cache.put(source, features, language[0])
+            results.append((cell_id, features, False))
+        except Exception as err:
+            if config.VERBOSE > 4:
+                import traceback
+                traceback.print_exc()
+            results.append((cell_id, 'Failed to process ({})'.format(err), False))
+    return results
+
+
+def write_results(session, buffer):
+    """Bulk insert MarkdownFeature rows and bulk update Cell.processed
+    buffer holds (cell row, features or error message) pairs. Features of
+    retried cells are replaced"""
+    retried = []
+    features = []
+    cells = []
+    for cell, result in buffer:
+        processed = cell.processed
+        if processed & consts.C_PROCESS_ERROR:
+            retried.append(cell.id)
+            processed -= consts.C_PROCESS_ERROR
+        if isinstance(result, dict):
+            result['repository_id'] = cell.repository_id
+            result['notebook_id'] = cell.notebook_id
+            result['cell_id'] = cell.id
+            result['index'] = cell.index
+            features.append(result)
+            processed |= consts.C_PROCESS_OK
+        else:
+            processed |= consts.C_PROCESS_ERROR
+        cells.append({'id': cell.id, 'processed': processed})
+    if retried:
+        session.query(MarkdownFeature).filter(
+            MarkdownFeature.cell_id.in_(retried)
+        ).delete(synchronize_session=False)
+    session.bulk_insert_mappings(MarkdownFeature, features)
+    session.bulk_update_mappings(Cell, cells)
+    session.commit()
+    del buffer[:]
+
+
+def apply(
+    session, status, skip_if_error, count, interval, reverse, check,
+    processes=config.PROCESSES, chunksize=4, flush=500, extractor='tokens'
+):
+    """Extract markdown features
+    Workers receive the cells of chunksize notebooks at a time. The main
+    process writes results every flush cells and at the end of repositories"""
     filters = [
         Cell.processed.op('&')(consts.C_PROCESS_OK) == 0,
         Cell.processed.op('&')(skip_if_error) == 0,
@@ -410,7 +648,10 @@ def apply(session, status, skip_if_error, count, interval, reverse, check):
         ]
 
     query = (
-        session.query(Cell)
+        session.query(
+            Cell.id, Cell.repository_id, Cell.notebook_id, Cell.index,
+            Cell.processed, Cell.source
+        )
         .filter(*filters)
     )
 
@@ -431,27 +672,139 @@ def apply(session, status, skip_if_error, count, interval, reverse, check):
             Cell.index.asc(),
         )
 
+    queue = deque()
+
+    def tasks():
+        notebooks = groupby(query, lambda cell: (cell.repository_id, cell.notebook_id))
+        for _, cells in notebooks:
+            if check_exit(check):
+                vprint(0, 'Found .exit file. Exiting')
+                return
+            cells = list(cells)
+            queue.append(cells)
+            yield ([(cell.id, cell.source) for cell in cells], extractor), {}
+
+    buffer = []
     repository_id = None
-    notebook_id = None
-    for cell in query:
-        if check_exit(check):
-            vprint(0, 'Found .exit file. Exiting')
-            return
-        status.report()
-        if repository_id != cell.repository_id:
-            session.commit()
-            repository_id = cell.repository_id
-            vprint(0, 'Processing repository: {}'.format(repository_id))
-        if notebook_id != cell.notebook_id:
-            notebook_id = cell.notebook_id
-            vprint(1, 'Processing notebook: {}'.format(notebook_id))
-        vprint(2, 'Processing cell: {}/[{}]'.format(cell.id, cell.index))
-        result = process_markdown_cell(
-            session, repository_id, notebook_id, cell, skip_if_error
+    hits = misses = 0
+    with WorkerPool(extract_notebook, 5 * 60, processes, chunksize) as pool:
+        for success, results in pool.imap(tasks()):
+            cells = queue.popleft()
+            if repository_id != cells[0].repository_id:
+                write_results(session, buffer)
+                repository_id = cells[0].repository_id
+                vprint(0, 'Processing repository: {}'.format(repository_id))
+            vprint(1, 'Processing notebook: {}'.format(cells[0].notebook_id))
+            if not success:
+                results = [
+                    (cell.id, 'Failed to process ({})'.format(results), False)
+                    for cell in cells
+                ]
+            for cell, (_, result, cached) in zip(cells, results):
+                vprint(2, 'Processing cell: {}/[{}]'.format(cell.id, cell.index))
+                vprint(2, 'done' if isinstance(result, dict) else result)
+                buffer.append((cell, result))
+                hits += cached
+                misses += not cached
+                status.count += 1
+            status.report()
+            if len(buffer) >= flush:
+                write_results(session, buffer)
+    write_results(session, buffer)
+    vprint(0, hit_rate(hits, misses))
+
+
+BENCHMARK_WORDS = {
+    'english': (
+        'the of and to in is that for it with as was on be by this are '
+        'data model we use function value plot result training set load '
+        'example dataset figure table error mean notebook analysis'
+    ).split(),
+    'portuguese': (
+        'de a o que e do da em um para com uma os no se na por mais as '
+        'dados modelo resultado valor tabela exemplo arquivo analise'
+    ).split(),
+}
+
+
+def synthetic_notebooks(cells, per_notebook=20, seed=0):
+    """Return lists of markdown cells. One in five notebooks is mixed"""
+    rnd = random.Random(seed)
+    languages = sorted(BENCHMARK_WORDS)
+    notebooks = []
+    for index in range(0, cells, per_notebook):
+        language = rnd.choice(languages)
+        notebook = []
+        for position in range(min(per_notebook, cells - index)):
+            if index % (5 * per_notebook) == 0 and position % 2:
+                words = BENCHMARK_WORDS[languages[languages.index(language) - 1]]
+            else:
+                words = BENCHMARK_WORDS[language]
+            text = ' '.join(rnd.choice(words) for _ in range(rnd.randint(5, 60)))
+            notebook.append(rnd.choice([
+                '# {}', '{}', '* {}\n* {}', '**{}** and `{}`', '> {}',
+                '{} [link](http://example.com/{})', '| a | b |\n|---|---|\n| {} | {} |',
+                '```\n{}\n```\n$x^2$ {}', '1. {}\n2. *{}*',
+            ]).format(text, text[:20]))
+        notebooks.append(notebook)
+    return notebooks
+
+
+def benchmark(cells):
+    """Compare per-cell and per-notebook language detection on synthetic cells"""
+    notebooks = synthetic_notebooks(cells)
+    total = sum(len(notebook) for notebook in notebooks)
+    start = time.time()
+    for notebook in notebooks:
+        for text in notebook:
+            extract_features(text)
+    per_cell = time.time() - start
+    start = time.time()
+    for notebook in notebooks:
+        for text, language in zip(notebook, notebook_languages(notebook)):
+            extract_features(text, language)
+    per_notebook = time.time() - start
+    vprint(0, 'Cells: {}. Notebooks: {}'.format(total, len(notebooks)))
+    vprint(0, 'Per-cell detection: {:.1f} cells/s'.format(total / per_cell))
+    vprint(0, 'Per-notebook detection: {:.1f} cells/s'.format(total / per_notebook))
+    languages = [notebook_languages(notebook) for notebook in notebooks]
+    for name, extract in sorted(EXTRACTORS.items()):
+        start = time.time()
+        for notebook, notebook_language in zip(notebooks, languages):
+            for text, language in zip(notebook, notebook_language):
+                extract(text, language)
+        elapsed = time.time() - start
+        vprint(0, 'Extractor {} without detection: {:.1f} cells/s'.format(
+            name, total / elapsed
+        ))
+
+
+def parity(session, cells, interval):
+    """Compare the features of both extractors on markdown cells
+    Uses cells from the database and synthetic cells"""
+    query = session.query(Cell.id, Cell.source).filter(Cell.cell_type == 'markdown')
+    if interval:
+        query = query.filter(
+            Cell.repository_id >= interval[0],
+            Cell.repository_id <= interval[1],
         )
-        vprint(2, result)
-        status.count += 1
-    session.commit()
+    sources = [(cell_id, source) for cell_id, source in query.limit(cells)]
+    sources += [
+        ('synthetic', text)
+        for notebook in synthetic_notebooks(cells) for text in notebook
+    ]
+    mismatches = 0
+    for cell_id, source in sources:
+        language = detect_language(source)
+        expected = extract_features(source, language)
+        result = extract_token_features(source, language)
+        if expected != result:
+            mismatches += 1
+            vprint(1, 'Cell {}: {}'.format(cell_id, {
+                key: (value, result.get(key))
+                for key, value in expected.items() if value != result.get(key)
+            }))
+    vprint(0, 'Cells: {}. Mismatches: {}'.format(len(sources), mismatches))
 
 
 def main():
@@ -473,15 +826,30 @@ def main():
     parser.add_argument('--check', type=str, nargs='*',
                         default={'all', script_name, script_name + '.py'},
                         help='check name in .exit')
+    parser.add_argument('-p', '--processes', type=int, default=config.PROCESSES,
+                        help='number of processes that extract features')
+    parser.add_argument('-x', '--extractor', type=str, default='tokens',
+                        choices=sorted(EXTRACTORS),
+                        help='single-pass token counter or the CountRenderer render')
+    parser.add_argument('-t', '--parity', type=int, default=0,
+                        help='compare extractors on this many cells')
+    parser.add_argument('-b', '--benchmark', type=int, default=0,
+                        help='measure cells/s on this many synthetic cells')
 
     args = parser.parse_args()
     config.VERBOSE = args.verbose
+    if args.benchmark:
+        benchmark(args.benchmark)
+        return
     status = None
     if not args.count:
         status = StatusLogger(script_name)
         status.report()
 
     with connect() as session, savepid():
+        if args.parity:
+            parity(session, args.parity, args.interval)
+            return
         apply(
             session,
             status,
@@ -489,7 +857,9 @@ def main():
             args.count,
             args.interval,
             args.reverse,
-            set(args.check)
+            set(args.check),
+            args.processes,
+            extractor=args.extractor,
         )
 
 if __name__ == '__main__':
@@ -1,16 +1,18 @@
-"""Load markdown features"""
+"""Backfill RepositoryFile manifests of archives
+s3 writes the manifest while compressing. This script lists the members of
+archives compressed without it"""
 import argparse
 import os
 import sys
 import ast
-import tarfile
 import re
 
 import config
 import consts
-from db import Repository, RepositoryFile, connect
+from archives import manifest_entries
+from db import Repository, connect, save_manifest
 from utils import vprint, StatusLogger, check_exit, savepid, to_unicode
-from utils import mount_basedir, ignore_surrogates
+from utils import mount_basedir
 from future.utils.surrogateescape import register_surrogateescape
 
 def process_repository(session, repository, skip_if_error=consts.R_COMPRESS_ERROR):
@@ -25,23 +27,13 @@ def process_repository(session, repository, skip_if_error=consts.R_COMPRESS_ERRO
             raise Exception("Repository {} zip path not found: {}".format(
                 repository.id, repository.zip_path
             ))
-        tarzip = tarfile.open(str(repository.zip_path))
-        members = tarzip.getmembers()
-        repository_id = repository.id
-        for member in members:
-            info = member.get_info()
-            name = info['name']
-            if not name.startswith(repository.hash_dir2):
-                raise Exception("Repository {} - Invalid file in zip: {}".format(
-                    repository.id, name
-                ))
-            name, had_surrogates = ignore_surrogates(name)
-            session.add(RepositoryFile(
-                repository_id=repository_id,
-                path=name[(len(repository.hash_dir2) + 1):],
-                size=info['size'],
-                had_surrogates=had_surrogates
-            ))
+        with repository.open_archive() as archive:
+            members = archive.members()
+        try:
+            manifest = manifest_entries(members, repository.hash_dir2)
+        except ValueError as err:
+            raise Exception("Repository {} - {}".format(repository.id, err))
+        save_manifest(session, repository, manifest)
         repository.processed += consts.R_EXTRACTED_FILES
         session.add(repository)
         return "done"
@@ -4,11 +4,15 @@ import os
 import sys
 import ast
 import tarfile
+import zipfile
+import random
 import re
+import time
 
 import config
 import consts
 
+from ast import AST
 from contextlib import contextmanager
 from collections import Counter, OrderedDict, defaultdict
 from functools import wraps
@@ -17,12 +21,14 @@ from itertools import groupby
 from future.utils.surrogateescape import register_surrogateescape
 
 from db import Cell, CellFeature, CellModule, CellName, CodeAnalysis, connect
-from db import RepositoryFile
+from feature_cache import get_cache
 from utils import vprint, StatusLogger, check_exit, savepid, to_unicode
-from utils import get_pyexec, invoke, timeout, TimeoutError, SafeSession
-from utils import mount_basedir, ignore_surrogates
+from utils import get_pyexec, invoke, TimeoutError, SafeSession
+from utils import mount_basedir
+from workers import deadline
 
 from s5_extract_files import process_repository
+from repository_content import repository_content, clean
 
 
 class PathLocalChecker(object):
@@ -47,35 +53,44 @@ class PathLocalChecker(object):
         return True
 
 
-class SetLocalChecker(PathLocalChecker):
-    """Check if module is local by looking at a set"""
+class ContentLocalChecker(PathLocalChecker):
+    """Check if module is local with the path index of the repository content
+    Directory content checks the filesystem instead of walking it to build
+    the index"""
 
-    def __init__(self, dirset, notebook_path):
-        path = to_unicode(notebook_path)
-        self.base = os.path.dirname(path)
-        self.dirset = dirset
+    def __init__(self, content, notebook_name):
+        path = to_unicode(notebook_name)
+        self.content = content
+        self.base = clean(os.path.dirname(path))
+        self.index = None
+        if content.kind != "directory":
+            self.index = content.path_index()
 
     def exists(self, path):
-        path, _ = ignore_surrogates(path)
-        if path[0] == "/":
-            path = path[1:]
-        return path in self.dirset or (path + "/") in self.dirset
-
-
-class CompressedLocalChecker(PathLocalChecker):
-    """Check if module is local by looking at the zip file"""
+        if self.index is None:
+            return self.content.exists(path)
+        return self.index.exists(clean(path))
 
-    def __init__(self, tarzip, notebook_path):
-        path = to_unicode(notebook_path)
-        self.base = os.path.dirname(path)
-        self.tarzip = tarzip
-
-    def exists(self, path):
-        try:
-            self.tarzip.getmember(path)
-            return True
-        except KeyError:
-            return False
+    def is_local(self, module):
+        if self.index is None:
+            return super(ContentLocalChecker, self).is_local(module)
+        return self.index.is_local(module, self.base)
+
+
+def name_reference(name):
+    """Return the IPython reference type of a name, or None"""
+    underscore_num = re.findall(r"(^_(i)?\d*$)", name)
+    many_underscores = re.findall(r"(^_{1,3}$)", name)
+    many_is = re.findall(r"(^_i{1,3}$)", name)
+    if underscore_num:
+        return "input_ref" if underscore_num[0][1] else "output_ref"
+    elif many_underscores:
+        return "output_ref"
+    elif many_is:
+        return "input_ref"
+    elif name == "_sh":
+        return "shadown_ref"
+    return None
 
 
 class CellVisitor(ast.NodeVisitor):
@@ -157,8 +172,10 @@ class CellVisitor(ast.NodeVisitor):
         self.names = defaultdict(Counter)
 
     def new_module(self, line, type_, name):
-        """Insert new module"""
-        self.modules.append((line, type_, name, self.local_checker.is_local(name)))
+        """Insert new module
+        Without a local checker, locality is left as None"""
+        local = self.local_checker.is_local(name) if self.local_checker else None
+        self.modules.append((line, type_, name, local))
 
     @contextmanager
     def set_scope(self, scope):
@@ -390,41 +407,235 @@ class CellVisitor(ast.NodeVisitor):
         """Collect _, __, ___, _i, _ii, _iii, _0, _1, _i0, _i1, ..., _sh"""
         self.count_name(node.id, type(node.ctx).__name__.lower())
         self.generic_visit(node)
-        type_ = None
-        underscore_num = re.findall(r"(^_(i)?\d*$)", node.id)
-        many_underscores = re.findall(r"(^_{1,3}$)", node.id)
-        many_is = re.findall(r"(^_i{1,3}$)", node.id)
-        if underscore_num:
-            type_ = "input_ref" if underscore_num[0][1] else "output_ref"
-        elif many_underscores:
-            type_ = "output_ref"
-        elif many_is:
-            type_ = "input_ref"
-        elif node.id == "_sh":
-            type_ = "shadown_ref"
+        type_ = name_reference(node.id)
+        if type_ is not None:
+            self.count_simple("ipython")
+            self.ipython_features.append((node.lineno, node.col_offset, type_, node.id))
+
+
+class ArrayCellVisitor(CellVisitor):
+    """CellVisitor that counts into a preallocated list of integers
+    Counter indexes, visit methods and context names are looked up by node
+    class in tables shared by all visitors. It produces the same counter"""
+
+    keys = None
+    index = None
+    scoped = None
+    totals = None
+    kinds = {}
+    contexts = {}
+
+    def __init__(self, local_checker):
+        self.layout()
+        self.values = [0] * len(self.keys)
+        self.others = []
+
+        self.scope = None
+        self.globals = set()
+        self.nonlocals = set()
+
+        self.ipython_features = []
+        self.modules = []
+        self.local_checker = local_checker
+        self.names = defaultdict(Counter)
+
+    @classmethod
+    def layout(cls):
+        """Build the counter indexes from the CellVisitor counter"""
+        if cls.keys is not None:
+            return
+        reference = CellVisitor(None)
+        keys = [name for name in reference.counter if name != "ast_others"]
+        index = {name: position for position, name in enumerate(keys)}
+        cls.statements = reference.statements
+        cls.expressions = reference.expressions
+        cls.index = index
+        cls.scoped = {
+            (scope, name[len(scope) + 1:]): position
+            for name, position in index.items()
+            for scope in ("class", "global", "nonlocal", "local")
+            if name.startswith(scope + "_")
+        }
+        cls.totals = {
+            name[len("total_"):]: position
+            for name, position in index.items()
+            if name.startswith("total_")
+        }
+        cls.keys = keys
+
+    @property
+    def counter(self):
+        """Return the counter in the order of CellVisitor"""
+        result = OrderedDict(zip(self.keys, self.values))
+        result["ast_others"] = "".join(name + " " for name in self.others)
+        return result
+
+    def visit(self, node, generic=False):
+        """Count node and visit its children unless it has a visit method"""
+        try:
+            method, indexes, other, fields = self.kinds[node.__class__]
+        except KeyError:
+            method, indexes, other, fields = self.node_kind(node.__class__)
+        if method is not None and not generic:
+            return method(self, node)
+        values = self.values
+        for position in indexes:
+            values[position] += 1
+        if other is not None:
+            self.others.append(other)
+        visit = self.visit
+        for field in fields:
+            value = getattr(node, field, None)
+            if isinstance(value, list):
+                for item in value:
+                    if isinstance(item, AST):
+                        visit(item)
+            elif isinstance(value, AST):
+                visit(value)
+
+    def node_kind(self, nodeclass):
+        """Return the dispatch table entry of a node class
+        Entries have the visit method, or None for generic nodes, the counter
+        indexes, the unknown counter name and the node fields"""
+        name = nodeclass.__name__.lower()
+        method = getattr(type(self), "visit_" + nodeclass.__name__, None)
+        if method is not None and method is getattr(ast.NodeVisitor, method.__name__, None):
+            method = None
+        key = "ast_" + name
+        indexes = []
+        other = None
+        if key not in self.index:
+            other = key
+        else:
+            indexes.append(self.index[key])
+            if name in self.statements:
+                indexes.append(self.index["ast_statements"])
+            if name in self.expressions:
+                indexes.append(self.index["ast_expressions"])
+        kind = (method, tuple(indexes), other, tuple(nodeclass._fields))
+        self.kinds[nodeclass] = kind
+        return kind
+
+    def count_simple(self, name):
+        position = self.index.get(name)
+        if position is None:
+            self.others.append(name)
+        else:
+            self.values[position] += 1
+
+    def count(self, name, varname=None, scope=None):
+        if varname in self.globals:
+            scope = "global"
+        if varname in self.nonlocals:
+            scope = "nonlocal"
+        scope = scope or self.scope
+        if scope is not None:
+            self.values[self.scoped[(scope, name)]] += 1
+        self.values[self.totals[name]] += 1
+        return scope
 
+    def generic_visit(self, node):
+        self.visit(node, generic=True)
+
+    def visit_Name(self, node):
+        """Collect _, __, ___, _i, _ii, _iii, _0, _1, _i0, _i1, ..., _sh"""
+        context = self.contexts.get(node.ctx.__class__)
+        if context is None:
+            context = self.contexts[node.ctx.__class__] = type(node.ctx).__name__.lower()
+        self.count_name(node.id, context)
+        self.generic_visit(node)
+        if not node.id.startswith("_"):
+            return
+        type_ = name_reference(node.id)
         if type_ is not None:
             self.count_simple("ipython")
             self.ipython_features.append((node.lineno, node.col_offset, type_, node.id))
 
 
-@timeout(1 * 60, use_signals=False)
-def extract_features(text, checker):
-    """Use cell visitor to extract features from cell text"""
-    visitor = CellVisitor(checker)
+def analyze_cell(text, visitor_class=ArrayCellVisitor):
+    """Return counter, modules, IPython features and names of a cell"""
+    visitor = visitor_class(None)
     try:
         parsed = ast.parse(text)
     except ValueError:
         raise SyntaxError("Invalid escape")
     visitor.visit(parsed)
-    visitor.counter["ast_others"] = visitor.counter["ast_others"].strip()
+    counter = visitor.counter
+    counter["ast_others"] = counter["ast_others"].strip()
     return (
-        visitor.counter,
+        counter,
         visitor.modules,
         visitor.ipython_features,
         visitor.names
     )
 
+
+# Increase when the visitor changes its results to invalidate cached features
+CACHE_VERSION = 1
+
+
+@deadline(1 * 60)
+def visit_cell(text):
+    """Use cell visitor to extract repository-independent features"""
+    return analyze_cell(text)
+
+
+def encode_analysis(analysis):
+    """Return JSON representation of analyze_cell result"""
+    counter, modules, features, names = analysis
+    return {
+        "counter": list(counter.items()),
+        "modules": [[line, type_, name] for line, type_, name, _ in modules],
+        "features": [list(feature) for feature in features],
+        "names": [
+            [scope, mode, dict(values)] for (scope, mode), values in names.items()
+        ],
+    }
+
+
+def decode_analysis(result):
+    """Return analyze_cell result of its JSON representation
+    Raises the cached SyntaxError"""
+    if "error" in result:
+        raise SyntaxError(result["error"])
+    names = defaultdict(Counter)
+    for scope, mode, values in result["names"]:
+        names[(scope, mode)].update(values)
+    return (
+        OrderedDict(result["counter"]),
+        [(line, type_, name, None) for line, type_, name in result["modules"]],
+        [tuple(feature) for feature in result["features"]],
+        names,
+    )
+
+
+def cached_visit_cell(text):
+    """Return visit_cell result from the feature cache
+    Timeouts are not cached"""
+    cache = get_cache("code", CACHE_VERSION)
+    result = cache.get(text)
+    if result is not None:
+        return decode_analysis(result)
+    try:
+        analysis = visit_cell(text)
+    except SyntaxError as err:
+        cache.put(text, {"error": str(err)})
+        raise
+    cache.put(text, encode_analysis(analysis))
+    return analysis
+
+
+def extract_features(text, checker):
+    """Use cell visitor to extract features from cell text
+    The visit runs in a persistent worker and its result is cached; only the
+    module locality check runs here, since the checker depends on the repository"""
+    counter, modules, features, names = cached_visit_cell(text)
+    modules = [
+        (line, type_, name, checker.is_local(name))
+        for line, type_, name, _ in modules
+    ]
+    return counter, modules, features, names
+
 def process_code_cell(
     session, repository_id, notebook_id, cell, checker,
     skip_if_error=consts.C_PROCESS_ERROR,
@@ -558,47 +769,38 @@ def process_code_cell(
 
 
 def load_archives(session, repository):
-    if not repository.processed & consts.R_EXTRACTED_FILES:
-        if repository.zip_path.exists():
-            vprint(1, 'Extracting files')
-            result = process_repository(session, repository, skip_if_error=0)
-            try:
-                session.commit()
-                if result != "done":
-                    raise Exception("Extraction failure. Fallback")
-                vprint(1, result)
-            except Exception as err:
-                vprint(1, 'Failed: {}'.format(err))
-                try:
-                    tarzip = tarfile.open(str(repository.zip_path))
-                    if repository.processed & consts.R_COMPRESS_ERROR:
-                        repository.processed -= consts.R_COMPRESS_ERROR
-                    session.add(repository)
-                except tarfile.ReadError:
-                    repository.processed |= consts.R_COMPRESS_ERROR
-                    session.add(repository)
-                    return True, None
-                zip_path = to_unicode(repository.hash_dir2)
-                return False, (tarzip, zip_path)
-
-        elif repository.path.exists():
-            repo_path = to_unicode(repository.path)
-            return False, (None, repo_path)
-        else:
-            repository.processed |= consts.R_UNAVAILABLE_FILES
+    """Return (skip, content) with the content of the repository
+    The manifest answers existence checks. Extract it first when possible"""
+    if not repository.processed & consts.R_EXTRACTED_FILES and repository.zip_path.exists():
+        vprint(1, 'Extracting files')
+        result = process_repository(session, repository, skip_if_error=0)
+        try:
+            session.commit()
+            if result != "done":
+                raise Exception("Extraction failure. Fallback")
+            vprint(1, result)
+        except Exception as err:
+            vprint(1, 'Failed: {}'.format(err))
+
+    content = repository_content(
+        session, repository, ("manifest", "directory", "archive")
+    )
+    if content is None:
+        repository.processed |= consts.R_UNAVAILABLE_FILES
+        session.add(repository)
+        vprint(1, "Failed to load repository. Skipping")
+        return True, None
+    if content.kind == "archive":
+        try:
+            content.archive.load()
+            if repository.processed & consts.R_COMPRESS_ERROR:
+                repository.processed -= consts.R_COMPRESS_ERROR
+            session.add(repository)
+        except (tarfile.ReadError, zipfile.BadZipfile):
+            repository.processed |= consts.R_COMPRESS_ERROR
             session.add(repository)
-            vprint(1, "Failed to load repository. Skipping")
             return True, None
-
-    tarzip =  {
-        fil.path for fil in session.query(RepositoryFile).filter(
-            RepositoryFile.repository_id == repository.id
-        )
-    }
-    zip_path = ""
-    if tarzip:
-        return False, (tarzip, zip_path)
-    return True, None
+    return False, content
 
 
 def load_repository(session, cell, skip_repo, repository_id, repository, archives):
@@ -639,17 +841,9 @@ def load_notebook(
         vprint(1, 'Processing notebook: {}'.format(notebook))
         name = to_unicode(notebook.name)
 
-        tarzip, repo_path = archives
-
-        notebook_path = os.path.join(repo_path, name)
         try:
-            if isinstance(tarzip, set):
-                checker = SetLocalChecker(tarzip, notebook_path)
-            elif tarzip:
-                checker = CompressedLocalChecker(tarzip, notebook_path)
-            else:
-                checker = PathLocalChecker(notebook_path)
-            if not checker.exists(notebook_path):
+            checker = ContentLocalChecker(archives, name)
+            if not checker.exists(name):
                 raise Exception("Repository content problem. Notebook not found")
             return skip_repo, False, cell.notebook_id, archives, checker
         except Exception as err:
@@ -665,6 +859,7 @@ def apply(
     count, interval, reverse, check
 ):
     """Extract code cell features"""
+    cache = get_cache("code", CACHE_VERSION)
     while selected_notebooks:
         filters = [
             Cell.processed.op('&')(consts.C_PROCESS_OK) == 0,
@@ -723,7 +918,9 @@ def apply(
         for cell in query:
             if check_exit(check):
                 session.commit()
+                cache.flush()
                 vprint(0, 'Found .exit file. Exiting')
+                vprint(0, cache.report())
                 return
             status.report()
 
@@ -749,6 +946,8 @@ def apply(
                 vprint(2, result)
             status.count += 1
         session.commit()
+        cache.flush()
+    vprint(0, cache.report())
 
 
 def pos_apply(dispatches, retry_errors, retry_timeout, verbose):
@@ -772,6 +971,103 @@ def pos_apply(dispatches, retry_errors, retry_timeout, verbose):
             notebook_ids = notebook_ids[20000:]
 
 
+BENCHMARK_STATEMENTS = [
+    "import numpy as np", "from os.path import join, {name}", "from .{name} import *",
+    "{name} = np.array([{number}, {number}]) * {number}",
+    "{name}.{attr}, {name}[{number}] = {name}, {name}[1:{number}]",
+    "{name} += {number} ** 2 - {name} // 3",
+    "del {name}[0], {name}.{attr}",
+    "for {name}, item in enumerate(range({number})):\n    print({name}, item)",
+    "while {name} < {number} and not {name} is None:\n    {name} = {name} + 1",
+    "if {name} in {{'a': 1}}:\n    pass\nelif {name} != {number}:\n    raise ValueError('{name}')",
+    "with open('{name}.txt') as fil:\n    lines = [line for line in fil if line]",
+    "try:\n    {name}()\nexcept Exception as err:\n    assert err\nfinally:\n    {name} = None",
+    "@decorator\ndef {name}(a, b={number}, *args, **kwargs):\n    global {attr}\n"
+    "    {attr} = lambda x: x if x else -x\n    return {{k: v for k, v in kwargs.items()}}",
+    "class {name}(Base):\n    {attr} = {number}\n    def method(self):\n"
+    "        def inner():\n            nonlocal {attr}\n            {attr} = 1\n"
+    "        yield from (x for x in {{1, 2}})",
+    "get_ipython().run_line_magic('matplotlib', 'inline')",
+    "get_ipython().run_line_magic('load_ext', '{name}')",
+    "get_ipython().system('ls {name}')",
+    "print(In[{number}], Out[{number}], _i{number}, _{number}, __, _ii)",
+    "{name} = f'{{{name}!r:>{number}}}' + b'{attr}'.decode()",
+    "async def {name}():\n    async with lock:\n        await {attr}\n",
+]
+
+
+def synthetic_cells(cells, lines=400, seed=0):
+    """Return large code cells built from BENCHMARK_STATEMENTS"""
+    rnd = random.Random(seed)
+    words = ["data", "model", "df", "result", "value", "x", "y", "plot", "config"]
+    result = []
+    for _ in range(cells):
+        result.append("\n".join(
+            rnd.choice(BENCHMARK_STATEMENTS).format(
+                name=rnd.choice(words), attr=rnd.choice(words),
+                number=rnd.randint(0, 99)
+            )
+            for _ in range(lines)
+        ))
+    return result
+
+
+def benchmark(cells, lines=400, repeat=5):
+    """Compare CellVisitor and ArrayCellVisitor on large synthetic cells
+    Reports the best of repeat runs"""
+    texts = synthetic_cells(cells, lines)
+    parsed = [ast.parse(text) for text in texts]
+    times = {}
+    for _ in range(repeat):
+        for visitor_class in (CellVisitor, ArrayCellVisitor):
+            start = time.time()
+            for tree in parsed:
+                visitor = visitor_class(None)
+                visitor.visit(tree)
+                visitor.counter
+            elapsed = time.time() - start
+            name = visitor_class.__name__
+            times[name] = min(times.get(name, elapsed), elapsed)
+    vprint(0, "Cells: {}. Lines per cell: {}".format(cells, lines))
+    for name, elapsed in sorted(times.items()):
+        vprint(0, "{}: {:.1f} cells/s".format(name, cells / elapsed))
+    vprint(0, "Speedup: {:.2f}x".format(
+        times["CellVisitor"] / times["ArrayCellVisitor"]
+    ))
+
+
+def parity(session, cells, interval):
+    """Compare the analysis of CellVisitor and ArrayCellVisitor
+    Uses code cells from the database and synthetic cells"""
+    query = session.query(Cell.id, Cell.source).filter(
+        Cell.cell_type == 'code', Cell.python.is_(True)
+    )
+    if interval:
+        query = query.filter(
+            Cell.repository_id >= interval[0],
+            Cell.repository_id <= interval[1],
+        )
+    sources = [(cell_id, source) for cell_id, source in query.limit(cells)]
+    sources += [('synthetic', text) for text in synthetic_cells(cells, 40)]
+    mismatches = errors = 0
+    for cell_id, source in sources:
+        try:
+            expected = analyze_cell(source, CellVisitor)
+        except SyntaxError:
+            errors += 1
+            continue
+        result = analyze_cell(source, ArrayCellVisitor)
+        if list(expected[0].items()) != list(result[0].items()) or expected[1:] != result[1:]:
+            mismatches += 1
+            vprint(1, "Cell {}: {}".format(cell_id, [
+                (key, value, result[0].get(key))
+                for key, value in expected[0].items() if value != result[0].get(key)
+            ]))
+    vprint(0, "Cells: {}. Syntax errors: {}. Mismatches: {}".format(
+        len(sources), errors, mismatches
+    ))
+
+
 def main():
     """Main function"""
     register_surrogateescape()
@@ -799,9 +1095,20 @@ def main():
     parser.add_argument('--check', type=str, nargs='*',
                         default={'all', script_name, script_name + '.py'},
                         help='check name in .exit')
+    parser.add_argument('-p', '--parity', type=int, default=0,
+                        help='compare visitors on this many cells')
+    parser.add_argument('-b', '--benchmark', type=int, default=0,
+                        help='measure cells/s on this many synthetic cells')
 
     args = parser.parse_args()
     config.VERBOSE = args.verbose
+    if args.benchmark:
+        benchmark(args.benchmark)
+        return
+    if args.parity:
+        with connect() as session:
+            parity(session, args.parity, args.interval)
+        return
     status = None
     if not args.count:
         status = StatusLogger(script_name)
@@ -106,7 +106,8 @@ def extract_repository(session, repository, skip_extract, out, err):
                 shutil.rmtree(str(config.EXECUTION_DIR), ignore_errors=True)
             if repository.zip_path.exists():
                 config.EXECUTION_DIR.mkdir(parents=True, exist_ok=True)
-                cmd = repository.uncompress(config.EXECUTION_DIR, return_cmd=True)
+                # Executions may write files: do not share blobs
+                cmd = repository.uncompress(config.EXECUTION_DIR, return_cmd=True, copy=True)
                 vprint(3, "Extract: {}".format(repository.zip_path))
                 vprint(3, "Command: {}".format(" ".join(cmd)))
                 uncompressed = subprocess.call(cmd, stdout=out, stderr=err)
@@ -0,0 +1,118 @@
+"""Persistent key/value caches in sqlite
+Caches live in config.CACHE_DIR, on local disk. Each process opens its own
+connection and stores new values in batches, and when it exits. Cache
+errors disable the cache, so callers compute every value instead.
+"""
+import os
+import sqlite3
+from multiprocessing.util import Finalize
+
+import config
+from utils import vprint
+
+
+class SqliteCache(object):
+    """Table of key -> values. Subclasses define table and columns"""
+    table = "cache"
+    columns = ("result",)
+    label = "Cache"
+
+    def __init__(self, path, flush_size=500):
+        self.path = path
+        self.flush_size = flush_size
+        self.connection = None
+        self.pending = []
+        self.hits = self.misses = 0
+
+    def connect(self):
+        """Open cache. Returns None if the cache is disabled"""
+        if self.connection is None and self.path:
+            try:
+                config.Path(str(self.path)).parent.mkdir(parents=True, exist_ok=True)
+                self.connection = sqlite3.connect(str(self.path), timeout=60)
+                self.connection.execute("PRAGMA journal_mode=WAL")
+                self.connection.execute("PRAGMA synchronous=NORMAL")
+                self.connection.execute(
+                    "CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, {})".format(
+                        self.table, ", ".join(column + " TEXT" for column in self.columns)
+                    )
+                )
+            except (sqlite3.Error, OSError) as err:
+                self.disable(err)
+        return self.connection
+
+    def disable(self, err):
+        """Stop using the cache after an error"""
+        vprint(1, "{} disabled: {}".format(self.label, err))
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except sqlite3.Error:
+                pass
+        self.connection = self.path = None
+        self.pending = []
+
+    def lookup(self, key):
+        """Return the values of key or None. Errors count as misses"""
+        connection = self.connect()
+        row = None
+        if connection is not None:
+            try:
+                row = connection.execute(
+                    "SELECT {} FROM {} WHERE key = ?".format(
+                        ", ".join(self.columns), self.table
+                    ), (key,)
+                ).fetchone()
+            except sqlite3.Error as err:
+                self.disable(err)
+        if row is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return row
+
+    def store(self, key, *values):
+        """Add values of key. They are stored every flush_size keys"""
+        if not self.path:
+            return
+        self.pending.append((key,) + values)
+        if len(self.pending) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """Store pending values in the cache"""
+        if self.pending and self.connect() is not None:
+            try:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO {} VALUES ({})".format(
+                        self.table, ", ".join("?" * (len(self.columns) + 1))
+                    ), self.pending
+                )
+                self.connection.commit()
+            except sqlite3.Error as err:
+                self.disable(err)
+        self.pending = []
+
+
+CACHES = {}
+
+
+def flush_caches():
+    """Store the pending values of the caches of the current process"""
+    if CACHES.get("pid") == os.getpid():
+        for key, cache in CACHES.items():
+            if key != "pid":
+                cache.flush()
+
+
+def process_cache(key, factory):
+    """Return the cache of key in the current process, created by factory
+    Forked workers create their own caches and flush them when they exit"""
+    pid = os.getpid()
+    if CACHES.get("pid") != pid:
+        CACHES.clear()
+        CACHES["pid"] = pid
+        Finalize(None, flush_caches, exitpriority=10)
+    if key not in CACHES:
+        CACHES[key] = factory()
+    return CACHES[key]
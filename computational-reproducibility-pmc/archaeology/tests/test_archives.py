@@ -0,0 +1,176 @@
+"""Round trips of the archive backends and their manifests"""
+import os
+import zipfile
+
+import pytest
+
+import archives
+import config
+from db import Repository
+from utils import scan_files
+
+
+def make_tree(root):
+    """Create a repository tree with nested files and links"""
+    os.makedirs(os.path.join(root, "src", "deep"))
+    os.makedirs(os.path.join(root, "empty"))
+    files = {
+        "README.md": b"# readme",
+        "setup.py": b"setup()",
+        "src/a.ipynb": b'{"cells": []}',
+        "src/deep/requirements.txt": b"numpy\n" * 1000,
+    }
+    for name, content in files.items():
+        with open(os.path.join(root, name), "wb") as fil:
+            fil.write(content)
+    os.chmod(os.path.join(root, "setup.py"), 0o755)
+    os.symlink("a.ipynb", os.path.join(root, "src", "link.ipynb"))
+    os.symlink("../src/deep/requirements.txt", os.path.join(root, "empty", "req.txt"))
+    return files
+
+
+def tree_state(root):
+    """Return {relative path: (kind, content)} of a directory"""
+    state = {}
+    for directory, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            full = os.path.join(directory, name)
+            relative = os.path.relpath(full, root)
+            if os.path.islink(full):
+                state[relative] = ("link", os.readlink(full))
+            elif os.path.isdir(full):
+                state[relative] = ("dir", None)
+            else:
+                with open(full, "rb") as fil:
+                    state[relative] = ("file", fil.read())
+    return state
+
+
+def available(name):
+    backend = archives.BACKENDS[name]
+    if backend.compressor:
+        return archives.installed(backend.compressor) and archives.installed(backend.decompressor)
+    return name != "python-zstd" or archives.zstandard is not None
+
+
+BACKENDS = [
+    pytest.param(name, marks=pytest.mark.skipif(
+        not available(name), reason="{} is not available".format(name)
+    ))
+    for name in ["bzip2", "xz", "zstd-3", "python-zstd", "zip", "blobs"]
+]
+
+
+@pytest.fixture
+def repository(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "BLOB_STORE", tmp_path / "blobs")
+    source = str(tmp_path / "repo")
+    files = make_tree(source)
+    return tmp_path, source, files
+
+
+@pytest.mark.parametrize("name", BACKENDS)
+def test_round_trip(repository, name):
+    tmp_path, source, files = repository
+    backend = archives.BACKENDS[name]
+    target = str(tmp_path / "repo.{}".format(backend.suffix))
+    members = []
+    assert archives.compress(source, target, backend, members)
+    assert archives.archive_format(target) == backend.suffix
+
+    with archives.open_archive(target) as archive:
+        names = {member.name: member for member in archive.members()}
+        assert names["repo/src/link.ipynb"].linkname == "repo/src/a.ipynb"
+        for relative, content in files.items():
+            assert archive.exists("repo/" + relative)
+            assert archive.read("repo/" + relative) == content
+
+    assert archives.read_members(target, "repo", ["setup.py", "src/link.ipynb", "missing"]) == {
+        "setup.py": files["setup.py"],
+        "src/link.ipynb": files["src/a.ipynb"],
+    }
+    found, contents = archives.scan_members(target, "repo", ["*.ipynb", "requirements.txt"])
+    assert sorted(map(str, found[0])) == ["src/a.ipynb", "src/link.ipynb"]
+    assert list(map(str, found[1])) == ["src/deep/requirements.txt"]
+    assert contents["src/link.ipynb"] == files["src/a.ipynb"]
+
+    extracted = tmp_path / "out"
+    assert archives.extract(target, str(extracted))
+    assert tree_state(str(extracted / "repo")) == tree_state(source)
+
+
+@pytest.mark.parametrize("name", BACKENDS)
+def test_compress_manifest_matches_scan_files(repository, name):
+    tmp_path, source, _ = repository
+    backend = archives.BACKENDS[name]
+    members = []
+    archives.compress(source, str(tmp_path / "repo.{}".format(backend.suffix)), backend, members)
+    _, manifest = scan_files(source, [], manifest=True)
+    assert sorted(archives.manifest_entries(members, "repo")) == sorted(manifest)
+
+
+@pytest.mark.parametrize("name", BACKENDS)
+def test_repository_compress_writes_manifest(tmp_path, monkeypatch, name):
+    monkeypatch.setattr(config, "BASE_DIR", tmp_path)
+    monkeypatch.setattr(config, "BLOB_STORE", tmp_path / "blobs")
+    repository = Repository(id=1, hash_dir1="ab", hash_dir2="repo")
+    make_tree(str(repository.path))
+    os.makedirs(str(repository.path / ".git"))
+    (repository.path / ".git" / "HEAD").write_text("ref: refs/heads/master\n")
+    manifest = []
+    assert repository.compress(backend=name, manifest=manifest)
+    assert repository.compression == name
+    assert repository.zip_path.exists()
+    assert (".git/HEAD", 23, False) in manifest
+    _, scanned = scan_files(repository.path, [], manifest=True)
+    assert sorted(
+        entry for entry in manifest if not entry[0].startswith(".git/")
+    ) == sorted(scanned)
+
+
+@pytest.mark.parametrize("name", ["zip", "bzip2", "blobs"])
+def test_recompress_from_tar(repository, name):
+    tmp_path, source, _ = repository
+    if not available(name) or not available("bzip2"):
+        pytest.skip("bzip2 is not available")
+    tar = str(tmp_path / "repo.tar.bz2")
+    archives.compress(source, tar, archives.BACKENDS["bzip2"])
+    backend = archives.BACKENDS[name]
+    target = str(tmp_path / "converted" / "repo.{}".format(backend.suffix))
+    os.makedirs(os.path.dirname(target))
+    assert archives.recompress(tar, target, backend)
+    extracted = tmp_path / "out"
+    archives.extract(target, str(extracted))
+    assert tree_state(str(extracted / "repo")) == tree_state(source)
+
+
+def test_zip_replaces_surrogates(tmp_path):
+    source = str(tmp_path / "repo")
+    os.makedirs(source)
+    with open(os.fsencode(os.path.join(source, "n\udcff.ipynb")), "wb") as fil:
+        fil.write(b"{}")
+    os.symlink("n\udcff.ipynb", os.path.join(source, "link.ipynb"))
+    target = str(tmp_path / "repo.zip")
+    members = []
+    archives.compress(source, target, archives.BACKENDS["zip"], members)
+    entries = archives.manifest_entries(members, "repo")
+    assert ("n�.ipynb", 2, False) in entries
+    with archives.open_archive(target) as archive:
+        assert archive.read("repo/link.ipynb") == b"{}"
+    archives.extract(target, str(tmp_path / "out"))
+    assert os.readlink(str(tmp_path / "out" / "repo" / "link.ipynb")) == "n�.ipynb"
+
+
+def test_extract_zip_refuses_members_outside_target(tmp_path):
+    target = str(tmp_path / "evil.zip")
+    with zipfile.ZipFile(target, "w") as out:
+        out.writestr(archives.zip_info("repo/escape", 0o120777, 0), b"../../outside")
+        out.writestr(archives.zip_info("repo/escape/file", 0o100644, 0), b"data")
+    with pytest.raises(ValueError):
+        archives.extract_zip(target, str(tmp_path / "out"))
+    assert not os.path.exists(str(tmp_path / "outside"))
+
+    with zipfile.ZipFile(target, "w") as out:
+        out.writestr(archives.zip_info("../escape", 0o100644, 0), b"data")
+    with pytest.raises(ValueError):
+        archives.extract_zip(target, str(tmp_path / "out2"))
@@ -0,0 +1,53 @@
+"""Tests for the parallel bz2 block reader"""
+import bz2
+import random
+
+import pytest
+
+import parallel_bz2
+
+
+pytestmark = pytest.mark.skipif(not parallel_bz2.SUPPORTED, reason="needs int.from_bytes")
+
+
+@pytest.fixture
+def compressed(tmp_path):
+    """Return (path, data) of a bz2 file with several 100k blocks"""
+    rng = random.Random(0)
+    words = [bytes(rng.choice(b"abcdefgh") for _ in range(6)) for _ in range(500)]
+    data = b" ".join(rng.choice(words) for _ in range(80000))
+    path = tmp_path / "data.bz2"
+    path.write_bytes(bz2.compress(data, 1))
+    return path, data
+
+
+def test_reader_matches_bz2(compressed, monkeypatch):
+    path, data = compressed
+    monkeypatch.setattr(parallel_bz2, "cpu_count", lambda: 4)
+    with parallel_bz2.BZ2BlockReader(path, 3) as reader:
+        assert len(reader.spans) > 2
+        assert reader.read() == data
+        reader.seek(123457)
+        assert reader.read(1000) == data[123457:124457]
+        assert reader.seek(-10, 2) == len(data) - 10
+        assert reader.read() == data[-10:]
+
+
+def test_threads_are_capped_by_cpus(compressed, monkeypatch):
+    path, _ = compressed
+    monkeypatch.setattr(parallel_bz2, "cpu_count", lambda: 2)
+    with parallel_bz2.BZ2BlockReader(path, 8) as reader:
+        assert reader.threads == 2
+
+
+def test_pools_are_shared_by_size(compressed, monkeypatch):
+    path, data = compressed
+    monkeypatch.setattr(parallel_bz2, "cpu_count", lambda: 4)
+    first = parallel_bz2.BZ2BlockReader(path, 2)
+    first.read(1000)
+    pool = parallel_bz2.get_pool(2)
+    with parallel_bz2.BZ2BlockReader(path, 3) as second:
+        assert second.read() == data
+    assert parallel_bz2.get_pool(2) is pool
+    assert first.read() == data[1000:]
+    first.close()
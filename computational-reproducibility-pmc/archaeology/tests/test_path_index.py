@@ -0,0 +1,94 @@
+"""Tests for the repository path index against the checks it replaced"""
+import os
+import random
+
+import pytest
+
+from path_index import PathIndex
+from s6_cell_features import PathLocalChecker
+
+
+NAMES = [
+    "setup.py",
+    "pkg/__init__.py",
+    "pkg/core.py",
+    "pkg/sub/__init__.py",
+    "pkg/sub/tools.py",
+    "notebooks/analysis.ipynb",
+    "notebooks/helpers.py",
+    "notebooks/lib/plot.py",
+    "data/pkg/core.py",
+    "mypkg/core.py",
+    "a/b/c/d.py",
+    "utils.py",
+]
+
+
+def endswith_possibility(names, module_name):
+    """Best p0 score with the endswith rule of the baseline scan"""
+    modes = [[module_name, 3, "full match 3"]]
+    split = module_name.split("/", 1)
+    if len(split) > 1:
+        modes.append([split[-1], 2, "all but first 2"])
+    split = module_name.split("/")
+    if len(split) > 2:
+        modes.append([split[-1], 1, "module name 1"])
+    for modname, value, result in modes:
+        suffix = None
+        for name in names:
+            if name.endswith(modname):
+                if len(name) <= len(modname):
+                    return value, result
+                if name[-len(modname) - 1] == "/":
+                    suffix = (value, result + " (py)")
+        if suffix:
+            return suffix
+    return 0, "non-local"
+
+
+def module_paths(rng, count):
+    """Return module paths built from the parts of NAMES and unknown parts"""
+    parts = sorted({part for name in NAMES for part in name.split("/")})
+    parts += ["core", "missing", "c", "d", "x.py"]
+    return [
+        "/".join(rng.choice(parts) for _ in range(rng.randint(1, 4)))
+        for _ in range(count)
+    ] + ["pkg/core.py", "core.py", "x/pkg/core.py", "y/z/tools.py", "b/c/d.py", "ore.py"]
+
+
+def test_local_possibility_matches_endswith():
+    index = PathIndex(NAMES)
+    for module in module_paths(random.Random(0), 2000):
+        assert index.local_possibility(module) == endswith_possibility(NAMES, module), module
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for name in NAMES:
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("")
+    return tmp_path
+
+
+@pytest.mark.parametrize("notebook", ["notebooks/analysis.ipynb", "analysis.ipynb", "a/b/x.ipynb"])
+def test_is_local_matches_path_checker(tree, notebook):
+    index = PathIndex(NAMES)
+    checker = PathLocalChecker(str(tree / notebook))
+    base = os.path.dirname(notebook)
+    modules = [
+        "pkg", "pkg.core", "pkg.sub.tools", "pkg.missing", "helpers", "lib.plot",
+        "lib", "utils", "setup", "c.d", "b.c.d", "numpy", ".relative", "pkg..core",
+        "notebooks.helpers", "data.pkg.core", "core",
+    ]
+    for module in modules:
+        assert index.is_local(module, base) == checker.is_local(module), module
+
+
+def test_exists_includes_implicit_directories():
+    index = PathIndex(NAMES)
+    assert index.exists("pkg/sub")
+    assert index.exists("./notebooks//lib/plot.py")
+    assert index.exists("")
+    assert not index.exists("pkg/sub/missing.py")
+    assert not index.exists("notebooks/lib/plot")
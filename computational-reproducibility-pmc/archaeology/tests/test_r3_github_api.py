@@ -0,0 +1,167 @@
+"""Tests for the GraphQL query builder and response mapping of r3"""
+from datetime import datetime
+
+import pytest
+import requests
+
+import r3_github_api as r3
+from db import Article, Repository
+
+
+RESPONSE = {
+    "url": "https://github.com/owner/name",
+    "description": "Notebooks",
+    "createdAt": "2019-01-02T03:04:05Z",
+    "updatedAt": "2020-01-02T03:04:05Z",
+    "pushedAt": "2020-01-01T00:00:00-03:00",
+    "diskUsage": 1234,
+    "homepageUrl": "",
+    "languages": {"edges": [
+        {"size": 900, "node": {"name": "Jupyter Notebook"}},
+        {"size": 100, "node": {"name": "Python"}},
+    ]},
+    "stargazerCount": 7,
+    "watchers": {"totalCount": 3},
+    "forkCount": 2,
+    "issues": {"totalCount": 4},
+    "pullRequests": {"totalCount": 1},
+    "isArchived": False,
+    "hasIssuesEnabled": True,
+    "hasProjectsEnabled": False,
+    "hasWikiEnabled": True,
+    "isPrivate": False,
+    "licenseInfo": {"name": "MIT License", "key": "mit"},
+    "defaultBranchRef": {"target": {
+        "published": {"totalCount": 5},
+        "accepted": {"totalCount": 8},
+    }},
+    "releases": {
+        "totalCount": 1,
+        "pageInfo": {"hasNextPage": False, "endCursor": None},
+        "nodes": [{
+            "name": "v1", "tagName": "v1.0", "createdAt": "2019-05-01T00:00:00Z",
+            "publishedAt": None, "isPrerelease": True,
+        }],
+    },
+}
+
+
+class Response(object):
+    """Recorded requests response"""
+
+    def __init__(self, status_code, body=None, headers=None, text=""):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+        self.text = text
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(str(self.status_code))
+
+
+@pytest.fixture
+def repository():
+    return Repository(id=10, article_id=20, repository='owner/na"me')
+
+
+def test_alias_query_escapes_names_and_builds_history(repository):
+    article = Article(published_date="2020-02-03", received_date=None,
+                      accepted_date="2020-01-05")
+    query = r3.repository_alias_query("r0", repository, article, after="abc")
+    assert 'r0: repository(owner: "owner", name: "na\\"me")' in query
+    assert 'published: history(since: "2020-02-03T00:00:00Z")' in query
+    assert 'accepted: history(since: "2020-01-05T00:00:00Z")' in query
+    assert "received:" not in query
+    assert "orderBy: {field: SIZE, direction: DESC}" in query
+    assert 'after: "abc"' in query
+
+
+def test_alias_query_without_article(repository):
+    query = r3.repository_alias_query("r3", repository, None)
+    assert "history" not in query
+    assert "... on Commit {\n                    oid" in query
+    assert "after:" not in query
+
+
+def test_repository_data_row(repository):
+    row = r3.repository_data_row(repository, RESPONSE)
+    assert row["created_at"] == datetime(2019, 1, 2, 3, 4, 5)
+    assert row["pushed_at"] == datetime(2020, 1, 1, 3, 0, 0)
+    assert row["language"] == str({"Jupyter Notebook": 900, "Python": 100})
+    assert row["watchers"] == row["stargazers_count"] == 7
+    assert row["subscribers_count"] == 3
+    assert row["open_issues_count"] == 5
+    assert row["license_key"] == "mit"
+    assert row["total_commits_after_published_date"] == 5
+    assert row["total_commits_after_received_date"] is None
+    assert row["total_commits_after_accepted_date"] == 8
+    assert row["network_count"] is row["has_downloads"] is row["has_pages"] is None
+    assert (row["repository_id"], row["article_id"]) == (10, 20)
+
+
+def test_release_rows(repository):
+    rows = r3.release_rows(repository, RESPONSE["releases"]["nodes"])
+    assert rows == [{
+        "name": "v1",
+        "tag_name": "v1.0",
+        "created_at": datetime(2019, 5, 1),
+        "published_at": None,
+        "tarball_url": 'https://api.github.com/repos/owner/na"me/tarball/v1.0',
+        "prerelease": True,
+        "repository_id": 10,
+        "article_id": 20,
+    }]
+
+
+def test_fetch_batch_skips_missing_repositories(repository, monkeypatch):
+    missing = Repository(id=11, article_id=21, repository="owner/gone")
+    monkeypatch.setattr(r3, "graphql_query", lambda query, endpoint: (
+        {"r0": RESPONSE, "r1": None}, [{"message": "Could not resolve"}]
+    ))
+    data_rows, release_rows = r3.fetch_batch([(repository, None), (missing, None)])
+    assert [row["repository_id"] for row in data_rows] == [10]
+    assert [row["tag_name"] for row in release_rows] == ["v1.0"]
+
+
+def test_retry_delay():
+    assert r3.retry_delay(Response(502), 2) == 4
+    assert r3.retry_delay(Response(403, headers={"Retry-After": "30"}), 0) == 30
+    assert r3.retry_delay(Response(403, text="You have triggered an abuse detection"), 1) == 120
+    assert r3.retry_delay(Response(403, text="Resource not accessible"), 0) is None
+    assert r3.retry_delay(Response(200), 0) is None
+
+
+def test_graphql_query_retries_with_timeout(monkeypatch):
+    responses = [
+        requests.Timeout("slow"),
+        Response(502),
+        Response(403, headers={"Retry-After": "5"}),
+        Response(200, {"data": {"r0": None}, "errors": [{"message": "x"}]}),
+    ]
+    calls, sleeps = [], []
+
+    def post(endpoint, data, headers, timeout):
+        calls.append(timeout)
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(r3.requests, "post", post)
+    monkeypatch.setattr(r3.time, "sleep", sleeps.append)
+    data, errors = r3.graphql_query("query {}", "http://localhost", timeout=3)
+    assert data == {"r0": None}
+    assert errors == [{"message": "x"}]
+    assert calls == [3, 3, 3, 3]
+    assert sleeps == [1, 2, 5.0]
+
+
+def test_graphql_query_raises_after_last_retry(monkeypatch):
+    monkeypatch.setattr(r3.requests, "post", lambda *args, **kwargs: Response(502))
+    monkeypatch.setattr(r3.time, "sleep", lambda delay: None)
+    with pytest.raises(requests.HTTPError):
+        r3.graphql_query("query {}", "http://localhost", retries=2)
@@ -0,0 +1,71 @@
+"""Parity of the single-pass markdown counter with rendered markdown"""
+import random
+
+import pytest
+
+from s4_markdown_features import (
+    Summary, UNDETECTED, extract_features, extract_token_features,
+    synthetic_notebooks
+)
+
+
+ENGLISH = ("english", frozenset(["the", "of", "and", "a", "is", "to", "in", "it"]), True)
+
+SNIPPETS = [
+    "",
+    "plain text",
+    "# Header\n\nSetext header\n=============\n\nSub\n---",
+    "* item one\n* item *two*\n    * nested **bold**\n\n1. first\n2. second",
+    "> quote with `code`\n> > nested quote\n\nafter",
+    "```python\nimport numpy as np\nx = 1\n```\n\n    indented code\n",
+    "| a | b |\n|---|:-:|\n| 1 | the |\n| 2 | of |",
+    "Inline $x^2$ and block\n\n$$\\sum_i x_i$$\n\n\\begin{equation}a=b\\end{equation}",
+    "<div>html <b>block</b></div>\n\ntext <span>inline</span>",
+    "Footnote[^1].\n\n[^1]: the note",
+    "[link](http://example.com) ![image](img.png) <http://auto.link> [ref][r]\n\n[r]: http://r.com",
+    "escapes \\* \\_ \\# and line  \nbreak\nsoft",
+    "a**b**c *d*e `f`g",
+    "the of and\n\n\n\ntrailing   ",
+    "---\n\n***\n\nword",
+    "Term\n: definition? \t tabs\tand nbsp",
+]
+
+
+def combined(seed, count):
+    """Return texts that join random snippets"""
+    rnd = random.Random(seed)
+    return [
+        rnd.choice(["", "\n", "\n\n", " "]).join(rnd.sample(SNIPPETS, rnd.randint(2, 4)))
+        for _ in range(count)
+    ]
+
+
+@pytest.mark.parametrize("language", [ENGLISH, UNDETECTED], ids=["english", "undetected"])
+def test_token_counter_matches_rendered_features(language):
+    texts = SNIPPETS + combined(0, 300) + [
+        text for notebook in synthetic_notebooks(200) for text in notebook
+    ]
+    for text in texts:
+        assert extract_token_features(text, language) == extract_features(text, language), text
+
+
+def test_counter_is_reset_between_texts():
+    first = extract_token_features("# one\n\n* two", ENGLISH)
+    extract_token_features("| a |\n|---|\n| b |", ENGLISH)
+    assert extract_token_features("# one\n\n* two", ENGLISH) == first
+
+
+@pytest.mark.parametrize("parts", [
+    ["the", " of"], ["a", "b"], ["a ", "b"], ["in", "", "to"], ["x y", "z w", "v"],
+    [" ", "the"], ["t", "he", " of"], ["\n", "a\n", "b"],
+])
+def test_summary_addition_matches_joined_split(parts):
+    stopset = ENGLISH[1]
+    summary = Summary("", stopset)
+    for part in parts:
+        summary = summary + Summary(part, stopset)
+    joined = "".join(parts)
+    expected = Summary(joined, stopset)
+    assert (summary.length, summary.newlines, summary.words, summary.stopwords) == (
+        expected.length, expected.newlines, expected.words, expected.stopwords
+    )
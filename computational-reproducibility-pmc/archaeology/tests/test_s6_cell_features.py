@@ -0,0 +1,52 @@
+"""Parity of ArrayCellVisitor with the dict based CellVisitor"""
+import sys
+
+import pytest
+
+from s6_cell_features import ArrayCellVisitor, CellVisitor, analyze_cell, synthetic_cells
+
+
+SNIPPETS = [
+    "",
+    "import os, sys as system\nfrom os import path\nfrom . import local\nfrom ..pkg import mod as m",
+    "x = 1\ny: int = 2\nx += y\ndel x\nprint(_, __, ___, _i, _ii, _iii, _1, _i2, _sh)",
+    "def f(a, b=1, *args, c, d=2, **kwargs):\n    global g\n    return lambda z: z + a\n",
+    "class A(B, metaclass=M):\n    '''doc'''\n    @property\n    def x(self):\n        nonlocal_ = self.y[1:2, ::3]\n        return nonlocal_",
+    "for i in range(10):\n    if i % 2:\n        continue\n    elif i > 5:\n        break\nelse:\n    pass\nwhile True:\n    break",
+    "try:\n    raise ValueError('x')\nexcept (ValueError, TypeError) as err:\n    pass\nfinally:\n    assert True, 'msg'",
+    "with open('f') as fil, open('g') as gil:\n    data = [x for x in fil if x]\n    s = {k: v for k, v in gil}\n    g = (a for a in s)\n    t = {1, 2}",
+    "async def main():\n    async with lock:\n        await asyncio.sleep(1)\n    async for item in stream:\n        yield item",
+    "value = f'{x!r:>10} {y}' + b'bytes' + r'raw' + 1j + 1.5 + ...\nz = not a and b or c is not d in e",
+    "if (n := len(a)) > 10:\n    print(n)\nx = a if b else c\nx = [*a, *b]\ny = {**c}",
+    "def g():\n    x = 0\n    def h():\n        nonlocal x\n        x += 1\n    yield from h()",
+    "import numpy as np\nimport matplotlib.pyplot as plt\nplt.plot(np.arange(10))\n_ = plt.show()",
+]
+if sys.version_info >= (3, 10):
+    SNIPPETS.append(
+        "match command.split():\n    case [action, obj]:\n        pass\n"
+        "    case Point(x=0, y=0) | {'k': v}:\n        pass\n    case _:\n        pass"
+    )
+
+
+def assert_same_analysis(text):
+    expected = analyze_cell(text, CellVisitor)
+    result = analyze_cell(text, ArrayCellVisitor)
+    assert list(result[0].items()) == list(expected[0].items())
+    assert result[1:] == expected[1:]
+
+
+@pytest.mark.parametrize("text", SNIPPETS)
+def test_snippet_parity(text):
+    assert_same_analysis(text)
+
+
+def test_combined_and_synthetic_parity():
+    assert_same_analysis("\n".join(SNIPPETS))
+    for text in synthetic_cells(20, 60):
+        assert_same_analysis(text)
+
+
+def test_syntax_errors_are_raised_by_both():
+    for visitor_class in (CellVisitor, ArrayCellVisitor):
+        with pytest.raises(SyntaxError):
+            analyze_cell("def (:", visitor_class)
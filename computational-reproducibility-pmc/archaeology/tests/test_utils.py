@@ -0,0 +1,61 @@
+"""Tests for the single pass file scanner"""
+import os
+import tarfile
+
+from archives import manifest_entries
+from utils import scan_files
+
+
+def make_tree(root):
+    """Create a repository tree with .git, links and surrogate names"""
+    os.makedirs(os.path.join(root, "src", "deep"))
+    os.makedirs(os.path.join(root, ".git", "objects"))
+    os.makedirs(os.path.join(root, "d\udcff"))
+    files = {
+        "setup.py": b"setup()",
+        "src/a.ipynb": b"{}",
+        "src/deep/requirements.txt": b"numpy",
+        "src/notes.txt": b"text",
+        "n\udcff.ipynb": b"{}",
+        "other\udcff.txt": b"x",
+        "d\udcff/b.ipynb": b"{}",
+        ".git/config": b"[core]",
+        ".git/objects/requirements.txt": b"",
+    }
+    for name, content in files.items():
+        with open(os.fsencode(os.path.join(root, name)), "wb") as fil:
+            fil.write(content)
+    os.symlink("a.ipynb", os.path.join(root, "src", "link.ipynb"))
+
+
+def test_scan_files_matches_and_renames_only_matched_files(tmp_path):
+    root = str(tmp_path / "repo")
+    make_tree(root)
+    found, manifest = scan_files(root, ["*.ipynb", "requirements.txt", "setup.py"])
+    assert manifest is None
+    notebooks, requirements, setups = [sorted(map(str, paths)) for paths in found]
+    assert notebooks == sorted([
+        "src/a.ipynb", "src/link.ipynb", "n�.ipynb", "d\udcff/b.ipynb"
+    ])
+    assert requirements == ["src/deep/requirements.txt"]
+    assert setups == ["setup.py"]
+    names = set(os.listdir(root))
+    assert "n�.ipynb" in names
+    assert "other\udcff.txt" in names
+    assert "d\udcff" in names
+
+
+def test_scan_files_manifest_matches_tar_manifest(tmp_path):
+    root = str(tmp_path / "repo")
+    make_tree(root)
+    _, manifest = scan_files(root, [], manifest=True)
+    archive = str(tmp_path / "repo.tar")
+    with tarfile.open(archive, "w") as tar:
+        tar.add(root, arcname="repo")
+    with tarfile.open(archive) as tar:
+        expected = manifest_entries(tar.getmembers(), "repo")
+    git = [entry for entry in expected if entry[0].startswith(".git/")]
+    assert git
+    assert (".git", 0, False) in manifest
+    assert sorted(manifest) == sorted(set(expected) - set(git))
+    assert ("other.txt", 1, True) in manifest
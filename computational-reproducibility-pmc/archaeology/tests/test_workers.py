@@ -0,0 +1,80 @@
+"""Tests for the persistent worker pool"""
+import os
+import time
+
+import pytest
+
+import workers
+from utils import TimeoutError
+from workers import WorkerPool, deadline
+
+
+pytestmark = pytest.mark.skipif(workers.CONTEXT is None, reason="needs fork")
+
+
+def task(value, sleep=0.0):
+    """Return value * 2 after sleeping. Negative values raise, 0 exits"""
+    time.sleep(sleep)
+    if value < 0:
+        raise ValueError(value)
+    if value == 0:
+        os._exit(1)
+    return value * 2
+
+
+def tasks(values, slow=(), sleep=5.0):
+    return [((value,), {"sleep": sleep if value in slow else 0.0}) for value in values]
+
+
+def test_results_are_in_order():
+    with WorkerPool(task, 5, processes=2, chunksize=3) as pool:
+        results = list(pool.imap(tasks(range(1, 11))))
+    assert results == [(True, value * 2) for value in range(1, 11)]
+
+
+def test_exceptions_are_results():
+    with WorkerPool(task, 5) as pool:
+        results = list(pool.imap(tasks([1, -2, 3])))
+    assert results[0] == (True, 2)
+    assert results[1][0] is False and isinstance(results[1][1], ValueError)
+    assert results[2] == (True, 6)
+
+
+def test_timeout_replaces_worker_and_requeues_its_chunk():
+    with WorkerPool(task, 0.5, processes=1, chunksize=4) as pool:
+        pid = pool.workers[0].process.pid
+        start = time.time()
+        results = list(pool.imap(tasks([1, 2, 3, 4], slow=[2])))
+        assert time.time() - start < 4
+        assert pool.workers[0].process.pid != pid
+    assert results[0] == (True, 2)
+    assert results[1][0] is False and isinstance(results[1][1], TimeoutError)
+    assert results[2:] == [(True, 6), (True, 8)]
+
+
+def test_dead_worker_fails_its_chunk():
+    with WorkerPool(task, 5, processes=1, chunksize=1) as pool:
+        results = list(pool.imap(tasks([1, 0, 3])))
+    assert results[0] == (True, 2)
+    assert results[1][0] is False and "Worker died" in str(results[1][1])
+    assert results[2] == (True, 6)
+
+
+def test_abandoned_imap_does_not_leak_results():
+    with WorkerPool(task, 5, processes=2, chunksize=2) as pool:
+        for success, result in pool.imap(tasks(range(1, 20), slow=[3, 4], sleep=0.3)):
+            break
+        assert (success, result) == (True, 2)
+        assert all(worker.chunk is None for worker in pool.workers)
+        assert list(pool.imap(tasks([7, 8]))) == [(True, 14), (True, 16)]
+
+
+def test_deadline_decorator():
+    wrapped = deadline(0.5)(task)
+    try:
+        assert wrapped(4) == 8
+        with pytest.raises(TimeoutError):
+            wrapped(1, sleep=5.0)
+        assert wrapped(5) == 10
+    finally:
+        wrapped.pool().close()
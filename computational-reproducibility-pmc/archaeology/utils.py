@@ -15,6 +15,11 @@ from contextlib import contextmanager
 import config
 from config import Path
 
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
 def ignore_surrogates(original):
     new = original.encode('utf8','ignore').decode('utf8','ignore')
     return new, new != original
@@ -200,6 +205,30 @@ def invoke(program, *args):
     return subprocess.check_call([program] + list(map(str, args)))
 
 
+def git_head(path):
+    """Return the HEAD commit of a repository reading its .git files
+    Returns None when HEAD cannot be resolved without git"""
+    git = os.path.join(str(path), ".git")
+    try:
+        with open(os.path.join(git, "HEAD")) as fil:
+            head = fil.read().strip()
+        if not head.startswith("ref: "):
+            return head or None
+        ref = head[5:]
+        ref_path = os.path.join(git, ref)
+        if os.path.isfile(ref_path):
+            with open(ref_path) as fil:
+                return fil.read().strip() or None
+        with open(os.path.join(git, "packed-refs")) as fil:
+            for line in fil:
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == ref:
+                    return parts[0]
+    except (IOError, OSError):
+        pass
+    return None
+
+
 def find_files(path, pattern):
     """Find files recursively"""
     for root, _, filenames in os.walk(str(path)):
@@ -210,6 +239,81 @@ def find_files(path, pattern):
             yield Path(new_name)
 
 
+def replace_surrogates(name):
+    """Replace surrogates by the unicode replacement character"""
+    return name.encode('utf-8', 'surrogateescape').decode('utf-8', 'replace')
+
+
+def pattern_matcher(patterns):
+    """Return a function that maps a file name to the indexes of the
+    patterns it matches"""
+    wildcards = [
+        (index, pattern) for index, pattern in enumerate(patterns)
+        if any(char in pattern for char in "*?[")
+    ]
+    exact = {
+        pattern: index for index, pattern in enumerate(patterns)
+        if not any(char in pattern for char in "*?[")
+    }
+
+    def match(name):
+        indexes = [exact[name]] if name in exact else []
+        for index, pattern in wildcards:
+            if fnmatch.fnmatch(name, pattern):
+                indexes.append(index)
+        return indexes
+    return match
+
+
+def scan_files(path, patterns, manifest=False, skip=(".git",)):
+    """Find files matching each pattern with a single directory traversal
+    Patterns with wildcards are matched with fnmatch; the others by name.
+    Directories in skip are not traversed. Matched files are renamed if
+    their names contain surrogates, so the matched paths exist. Directories
+    keep their names.
+    Returns the relative paths for each pattern and, if manifest is set,
+    a list of (relative path, size, had_surrogates) for every entry.
+    The manifest has the entries of archives.manifest_entries for a tar of
+    path: the root (""), and size 0 for directories and symbolic links.
+    Skipped directories are single entries, without their contents, and
+    hard links count their size in every entry
+    """
+    path = str(path)
+    found = [[] for _ in patterns]
+    match = pattern_matcher(patterns)
+    files = [("", 0, False)] if manifest else None
+    stack = [(path, "")]
+    while stack:
+        directory, relative = stack.pop()
+        try:
+            entries = list(scandir(directory))
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            name = entry.name
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if is_dir and name in skip and files is None:
+                continue
+            indexes = [] if is_dir else match(name)
+            if indexes and ignore_surrogates(name)[1]:
+                name = replace_surrogates(name)
+                os.rename(entry.path, os.path.join(directory, name))
+            rel_name = relative + name
+            for index in indexes:
+                found[index].append(Path(rel_name))
+            if files is not None:
+                size = 0
+                if not is_dir and not entry.is_symlink():
+                    size = os.lstat(os.path.join(directory, name)).st_size
+                clean_name, had_surrogates = ignore_surrogates(rel_name)
+                files.append((clean_name, size, had_surrogates))
+            if is_dir and name not in skip:
+                subdirs.append((entry.path, rel_name + "/"))
+        stack.extend(reversed(subdirs))
+    return found, files
+
+
 def find_names(names, pattern, fn=Path):
     """Find path names in pattern"""
     for name in fnmatch.filter(names, pattern):
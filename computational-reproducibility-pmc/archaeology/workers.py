@@ -0,0 +1,255 @@
+"""Persistent pool of pre-forked workers with per-task deadlines"""
+import multiprocessing
+import os
+import pickle
+import signal
+import time
+from collections import deque
+from functools import wraps
+
+from utils import timeout, TimeoutError, vprint
+
+try:
+    from multiprocessing.connection import wait
+    CONTEXT = multiprocessing.get_context("fork")
+except (ImportError, AttributeError, ValueError):
+    # Python 2 environments used by s6 dispatches: deadline uses utils.timeout
+    wait = CONTEXT = None
+
+clock = getattr(time, "monotonic", time.time)  # pylint: disable=invalid-name
+
+
+def _portable(error):
+    """Return an exception that can be sent back to the parent"""
+    try:
+        pickle.loads(pickle.dumps(error))
+        return error
+    except Exception:  # pylint: disable=broad-except
+        return Exception(repr(error))
+
+
+def _work(function, connection, progress):
+    """Worker loop: run chunks of tasks and send back their results
+    progress[0] is the position of the running task in the chunk and
+    progress[1] is its start time (0 when idle)
+    """
+    while True:
+        try:
+            chunk = connection.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if chunk is None:
+            return
+        results = []
+        for position, (args, kwargs) in enumerate(chunk):
+            progress[0] = position
+            progress[1] = clock()
+            try:
+                results.append((True, function(*args, **kwargs)))
+            except Exception as err:  # pylint: disable=broad-except
+                results.append((False, _portable(err)))
+        progress[1] = 0.0
+        try:
+            connection.send(results)
+        except Exception as err:  # pylint: disable=broad-except
+            connection.send([(False, Exception(repr(err)))] * len(results))
+
+
+class Worker(object):
+    """Forked worker process and its channel"""
+
+    def __init__(self, function):
+        self.connection, child = CONTEXT.Pipe()
+        self.progress = CONTEXT.RawArray("d", 2)
+        self.process = CONTEXT.Process(
+            target=_work, args=(function, child, self.progress)
+        )
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.chunk = None
+
+    def send(self, chunk):
+        """Dispatch chunk of (task id, args, kwargs)"""
+        self.chunk = chunk
+        self.progress[0] = 0
+        self.progress[1] = clock()
+        self.connection.send([(args, kwargs) for _, args, kwargs in chunk])
+
+    def overrun(self, timeout, now):
+        """Return the position of the running task if it exceeded timeout"""
+        started = self.progress[1]
+        if self.chunk is None or not started or now - started <= timeout:
+            return None
+        return int(self.progress[0])
+
+    def kill(self):
+        """Kill worker process"""
+        try:
+            os.kill(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.process.join()
+        self.connection.close()
+
+    def close(self):
+        """Ask worker to finish"""
+        try:
+            self.connection.send(None)
+        except (IOError, OSError):
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.kill()
+        else:
+            self.connection.close()
+
+
+class WorkerPool(object):
+    """Persistent pool of pre-forked workers
+    Tasks are dispatched in chunks and results come back in batches.
+    A task that exceeds the timeout gets a TimeoutError; only the worker
+    running it is killed and replaced, and the other tasks of its chunk
+    are requeued
+    """
+
+    def __init__(self, function, timeout, processes=1, chunksize=1):
+        self.function = function
+        self.timeout = timeout
+        self.chunksize = chunksize
+        self.workers = [Worker(function) for _ in range(processes)]
+
+    def replace(self, worker):
+        """Kill worker and start a new one in its place"""
+        worker.kill()
+        new = Worker(self.function)
+        self.workers[self.workers.index(worker)] = new
+        return new
+
+    def imap(self, tasks):
+        """Yield (ok, result) for each (args, kwargs) task, in order
+        If the caller stops early, workers with tasks in flight are replaced,
+        so their results do not reach the next imap"""
+        try:
+            for item in self._imap(tasks):
+                yield item
+        finally:
+            for worker in list(self.workers):
+                if worker.chunk is not None:
+                    worker.chunk = None
+                    self.replace(worker)
+
+    def _imap(self, tasks):
+        """Dispatch tasks and yield their results in order"""
+        tasks = iter(tasks)
+        pending = deque()
+        results = {}
+        next_id = 0
+        submitted = 0
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < 2 * self.chunksize * len(self.workers):
+                try:
+                    args, kwargs = next(tasks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.append((submitted, args, kwargs))
+                submitted += 1
+            for worker in self.workers:
+                if worker.chunk is None and pending:
+                    worker.send([
+                        pending.popleft()
+                        for _ in range(min(self.chunksize, len(pending)))
+                    ])
+            while next_id in results:
+                yield results.pop(next_id)
+                next_id += 1
+            busy = [worker for worker in self.workers if worker.chunk is not None]
+            if not busy:
+                if exhausted and not pending:
+                    return
+                continue
+            now = clock()
+            remaining = [
+                self.timeout - (now - worker.progress[1])
+                for worker in busy if worker.progress[1]
+            ]
+            ready = wait(
+                [worker.connection for worker in busy],
+                max(min(remaining), 0) if remaining else self.timeout
+            )
+            for worker in busy:
+                if worker.connection in ready:
+                    chunk, worker.chunk = worker.chunk, None
+                    try:
+                        batch = worker.connection.recv()
+                    except EOFError:
+                        batch = [(False, Exception("Worker died"))] * len(chunk)
+                        self.replace(worker)
+                    for (task_id, _, _), result in zip(chunk, batch):
+                        results[task_id] = result
+                    continue
+                position = worker.overrun(self.timeout, clock())
+                if position is None:
+                    continue
+                chunk = worker.chunk
+                vprint(3, "Task exceeded {}s. Replacing worker".format(self.timeout))
+                results[chunk[position][0]] = (False, TimeoutError("Timed Out"))
+                pending.extendleft(reversed(chunk[:position] + chunk[position + 1:]))
+                self.replace(worker)
+
+    def run(self, *args, **kwargs):
+        """Run a single task and return its result or raise its exception"""
+        for success, result in self.imap([(args, kwargs)]):
+            if not success:
+                raise result
+            return result
+
+    def close(self):
+        """Stop workers"""
+        for worker in self.workers:
+            worker.close()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def deadline(seconds, processes=1, chunksize=1):
+    """Run the decorated function in a persistent worker pool
+    Calls raise TimeoutError when they take longer than seconds.
+    The pool starts on the first call; decorated.imap runs many tasks.
+    Without fork contexts, it falls back to a process per call
+    """
+    def decorator(function):
+        if CONTEXT is None:
+            wrapper = timeout(seconds, use_signals=False)(function)
+
+            def imap(tasks):
+                for args, kwargs in tasks:
+                    try:
+                        yield True, wrapper(*args, **kwargs)
+                    except Exception as err:  # pylint: disable=broad-except
+                        yield False, err
+            wrapper.imap = imap
+            return wrapper
+
+        pools = []
+
+        def pool():
+            if not pools:
+                pools.append(WorkerPool(function, seconds, processes, chunksize))
+            return pools[0]
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            return pool().run(*args, **kwargs)
+
+        wrapper.pool = pool
+        wrapper.imap = lambda tasks: pool().imap(tasks)
+        return wrapper
+    return decorator